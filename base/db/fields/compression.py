@@ -0,0 +1,122 @@
+"""
+Compression for the values of compressed fields (see `CompressedTextField` and
+`CompressedJSONField`).
+
+Compressed values are prefixed with a byte identifying the algorithm, so values
+stay readable when a field's algorithm is changed. `benchmark()` reports the
+compression ratio and costs of the algorithms for given payloads, run the
+module for a report on representative payloads:
+
+    python -m base.db.fields.compression
+"""
+
+import json
+import lzma
+import random
+import string
+import time
+import zlib
+
+__all__ = (
+    'ALGORITHMS',
+    'benchmark',
+    'compress',
+    'decompress'
+    )
+
+# The compress/decompress functions and prefix byte of each algorithm
+ALGORITHMS = {
+    'zlib': (zlib.compress, zlib.decompress, b'\x01'),
+    'lzma': (lzma.compress, lzma.decompress, b'\x02'),
+}
+
+_DECOMPRESS = {prefix: decompress for _, decompress, prefix in ALGORITHMS.values()}
+
+
+def compress(data, algorithm='zlib'):
+    """Return the compressed (prefixed) form of some bytes"""
+    compress_, _, prefix = ALGORITHMS[algorithm]
+    return prefix + compress_(data)
+
+
+def decompress(data):
+    """Return the bytes for a compressed value (of any algorithm)"""
+    return _DECOMPRESS[bytes(data[:1])](memoryview(data)[1:])
+
+
+def benchmark(payloads, algorithms=tuple(ALGORITHMS), number=20):
+    """
+    Return a report for compressing each payload (a dictionary of name to a
+    string or JSON serializable object) with each algorithm, a list of
+    dictionaries holding the payload's size, the compressed size, the ratio
+    and the mean time in milliseconds to compress and decode (decompress and,
+    for objects, parse) the payload.
+    """
+    report = []
+    for name, payload in payloads.items():
+        is_text = isinstance(payload, str)
+        data = (payload if is_text else json.dumps(payload)).encode('utf-8')
+
+        for algorithm in algorithms:
+            compressed = compress(data, algorithm)
+
+            start = time.perf_counter()
+            for _ in range(number):
+                compress(data, algorithm)
+            compress_time = (time.perf_counter() - start) / number
+
+            start = time.perf_counter()
+            for _ in range(number):
+                value = decompress(compressed).decode('utf-8')
+                if not is_text:
+                    json.loads(value)
+            decode_time = (time.perf_counter() - start) / number
+
+            report.append({
+                'payload': name,
+                'algorithm': algorithm,
+                'size': len(data),
+                'compressed_size': len(compressed),
+                'ratio': round(len(data) / len(compressed), 2),
+                'compress_ms': round(compress_time * 1000, 3),
+                'decode_ms': round(decode_time * 1000, 3)
+            })
+    return report
+
+
+# Private functions
+
+def _sample_payloads():
+    """Return representative payloads, a template and audit log blobs"""
+    rand = random.Random(0)
+    words = [''.join(rand.choices(string.ascii_lowercase, k=rand.randint(3, 9))) for _ in range(300)]
+
+    template = '\n'.join(
+        '<div class="row-{0}"><p>{{{{ {1} }}}}</p><span>{2}</span></div>'.format(
+            i % 7,
+            rand.choice(words),
+            ' '.join(rand.choices(words, k=12))
+        )
+        for i in range(400)
+    )
+    audit = [
+        {
+            'at': '2024-01-{0:02d}T{1:02d}:00:00'.format(i % 28 + 1, i % 24),
+            'user': rand.choice(words),
+            'action': rand.choice(['create', 'update', 'delete']),
+            'changes': {rand.choice(words): rand.randint(0, 10000) for _ in range(5)}
+        }
+        for i in range(500)
+    ]
+    return {
+        'template': template,
+        'audit_log': audit,
+        'small_audit_log': audit[:5]
+    }
+
+
+if __name__ == '__main__':
+    columns = ('payload', 'algorithm', 'size', 'compressed_size', 'ratio', 'compress_ms', 'decode_ms')
+    print(''.join(c.ljust(17) for c in columns))
+    for row in benchmark(_sample_payloads()):
+        print(''.join(str(row[c]).ljust(17) for c in columns))
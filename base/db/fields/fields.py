@@ -1,8 +1,14 @@
 import datetime
+import os
+import struct
+import sys
 import uuid
 import json
-from bson import ObjectId
+from array import array
+from functools import lru_cache
+from bson import Binary, ObjectId
 from django.core import checks, exceptions, validators
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.query_utils import DeferredAttribute
 from django.utils import timezone
 from django.utils.dateparse import (
@@ -11,8 +17,17 @@ from django.utils.dateparse import (
 from django.utils.functional import cached_property
 from django.utils.ipv6 import clean_ipv6_address
 from django.utils.translation import gettext_lazy as _
+
+from base.aes import AES
+from base.db.fields import compression
 # import magic
 
+# NumPy is optional, without it packed arrays are exposed as memoryviews
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __all__ = [
     'BooleanField', 'CharField',
     'DateField', 'DateTimeField',
@@ -21,7 +36,13 @@ __all__ = [
     'TextField', 'TimeField', 'URLField', 'UUIDField', 'ArrayField', 'JSONField', 'ForeignFrame', 'ForeignKey',
     'ObjectIdField',
     'EmbeddedField',
-    'PositiveIntegerField'
+    'PositiveIntegerField',
+    'BinaryField',
+    'PackedArrayField',
+    'CompressedTextField',
+    'CompressedJSONField',
+    'FileField',
+    'EncryptedField'
 ]
 
 
@@ -51,6 +72,30 @@ def return_None():
     return None
 
 
+def _membership_test(values):
+    """
+    Return a function testing if a value is in the given values, hashable
+    values are tested against a frozenset.
+    """
+    hashable = []
+    unhashable = []
+    for value in values:
+        try:
+            hash(value)
+            hashable.append(value)
+        except TypeError:
+            unhashable.append(value)
+    hashable = frozenset(hashable)
+
+    def contains(value):
+        try:
+            return value in hashable or (bool(unhashable) and value in unhashable)
+        except TypeError:
+            return value in unhashable
+
+    return contains
+
+
 class Field:  # RegisterLookupMixin
     """Base class for all field types"""
 
@@ -90,6 +135,10 @@ class Field:  # RegisterLookupMixin
 
     descriptor_class = DeferredAttribute
 
+    # The type `to_python` returns values of unchanged, the compiled clean
+    # skips the conversion for values of exactly this type
+    python_type = None
+
     # Generic field type description, usually overridden by subclasses
     def _description(self):
         return _('Field of type: %(field_type)s') % {
@@ -100,11 +149,13 @@ class Field:  # RegisterLookupMixin
 
     def __init__(self, max_length=None, null=False,
                  default=NOT_PROVIDED, validators=(), choices=None,
-                 error_messages=None):
+                 error_messages=None, db_field=None):
         self.choices = choices
         self.max_length = max_length
         self.null = null
         self.default = default
+        # The (short) name the field is stored under, if not its name
+        self.db_field = db_field
         # Adjust the appropriate creation counter, and save our local copy.
         self._validators = list(validators)  # Store for deconstruction later
         messages = {}
@@ -114,6 +165,22 @@ class Field:  # RegisterLookupMixin
         self._error_messages = error_messages  # Store for deconstruction later
         self.error_messages = messages
 
+    def __set_name__(self, owner, name):
+        if getattr(self, 'name', None) is None:
+            self.name = name
+        self._compile()
+
+    def __get__(self, instance, owner):
+        # Only reached when the instance holds no value for the field (e.g.
+        # the field was deferred when a frame was loaded), the instance decides
+        # what a missing value means.
+        if instance is None:
+            return self
+        missing_field = getattr(instance, '_missing_field', None)
+        if missing_field is None:
+            return self
+        return missing_field(self)
+
     def __repr__(self):
         """Display the module, class, and name of the field."""
         path = '%s.%s' % (self.__class__.__module__, self.__class__.__qualname__)
@@ -195,6 +262,74 @@ class Field:  # RegisterLookupMixin
         self.run_validators(value)
         return value
 
+    def compile_clean(self):
+        """
+        Return a callable equivalent to clean() specialized for the field's
+        configuration: the conversion is skipped for values already of the
+        field's `python_type`, choices and empty values are tested against
+        frozensets and validators are only run if there are any. Failing
+        values go through validate()/run_validators() for the usual errors.
+        """
+        cls = type(self)
+        if (
+                cls.clean is not Field.clean
+                or cls.validate is not Field.validate
+                or cls.run_validators is not Field.run_validators
+        ):
+            return self.clean
+
+        to_python = self.to_python
+        validate = self.validate
+        run_validators = self.run_validators
+        python_type = self.python_type
+        null = self.null
+        validators_ = self.validators
+        is_empty = _membership_test(self.empty_values)
+        in_choices = _membership_test(self.choices) if self.choices else None
+
+        # A lone max length validator (as added by `CharField`) is checked
+        # inline
+        max_length = None
+        if (
+                len(validators_) == 1
+                and isinstance(validators_[0], validators.MaxLengthValidator)
+                and isinstance(validators_[0].limit_value, int)
+        ):
+            max_length = validators_[0].limit_value
+
+        def clean(value):
+            if python_type is None or type(value) is not python_type:
+                value = to_python(value)
+
+            empty = is_empty(value)
+            if (not null and empty) or (in_choices and value and not in_choices(value)):
+                validate(value)
+
+            if validators_ and not empty:
+                if (
+                        max_length is None
+                        or len(validators_) != 1
+                        or type(value) is not str
+                        or len(value) > max_length
+                ):
+                    run_validators(value)
+            return value
+
+        return clean
+
+    def _compile(self):
+        """Replace clean() with the version compiled for the field"""
+        if 'clean' not in self.__dict__:
+            self.clean = self.compile_clean()
+
+    def get_prep_value(self, value):
+        """
+        Convert a value used in a query against this field to the type stored
+        in the database. Values that can't be converted are returned as is,
+        validation is left to clean().
+        """
+        return value
+
     def has_default(self):
         """Return a boolean of whether this field has a default value."""
         return self.default is not NOT_PROVIDED
@@ -250,6 +385,13 @@ class BooleanField(Field):
             params={'value': value},
         )
 
+    def get_prep_value(self, value):
+        if value in ('t', 'True', '1', 'true'):
+            return True
+        if value in ('f', 'False', '0', 'false'):
+            return False
+        return value
+
 
 class CharField(Field):
     description = _("String (up to %(max_length)s)")
@@ -412,6 +554,20 @@ class DateField(Field):
             params={'value': value},
         )
 
+    def get_prep_value(self, value):
+        # Dates are stored as datetimes at midnight
+        if isinstance(value, str):
+            try:
+                parsed = parse_date(value)
+            except ValueError:
+                return value
+            if parsed is None:
+                return value
+            value = parsed
+        if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            return datetime.datetime(value.year, value.month, value.day)
+        return value
+
 
 class DateTimeField(DateField):
     empty_strings_allowed = False
@@ -511,6 +667,19 @@ class DateTimeField(DateField):
             params={'value': value},
         )
 
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            try:
+                parsed = parse_datetime(value) or parse_date(value)
+            except ValueError:
+                return value
+            if parsed is None:
+                return value
+            value = parsed
+        if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            return datetime.datetime(value.year, value.month, value.day)
+        return value
+
 
 class EmailField(CharField):
     default_validators = [validators.validate_email]
@@ -528,6 +697,7 @@ class FloatField(Field):
         'invalid': _('“%(value)s” value must be a float.'),
     }
     description = _("Floating point number")
+    python_type = float
 
     def to_python(self, value):
         if value is None:
@@ -541,11 +711,20 @@ class FloatField(Field):
                 params={'value': value},
             )
 
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                return value
+        return value
+
 
 class PositiveFloatField(FloatField):
     default_error_messages = {
         'invalid_float': _('“%(value)s” value must be Positive.')
     }
+    python_type = None
 
     def to_python(self, value):
         value = super().to_python(value)
@@ -564,6 +743,7 @@ class IntegerField(Field):
         'invalid': _('“%(value)s” value must be an integer.'),
     }
     description = _("Integer")
+    python_type = int
 
     def check(self, **kwargs):
         return [
@@ -605,11 +785,20 @@ class IntegerField(Field):
                 params={'value': value},
             )
 
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            try:
+                return int(value)
+            except ValueError:
+                return value
+        return value
+
 
 class PositiveIntegerField(IntegerField):
     default_error_messages = {
         'invalid_integer': _('“%(value)s” value must be Positive.')
     }
+    python_type = None
 
     def to_python(self, value):
         value = super().to_python(value)
@@ -886,9 +1075,11 @@ class UUIDField(Field):
 
 
 class JSONField(Field):
+    default_error_messages = {
+        'invalid': _('“%(value)s” value must be Json format.'),
+    }
 
     def to_python(self, value):
-        self.error_messages.update({'invalid': _('“%(value)s” value must be Json format.')})
         try:
             return json.loads(value)
         except:
@@ -904,10 +1095,15 @@ class ArrayField(Field):
         'invalid': _('“%(value)s” is not a valid array.'),
     }
 
-    def __init__(self, to: Field = None, default=list()):
-        super(ArrayField, self).__init__(default=default)
+    def __init__(self, to: Field = None, default=list(), db_field=None):
+        super(ArrayField, self).__init__(default=default, db_field=db_field)
         self.to = to
 
+    def _compile(self):
+        super(ArrayField, self)._compile()
+        if isinstance(self.to, Field):
+            self.to._compile()
+
     def clean(self, value):
         try:
             if isinstance(self.to, Field):
@@ -923,6 +1119,294 @@ class ArrayField(Field):
                                              params={"value": value})
 
 
+class BinaryField(Field):
+    """
+    Base class for fields whose values are stored in an encoded form as BSON
+    Binary (of the field's `binary_subtype`). Values loaded from the database
+    are kept encoded until the attribute is first read, they're then decoded
+    by `from_db_value()` (once). `get_prep_value()` returns the encoded form.
+    """
+
+    # The (user defined) Binary subtype the encoded values are stored with
+    binary_subtype = 0x80
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            value = instance.__dict__[self.name]
+        except KeyError:
+            return super(BinaryField, self).__get__(instance, owner)
+
+        if self.is_db_value(value):
+            value = self.from_db_value(value)
+            instance.__dict__[self.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+    def is_db_value(self, value):
+        """Return True if the value is in the field's encoded (stored) form"""
+        return isinstance(value, Binary) and value.subtype == self.binary_subtype
+
+    def from_db_value(self, value):
+        """Return the value for an encoded value loaded from the database"""
+        raise NotImplementedError()
+
+    def to_db_value(self, value):
+        """Return the encoded form of a (clean) value"""
+        raise NotImplementedError()
+
+    def to_python(self, value):
+        if self.is_db_value(value):
+            return self.from_db_value(value)
+        return super(BinaryField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        if value is None or self.is_db_value(value):
+            return value
+        try:
+            return self.to_db_value(self.to_python(value))
+        except exceptions.ValidationError:
+            return value
+
+    def run_validators(self, value):
+        # Values aren't tested against the empty values, they may not support
+        # comparisons (e.g. arrays).
+        errors = []
+        for v in self.validators:
+            try:
+                v(value)
+            except exceptions.ValidationError as e:
+                if hasattr(e, 'code') and e.code in self.error_messages:
+                    e.message = self.error_messages[e.code]
+                errors.extend(e.error_list)
+
+        if errors:
+            raise exceptions.ValidationError(errors)
+
+    def clean(self, value):
+        value = self.to_python(value)
+        if value is None:
+            if not self.null:
+                raise exceptions.ValidationError(self.error_messages['null'], code='null')
+            return value
+        self.run_validators(value)
+        return value
+
+
+class PackedArrayField(BinaryField):
+    """
+    A numeric array stored packed (as the little-endian bytes of its values)
+    in a single BSON Binary rather than an array of BSON values. Values are
+    exposed as read-only NumPy arrays built on the loaded bytes (no copy and no
+    object per element), or read-only memoryviews if NumPy isn't installed.
+
+    `shape` is the shape values must have (1-D of any length by default),
+    `None` may be used for a single dimension of any length, e.g. `(None, 3)`.
+    """
+
+    binary_subtype = 0x80
+
+    default_error_messages = {
+        'invalid': _('“%(value)s” is not a valid %(dtype)s array.'),
+        'invalid_shape': _('Array of shape %(shape)s must be of shape %(expected)s.'),
+    }
+
+    # The `array`/`memoryview` format for each supported dtype
+    formats = {
+        'int8': 'b', 'uint8': 'B',
+        'int16': 'h', 'uint16': 'H',
+        'int32': 'i', 'uint32': 'I',
+        'int64': 'q', 'uint64': 'Q',
+        'float32': 'f', 'float64': 'd',
+    }
+
+    def __init__(self, dtype='float64', shape=None, null=False, default=NOT_PROVIDED, validators=(),
+                 error_messages=None, db_field=None):
+        super(PackedArrayField, self).__init__(
+            null=null,
+            default=default,
+            validators=validators,
+            error_messages=error_messages,
+            db_field=db_field
+        )
+        dtype = numpy.dtype(dtype).name if numpy is not None else dtype
+        assert dtype in self.formats, 'Unsupported dtype `{0}`'.format(dtype)
+        assert shape is None or list(shape).count(None) <= 1, 'Only one dimension may be of any length'
+        self.dtype = dtype
+        self.format = self.formats[dtype]
+        self.shape = tuple(shape) if shape is not None else (None,)
+
+    def from_db_value(self, value):
+        if numpy is not None:
+            array_ = numpy.frombuffer(value, dtype=numpy.dtype(self.dtype).newbyteorder('<'))
+            return array_.reshape(self._reshape(array_.size))
+
+        if sys.byteorder != 'little':
+            values = array(self.format, value)
+            values.byteswap()
+            value = values.tobytes()
+        view = memoryview(value).cast('B')
+        return view.cast(self.format, self._reshape(len(view) // struct.calcsize(self.format)))
+
+    def to_db_value(self, value):
+        # Views of the whole of a loaded value are written back without a copy
+        base = value
+        while base is not None and not self.is_db_value(base):
+            base = getattr(base, 'obj' if isinstance(base, memoryview) else 'base', None)
+        contiguous = value.c_contiguous if isinstance(value, memoryview) else value.flags.c_contiguous
+        if base is not None and contiguous and value.nbytes == len(base):
+            return base
+
+        if numpy is not None:
+            data = numpy.ascontiguousarray(value, dtype=numpy.dtype(self.dtype).newbyteorder('<')).tobytes()
+        else:
+            data = value.tobytes()
+            if sys.byteorder != 'little':
+                values = array(self.format, data)
+                values.byteswap()
+                data = values.tobytes()
+        return Binary(data, self.binary_subtype)
+
+    def to_python(self, value):
+        if value is None:
+            return value
+        if self.is_db_value(value):
+            return self.from_db_value(value)
+        if numpy is not None:
+            value = self._to_numpy(value)
+        else:
+            value = self._to_memoryview(value)
+        self._check_shape(value.shape)
+        return value
+
+    def _invalid(self, value):
+        return exceptions.ValidationError(
+            self.error_messages['invalid'],
+            code='invalid',
+            params={'value': value, 'dtype': self.dtype}
+        )
+
+    def _to_numpy(self, value):
+        """Return a read-only NumPy array of the field's dtype for a value"""
+        try:
+            source = numpy.asarray(value)
+        except (TypeError, ValueError):
+            raise self._invalid(value)
+        if source.dtype.kind not in 'biuf':
+            raise self._invalid(value)
+
+        dtype = numpy.dtype(self.dtype)
+        try:
+            converted = source.astype(dtype, copy=False)
+        except (TypeError, ValueError, OverflowError):
+            raise self._invalid(value)
+
+        # Values may lose precision to a float dtype but integer values must
+        # be held exactly
+        if dtype.kind != 'f' and converted is not source and not numpy.array_equal(converted, source):
+            raise self._invalid(value)
+
+        # A view, to not make the given array read-only
+        converted = converted.view()
+        converted.flags.writeable = False
+        return converted
+
+    def _to_memoryview(self, value):
+        """Return a read-only memoryview of the field's format for a value"""
+        if isinstance(value, memoryview):
+            if value.format == self.format and value.c_contiguous:
+                return value.toreadonly()
+            value = value.tolist()
+        try:
+            values = array(self.format, value)
+        except (TypeError, ValueError, OverflowError):
+            raise self._invalid(value)
+        return memoryview(values.tobytes()).cast(self.format)
+
+    def _reshape(self, size):
+        """Return the shape for an array of `size` values"""
+        if self.shape == (None,):
+            return [size]
+        known = 1
+        for dimension in self.shape:
+            known *= dimension or 1
+        return [size // known if dimension is None else dimension for dimension in self.shape]
+
+    def _check_shape(self, shape):
+        if len(shape) == len(self.shape) and all(e is None or e == s for s, e in zip(shape, self.shape)):
+            return
+        raise exceptions.ValidationError(
+            self.error_messages['invalid_shape'],
+            code='invalid_shape',
+            params={'shape': tuple(shape), 'expected': self.shape}
+        )
+
+
+class CompressedField(BinaryField):
+    """
+    Base class for fields whose values are compressed (with the `algorithm`,
+    'zlib' or 'lzma') once their encoded form reaches `threshold` bytes,
+    smaller values are stored as they are. Compressed values are only
+    decompressed when the attribute is first read.
+    """
+
+    binary_subtype = 0x81
+
+    def __init__(self, *args, threshold=1024, algorithm='zlib', **kwargs):
+        super(CompressedField, self).__init__(*args, **kwargs)
+        assert algorithm in compression.ALGORITHMS, 'Unsupported algorithm `{0}`'.format(algorithm)
+        self.threshold = threshold
+        self.algorithm = algorithm
+
+    def encode(self, value):
+        """Return the bytes to compress for a value"""
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """Return the value for decompressed bytes"""
+        raise NotImplementedError()
+
+    def from_db_value(self, value):
+        return self.decode(compression.decompress(value))
+
+    def to_db_value(self, value):
+        data = self.encode(value)
+        if len(data) < self.threshold:
+            return value
+        return Binary(compression.compress(data, self.algorithm), self.binary_subtype)
+
+
+class CompressedTextField(CompressedField, TextField):
+    """A `TextField` compressed above a size threshold"""
+
+    def encode(self, value):
+        return value.encode('utf-8')
+
+    def decode(self, data):
+        return data.decode('utf-8')
+
+
+class CompressedJSONField(CompressedField, JSONField):
+    """
+    A `JSONField` compressed above a size threshold, values may be given as
+    JSON or as the objects.
+    """
+
+    def to_python(self, value):
+        if isinstance(value, (str, bytes)):
+            return super(CompressedJSONField, self).to_python(value)
+        return value
+
+    def encode(self, value):
+        return json.dumps(value, cls=DjangoJSONEncoder).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
 # ---------------------------------------------------------------------------------------------------
 
 # ------------------------foreignkey and foreign frame need to be modify.... ------------------------
@@ -954,11 +1438,16 @@ class ForeignKey(Field):
                 params={"value": value}
             )
 
+    def get_prep_value(self, value):
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        return getattr(value, '_id', value)
+
 
 class EmbeddedField(Field):
-    def __init__(self, to, default=None, null=True):
+    def __init__(self, to, default=None, null=True, db_field=None):
         self.null = null
-        super(EmbeddedField, self).__init__(default=default, null=null)
+        super(EmbeddedField, self).__init__(default=default, null=null, db_field=db_field)
         self.to = to
 
     def to_python(self, value):
@@ -974,6 +1463,100 @@ class EmbeddedField(Field):
         return value
 
 
+@lru_cache(maxsize=32)
+def _cipher(key):
+    """Return the cipher for a key, expanding a key schedule is costly"""
+    return AES(key)
+
+
+class EncryptedField(BinaryField, TextField):
+    """
+    A text field encrypted at rest with AES (CBC mode), the value is stored as
+    the IV followed by the ciphertext. Values are only decrypted when the
+    attribute is first read, or for a whole column of frames at once with
+    `decrypt_many()` (see `Frame.decrypt_fields`).
+
+    The key (16, 24 or 32 bytes) defaults to the `AES_KEY` environment
+    variable. Encrypted values use a random IV so they can't be queried, filters
+    comparing the field with a value raise a `ValueError`.
+    """
+
+    binary_subtype = 0x82
+
+    def __init__(self, *args, key=None, null=True, **kwargs):
+        super(EncryptedField, self).__init__(*args, null=null, **kwargs)
+        self.key = key
+
+    def get_key(self):
+        """Return the key"""
+        key = self.key if self.key is not None else os.getenv('AES_KEY')
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return key
+
+    def from_db_value(self, value):
+        return self.decrypt_values(self.get_key(), [value])[0]
+
+    def to_db_value(self, value):
+        iv = os.urandom(16)
+        ciphertext = _cipher(self.get_key()).encrypt_cbc(value.encode('utf-8'), iv)
+        return Binary(iv + ciphertext, self.binary_subtype)
+
+    def decrypt_many(self, values):
+        """Return the decrypted values for a list of encrypted values"""
+        return self.decrypt_values(self.get_key(), values)
+
+    @staticmethod
+    def decrypt_values(key, values):
+        """
+        Return the decrypted values for a list of values encrypted with a key
+        (a plain function so it can be run by a process pool).
+        """
+        cipher = _cipher(key)
+        decrypted = []
+        for value in values:
+            try:
+                decrypted.append(cipher.decrypt_cbc(value[16:], value[:16]).decode('utf-8'))
+            except (AssertionError, IndexError, UnicodeDecodeError):
+                raise ValueError('Value could not be decrypted, the key may be wrong')
+        return decrypted
+
+
+class FileField(Field):
+    """
+    A file stored in GridFS (in the field's `bucket`), the field holds the
+    file's Id. Files are uploaded with `Frame.upload()`, read with
+    `Frame.download()` and deleted with the frame.
+    """
+
+    default_error_messages = {
+        'invalid': _('“%(value)s” value must be a valid file Id.'),
+        'too_large': _('File must be at most %(max_size)s bytes.'),
+    }
+
+    def __init__(self, bucket='fs', max_size=None, chunk_size=255 * 1024, null=True, **kwargs):
+        super(FileField, self).__init__(null=null, **kwargs)
+        self.bucket = bucket
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    def to_python(self, value):
+        if value is None or isinstance(value, ObjectId):
+            return value
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        raise exceptions.ValidationError(
+            self.error_messages['invalid'],
+            code='invalid',
+            params={'value': value}
+        )
+
+    def get_prep_value(self, value):
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        return value
+
+
 class ObjectIdField(Field):
     def __init__(self, *args, **kwargs):
         super(ObjectIdField, self).__init__(max_length=24, *args, **kwargs)
@@ -992,6 +1575,16 @@ class ObjectIdField(Field):
             return value
         return ObjectId()
 
+    def compile_clean(self):
+        clean = self.clean
+
+        def clean_object_id(value):
+            if type(value) is ObjectId:
+                return value
+            return clean(value)
+
+        return clean_object_id
+
     def clean(self, value):
         if value is not None:
             if len(str(value)) != 24:
@@ -1002,6 +1595,11 @@ class ObjectIdField(Field):
         value = self.to_python(value)
         return value
 
+    def get_prep_value(self, value):
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        return value
+
 
 class ForeignFrame:
     def __init__(self, redis=False, frame=None, queue=False, on_delete=False):
@@ -1,3 +1,11 @@
 from base.db.frames_motor.frames import *
 from base.db.frames_motor import *
-from base.db.frames.queries import *
+from base.db.frames_motor.concerns import *
+from base.db.frames_motor.cursors import *
+from base.db.frames_motor.hedging import *
+from base.db.frames_motor.limiter import *
+from base.db.frames_motor.queries import *
+from base.db.frames_motor.queryset import *
+from base.db.frames_motor.routing import *
+from base.db.frames_motor.scopes import *
+from base.db.frames_motor.updates import *
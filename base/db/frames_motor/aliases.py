@@ -0,0 +1,404 @@
+"""
+Translation between the names of fields and the names they're stored under.
+
+A field declared with `db_field` (e.g. `IntegerField(db_field='n')`) is stored
+under that (short) name while Python code keeps using the field's name. The
+translation is compiled once per frame class (`Aliases`) and applied to the
+documents, filters, projections, sorts, updates and pipelines sent to the
+database, and to the documents read back.
+
+Documents stored before a field was aliased can be migrated with
+`migrate_aliases()`.
+"""
+
+from base.db.fields import ArrayField, BinaryField, EmbeddedField, Field, JSONField
+from base.db.frames_motor.normalization import LOGICAL_OPERATORS
+from base.db.frames_motor.paths import is_operators, is_positional, sub_fields
+
+__all__ = (
+    'Aliases',
+    'migrate_aliases'
+    )
+
+# Pipeline stages that don't change the shape of documents, or add to it, the
+# paths of stages after them still refer to the frame's fields
+_SHAPE_KEEPING_STAGES = frozenset([
+    '$match', '$sort', '$skip', '$limit', '$sample', '$project', '$set', '$addFields', '$unset',
+    '$unwind', '$lookup'
+])
+
+# Update operators whose values are written to the document, embedded
+# documents among the values are translated
+_VALUE_OPERATORS = frozenset(['$set', '$setOnInsert', '$push', '$addToSet'])
+
+
+class Aliases(object):
+    """
+    The translation of paths between the names of the fields of a frame class
+    (a dictionary of name to `Field`) and the names they're stored under.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+        # Field name to stored name (and the reverse) for aliased fields
+        self.to_db = {}
+        for name, field in fields.items():
+            if field.db_field and field.db_field != name:
+                self.to_db[name] = field.db_field
+        self.to_python = {v: k for k, v in self.to_db.items()}
+
+        # Stored documents are read by name or stored name (see `set_items`)
+        # so a stored name can't be the name of another field
+        stored = [self.to_db.get(name, name) for name in fields]
+        assert len(set(stored)) == len(stored) and not set(self.to_python).intersection(fields), \
+            'Fields must be stored under unique names ({0})'.format(', '.join(stored))
+
+        # The fields stored encoded as Binary (or arrays of them) by name, and
+        # the field decoding their values when transcoded to JSON
+        self.binary = {}
+        for name, field in fields.items():
+            if isinstance(field, ArrayField):
+                field = field.to
+            if isinstance(field, BinaryField):
+                self.binary[name] = field
+
+        # The translation for the documents embedded in each field (and those
+        # holding binary fields)
+        self.embedded = {}
+        self._json_embedded = {}
+        for name, field in fields.items():
+            embedded_fields = sub_fields(field)
+            if embedded_fields is not None:
+                aliases = Aliases(embedded_fields)
+                if aliases.active:
+                    self.embedded[name] = aliases
+                if aliases.active or aliases.binary or aliases._json_embedded:
+                    self._json_embedded[name] = aliases
+
+        # Flag indicating if anything has to be translated
+        self.active = bool(self.to_db or self.embedded)
+
+        # Translated paths, and whether stored paths hold a single value
+        self._paths = {}
+        self._scalars = {}
+
+    def path(self, path):
+        """Return the stored path for a (dot separated) path"""
+        if not self.active:
+            return path
+        try:
+            return self._paths[path]
+        except KeyError:
+            pass
+
+        parts = path.split('.')
+        aliases = self
+        translated = []
+        for part in parts:
+            # Array indexes and positional operators are kept as they are
+            if aliases is None or is_positional(part):
+                translated.append(part)
+                continue
+            translated.append(aliases.to_db.get(part, part))
+            aliases = aliases.embedded.get(part)
+
+        self._paths[path] = translated = '.'.join(translated)
+        return translated
+
+    def is_scalar(self, path):
+        """
+        Return True if a stored (dot separated) path resolves to a field
+        holding a single value, with no array (or JSON) field along the path.
+        """
+        try:
+            return self._scalars[path]
+        except KeyError:
+            pass
+
+        scalar = True
+        fields = self.fields
+        aliases = self
+        for part in path.split('.'):
+            field = None
+            if fields is not None:
+                name = aliases.to_python.get(part, part) if aliases is not None else part
+                field = fields.get(name)
+            if not isinstance(field, Field) or isinstance(field, (ArrayField, JSONField)):
+                scalar = False
+                break
+            fields = sub_fields(field)
+            aliases = aliases.embedded.get(name) if aliases is not None else None
+
+        self._scalars[path] = scalar
+        return scalar
+
+    def filter(self, filter):
+        """Return a pymongo filter with its paths translated"""
+        if not self.active or not isinstance(filter, dict):
+            return filter
+
+        translated = {}
+        for key, value in filter.items():
+            if key in LOGICAL_OPERATORS and isinstance(value, (list, tuple)):
+                value = [self.filter(f) for f in value]
+            elif key == '$expr':
+                value = self.expression(value)
+            elif not key.startswith('$'):
+                value = self._condition(key, value)
+                key = self.path(key)
+            translated[key] = value
+        return translated
+
+    def projection(self, projection):
+        """Return a projection (a dictionary or list of paths) translated"""
+        if not self.active or not projection:
+            return projection
+        if isinstance(projection, dict):
+            return {self.path(k): v for k, v in projection.items()}
+        return [self.path(p) for p in projection]
+
+    def sort(self, sort):
+        """Return a sort (a path or list of `(path, direction)`) translated"""
+        if not self.active or not sort:
+            return sort
+        if isinstance(sort, str):
+            return self.path(sort)
+        return [(self.path(p), d) if isinstance(p, str) else (p, d) for p, d in sort]
+
+    def update(self, update):
+        """Return an update document (or pipeline) translated"""
+        if not self.active or not update:
+            return update
+        if isinstance(update, (list, tuple)):
+            return self.pipeline(update)
+
+        translated = {}
+        for operator, operands in update.items():
+            if not isinstance(operands, dict):
+                translated[operator] = operands
+                continue
+            if operator == '$rename':
+                operands = {self.path(k): self.path(v) for k, v in operands.items()}
+            elif operator == '$pull':
+                operands = {self.path(k): self._pull(k, v) for k, v in operands.items()}
+            elif operator in _VALUE_OPERATORS:
+                operands = {self.path(k): self._value(k, v) for k, v in operands.items()}
+            else:
+                operands = {self.path(k): v for k, v in operands.items()}
+            translated[operator] = operands
+        return translated
+
+    def pipeline(self, pipeline):
+        """
+        Return an aggregation pipeline (or pipeline update) with the stages
+        that see documents shaped as the frame translated, translation stops
+        at the first stage reshaping the documents (e.g. `$group`).
+        """
+        if not self.active:
+            return pipeline
+
+        translated = list(pipeline)
+        for index, stage in enumerate(translated):
+            if not isinstance(stage, dict) or len(stage) != 1:
+                break
+            (name, value), = stage.items()
+
+            if name == '$match':
+                value = self.filter(value)
+            elif name == '$sort':
+                value = {self.path(k): v for k, v in value.items()}
+            elif name in ('$project', '$set', '$addFields'):
+                value = {self.path(k): self.expression(v) for k, v in value.items()}
+            elif name == '$unset':
+                value = self.path(value) if isinstance(value, str) else [self.path(p) for p in value]
+            elif name == '$unwind':
+                value = self.expression(value)
+            elif name == '$lookup' and 'localField' in value:
+                value = {**value, 'localField': self.path(value['localField'])}
+            elif name == '$group':
+                translated[index] = {name: {k: self.expression(v) for k, v in value.items()}}
+                break
+
+            translated[index] = {name: value}
+            if name not in _SHAPE_KEEPING_STAGES:
+                break
+        return translated
+
+    def expression(self, value):
+        """Return an aggregation expression with its field paths translated"""
+        if isinstance(value, str):
+            if value.startswith('$') and not value.startswith('$$'):
+                return '$' + self.path(value[1:])
+            return value
+        if isinstance(value, list):
+            return [self.expression(v) for v in value]
+        if isinstance(value, dict):
+            return {
+                k: v if k == '$literal' else self.expression(v)
+                for k, v in value.items()
+            }
+        return value
+
+    def to_python_document(self, document):
+        """Return a stored document with its keys translated to field names"""
+        if not self.active or not isinstance(document, dict):
+            return document
+
+        translated = {}
+        for key, value in document.items():
+            key = self.to_python.get(key, key)
+            aliases = self.embedded.get(key)
+            if aliases is not None:
+                if isinstance(value, list):
+                    value = [aliases.to_python_document(v) for v in value]
+                else:
+                    value = aliases.to_python_document(value)
+            translated[key] = value
+        return translated
+
+    def to_db_document(self, document):
+        """Return a document with its keys translated to the stored names"""
+        if not self.active or not isinstance(document, dict):
+            return document
+
+        translated = {}
+        for key, value in document.items():
+            aliases = self.embedded.get(key)
+            if aliases is not None:
+                if isinstance(value, list):
+                    value = [aliases.to_db_document(v) for v in value]
+                else:
+                    value = aliases.to_db_document(value)
+            translated[self.to_db.get(key, key)] = value
+        return translated
+
+    def json_names(self):
+        """
+        Return the names to write the keys of stored documents under in JSON, a
+        dictionary of stored name to `(name, names for the embedded document,
+        binary field)`, the values of binary fields (and the elements of arrays
+        of them) are decoded by the field.
+        """
+        if not (self.active or self.binary or self._json_embedded):
+            return None
+        names = {}
+        for name in self.fields:
+            aliases = self._json_embedded.get(name)
+            names[self.to_db.get(name, name)] = (
+                name,
+                aliases.json_names() if aliases else None,
+                self.binary.get(name)
+            )
+        return names
+
+    def renames(self, parent=''):
+        """
+        Return the list of `(depth, path, renamed path)` renames migrating the
+        keys of the aliased fields, the parents of both paths are named as the
+        fields (nested keys are renamed before their parents). Documents
+        embedded in arrays aren't included.
+        """
+        renames = []
+        for name, field in self.fields.items():
+            stored = self.to_db.get(name, name)
+            if name != stored:
+                renames.append((parent.count('.'), parent + name, parent + stored))
+            aliases = self.embedded.get(name)
+            if aliases is not None and isinstance(field, EmbeddedField):
+                renames.extend(aliases.renames(parent + name + '.'))
+        return renames
+
+    # Private methods
+
+    def _condition(self, path, condition):
+        """Translate the paths of the documents matched by `$elemMatch`"""
+        if not isinstance(condition, dict) or '$elemMatch' not in condition:
+            return condition
+
+        aliases = self._embedded(path)
+        operand = condition['$elemMatch']
+        if aliases is None or not isinstance(operand, dict) or is_operators(operand):
+            return condition
+        return {**condition, '$elemMatch': aliases.filter(operand)}
+
+    def _pull(self, path, condition):
+        """Translate a `$pull` condition (matching the array's elements)"""
+        aliases = self._embedded(path)
+        if aliases is None or not isinstance(condition, dict) or is_operators(condition):
+            return condition
+        return aliases.filter(condition)
+
+    def _value(self, path, value):
+        """
+        Translate a value written to a path, the documents embedded at the path
+        (or their list, or the `$each` list of `$push` and `$addToSet`).
+        """
+        aliases = self._embedded(path)
+        if aliases is None:
+            return value
+        if is_operators(value):
+            value = dict(value)
+            if isinstance(value.get('$each'), list):
+                value['$each'] = [aliases.to_db_document(v) for v in value['$each']]
+            if isinstance(value.get('$sort'), dict):
+                value['$sort'] = {aliases.path(k): v for k, v in value['$sort'].items()}
+            return value
+        if isinstance(value, list):
+            return [aliases.to_db_document(v) for v in value]
+        return aliases.to_db_document(value)
+
+    def _embedded(self, path):
+        """Return the translation for the documents embedded at a path"""
+        aliases = self
+        for part in path.split('.'):
+            if is_positional(part):
+                continue
+            aliases = aliases.embedded.get(part)
+            if aliases is None:
+                return None
+        return aliases
+
+
+async def migrate_aliases(frame_cls, batch_size=1000, reverse=False):
+    """
+    Rename the keys of the documents of a frame class stored under the fields'
+    names to the names they're now stored under (`db_field`), or back if
+    `reverse` is True. Documents are renamed in batches of `batch_size`, return
+    the number of documents renamed.
+
+    Keys are renamed with `$rename`, which can't reach documents embedded in
+    arrays, those must be migrated by rewriting the documents.
+    """
+    aliases = frame_cls._aliases
+    renames = aliases.renames()
+    if not renames:
+        return 0
+
+    # Nested keys are renamed within their parents while those are named as
+    # the fields, so renames are applied from the deepest keys and reversed
+    # from the shallowest.
+    stages = []
+    for depth in sorted({r[0] for r in renames}, reverse=not reverse):
+        stages.append({
+            (stored if reverse else path): (path if reverse else stored)
+            for rename_depth, path, stored in renames
+            if rename_depth == depth
+        })
+
+    # The documents with keys left to rename
+    collection = frame_cls.get_collection()
+    pending = {'$or': [
+        {aliases.path(path) if reverse else path: {'$exists': True}}
+        for _, path, _ in renames
+    ]}
+    migrated = 0
+    while True:
+        ids = [d['_id'] async for d in collection.find(pending, {'_id': 1}, limit=batch_size)]
+        if not ids:
+            break
+        for stage in stages:
+            await collection.update_many({'_id': {'$in': ids}}, {'$rename': stage})
+        migrated += len(ids)
+    return migrated
+
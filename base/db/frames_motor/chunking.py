@@ -0,0 +1,336 @@
+"""
+Support for splitting filters with huge `$in` lists into chunks.
+
+A filter such as `{'_id': {'$in': ids}}` with 100k+ ids makes for an oversized
+command and a single slow query. Instead the list is split into chunks, a query
+is run for each chunk (a bounded number at once) and the results are merged.
+
+Only top-level `$in` conditions are split, a `$nin` list can't be (the chunks
+would have to be intersected rather than merged). Only `$in` conditions on
+paths holding a single value are split, a document with an array of values
+would match several chunks (be returned or counted more than once, and have
+an update applied more than once).
+
+Sorted chunks are merged in the order MongoDB sorts values of different BSON
+types, strings are compared by code point so sorts with a collation can't be
+merged.
+"""
+
+import asyncio
+import re
+from collections.abc import Mapping
+from datetime import datetime
+
+from bson import Binary, Decimal128, MaxKey, MinKey, ObjectId, Regex, Timestamp
+from pymongo import DESCENDING
+
+from base.db.frames_motor.paths import get_path
+
+__all__ = (
+    'ChunkedCursor',
+    'ChunksFailed',
+    'find_in',
+    'gather_chunks',
+    'split_in'
+    )
+
+
+class ChunksFailed(Exception):
+    """
+    Raised by `gather_chunks` when awaiting a chunk raises (the error is the
+    cause), once the chunks still running are cancelled. `results` holds the
+    result of each chunk that completed by its index, and `count` the sum of
+    their counts if a count was requested.
+    """
+
+    def __init__(self, total, results, count=None):
+        self.total = total
+        self.results = results
+        self.count = count
+        message = '{0} of {1} chunks completed before a chunk failed'.format(len(results), total)
+        if count is not None:
+            message += ', with a count of {0}'.format(count)
+        super().__init__(message)
+
+
+class ChunkedCursor(object):
+    """
+    A cursor over the documents matching a list of (chunk) filters. The chunks
+    are queried concurrently, at most `parallelism` at once, and their results
+    merged into the requested sort order, or into the order of the values in
+    `order` (a `(path, values)` tuple). The merge reads the sort (or order)
+    keys off the documents, an `AssertionError` is raised if the projection
+    leaves them out or the sort has a collation (which can't be merged).
+
+    Unlike a motor cursor the whole result is loaded on the first read.
+    """
+
+    def __init__(
+            self,
+            collection,
+            filters,
+            projection=None,
+            parallelism=4,
+            order=None,
+            sort=None,
+            skip=0,
+            limit=0,
+            **kwargs
+    ):
+        assert not (sort and kwargs.get('collation') and len(filters) > 1), \
+            'A sort with a collation can\'t be merged across the chunks of a huge `$in` list'
+        merged = [path for path, _ in sort or []] if len(filters) > 1 else []
+        if order is not None:
+            merged.append(order[0])
+        for path in merged:
+            assert _projects(projection, path), \
+                'The projection must return `{0}` to merge the chunks of a huge `$in` list'.format(path)
+
+        self._collection = collection
+        self._filters = filters
+        self._projection = projection
+        self._parallelism = parallelism
+        self._order = order
+        self._sort = sort
+        self._skip = skip
+        self._limit = limit
+        self._kwargs = kwargs
+
+        # The merged documents left to read (None until they are loaded)
+        self._documents = None
+
+        # Flag indicating if there may be documents left to read
+        self.alive = True
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def to_list(self, length=None):
+        """Return up to `length` (all if None) of the documents left to read"""
+        if self._documents is None:
+            self._documents = await self._fetch()
+
+        if length is None:
+            length = len(self._documents)
+        documents = self._documents[:length]
+        self._documents = self._documents[length:]
+        if not self._documents:
+            self.alive = False
+        return documents
+
+    def close(self):
+        self._documents = []
+        self.alive = False
+
+    # Private methods
+
+    async def _iterate(self):
+        for document in await self.to_list():
+            yield document
+
+    async def _fetch(self):
+        # Each chunk must return enough documents to fill the page once the
+        # skip is applied to the merged results.
+        limit = self._skip + self._limit if self._limit else 0
+
+        async def find(filter):
+            cursor = self._collection.find(
+                filter,
+                self._projection,
+                sort=self._sort,
+                limit=limit,
+                **self._kwargs
+            )
+            return await cursor.to_list(length=None)
+
+        results = await gather_chunks(self._filters, find, self._parallelism)
+        documents = [d for documents in results for d in documents]
+
+        if self._order is not None:
+            path, values = self._order
+            positions = {v: i for i, v in enumerate(values)}
+            documents.sort(key=lambda d: _position(positions, get_path(d, path)))
+
+        elif self._sort and len(results) > 1:
+            # Sorts are stable so sorting by each key in reverse order gives
+            # the documents sorted by all the keys.
+            for path, direction in reversed(self._sort):
+                reverse = direction == DESCENDING
+                documents.sort(
+                    key=lambda d: _sort_key(get_path(d, path), reverse),
+                    reverse=reverse
+                )
+
+        end = self._skip + self._limit if self._limit else None
+        return documents[self._skip:end]
+
+
+# Functions
+
+def find_in(filter, is_scalar=None):
+    """
+    Return the path and values of the longest top-level `$in` condition in a
+    pymongo filter, or None if there isn't one. If `is_scalar` is given only
+    the paths it returns True for (those holding a single value) are looked
+    at.
+    """
+    found = None
+    if not isinstance(filter, dict):
+        return found
+
+    for path, condition in filter.items():
+        if path.startswith('$') or not isinstance(condition, dict):
+            continue
+        if is_scalar is not None and not is_scalar(path):
+            continue
+        values = condition.get('$in')
+        if isinstance(values, (list, tuple)) and (found is None or len(values) > len(found[1])):
+            found = (path, values)
+    return found
+
+
+def split_in(filter, chunk_size, is_scalar=None):
+    """
+    Return a list of filters each matching a chunk (of at most `chunk_size`
+    values) of the longest top-level `$in` list in a pymongo filter, or None
+    if the filter doesn't need to be split. `is_scalar` returns True for the
+    paths holding a single value, only those are split.
+    """
+    found = find_in(filter, is_scalar)
+    if found is None or len(found[1]) <= chunk_size:
+        return None
+
+    path, values = found
+    try:
+        # Values repeated across chunks would match the same documents twice,
+        # values are equal if MongoDB compares them as equal (e.g. `1` and
+        # `1.0` but not `True`)
+        values = list({(_sort_key(v)[0], v): v for v in values}.values())
+    except TypeError:
+        # Unhashable values (e.g. embedded documents) can't be de-duplicated
+        return None
+
+    filters = []
+    for start in range(0, len(values), chunk_size):
+        chunk = dict(filter)
+        chunk[path] = dict(filter[path])
+        chunk[path]['$in'] = values[start:start + chunk_size]
+        filters.append(chunk)
+    return filters
+
+
+async def gather_chunks(chunks, func, parallelism, count=None):
+    """
+    Return the results of awaiting `func(chunk)` for each chunk, with at most
+    `parallelism` chunks awaited at once. If a chunk raises the others are
+    cancelled and `ChunksFailed` is raised, with the sum of `count(result)`
+    for the chunks that completed if `count` is given.
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+    results = {}
+
+    async def run(index, chunk):
+        async with semaphore:
+            results[index] = await func(chunk)
+
+    tasks = [asyncio.ensure_future(run(i, c)) for i, c in enumerate(chunks)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if not isinstance(e, Exception):
+            raise
+        total = None if count is None else sum(count(r) for r in results.values())
+        raise ChunksFailed(len(tasks), results, total) from e
+
+    return [results[i] for i in range(len(tasks))]
+
+
+# Private functions
+
+def _projects(projection, path):
+    """Return True if a (pymongo) projection returns the value at a path"""
+    if projection is None:
+        return True
+    if not isinstance(projection, Mapping):
+        projection = dict.fromkeys(projection, 1)
+
+    parts = path.split('.')
+    for end in range(1, len(parts) + 1):
+        prefix = '.'.join(parts[:end])
+        if prefix in projection:
+            return bool(projection[prefix])
+
+    # Unless excluded `_id` is returned, other paths are unless the
+    # projection includes fields
+    return parts[0] == '_id' or not any(v for k, v in projection.items() if k != '_id')
+
+
+def _position(positions, value):
+    """Return the position of a value in the requested order"""
+    try:
+        return positions.get(value, len(positions))
+    except TypeError:
+        return len(positions)
+
+
+def _sort_key(value, reverse=False):
+    """
+    Return the key sorting a value as MongoDB sorts it, by BSON type and then
+    by value. An array sorts by its lowest element (its highest if `reverse`),
+    an empty array before missing values.
+    """
+    if value is None:
+        return (1,)
+
+    # Booleans are integers in Python
+    elif isinstance(value, bool):
+        return (9, value)
+
+    elif isinstance(value, (int, float, Decimal128)):
+        if isinstance(value, Decimal128):
+            value = value.to_decimal()
+        # NaN sorts before the other numbers
+        if value != value:
+            return (2, 0)
+        return (2, 1, value)
+
+    elif isinstance(value, str):
+        return (3, value)
+
+    elif isinstance(value, Mapping):
+        return (4, tuple((_sort_key(v)[0], k, _sort_key(v)) for k, v in value.items()))
+
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            return (0,)
+        keys = [_sort_key(v) for v in value]
+        return max(keys) if reverse else min(keys)
+
+    elif isinstance(value, Binary):
+        return (6, len(value), value.subtype, bytes(value))
+
+    elif isinstance(value, bytes):
+        return (6, len(value), 0, value)
+
+    elif isinstance(value, ObjectId):
+        return (7, value.binary)
+
+    elif isinstance(value, datetime):
+        return (10, value)
+
+    elif isinstance(value, Timestamp):
+        return (11, value.time, value.inc)
+
+    elif isinstance(value, (Regex, re.Pattern)):
+        return (12, value.pattern, str(value.flags))
+
+    elif isinstance(value, MinKey):
+        return (-1,)
+
+    elif isinstance(value, MaxKey):
+        return (13,)
+
+    return (14, repr(value))
@@ -0,0 +1,41 @@
+"""
+Durability profiles, the named write concerns frames are written with, for
+example:
+
+    class AuditEntry(Frame):
+        _write_concern = 'fast'
+
+    await entry.insert(write_concern='majority')
+
+Profiles trade durability for write latency, writes that can be lost on a
+failover (telemetry, audit trails...) don't have to wait on the replica set.
+Projects may add their own profiles to `WRITE_CONCERNS`.
+"""
+
+from pymongo.write_concern import WriteConcern
+
+__all__ = (
+    'WRITE_CONCERNS',
+    'get_write_concern'
+    )
+
+WRITE_CONCERNS = {
+    # Acknowledged once journaled by a majority of the replica set, writes
+    # survive a failover
+    'majority': WriteConcern(w='majority', j=True),
+
+    # Acknowledged once journaled by the primary, writes survive a restart of
+    # the primary but may be rolled back on a failover
+    'journaled': WriteConcern(w=1, j=True),
+
+    # Acknowledged once applied in memory by the primary
+    'fast': WriteConcern(w=1, j=False)
+}
+
+
+def get_write_concern(profile):
+    """Return the write concern for a profile name or `WriteConcern`"""
+    if isinstance(profile, WriteConcern):
+        return profile
+    assert profile in WRITE_CONCERNS, 'Unknown write concern profile `{0}`'.format(profile)
+    return WRITE_CONCERNS[profile]
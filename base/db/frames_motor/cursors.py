@@ -0,0 +1,148 @@
+"""
+Support for keeping motor cursors open between requests (infinite scroll).
+"""
+
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+
+from base.rf.exceptions import InvalidScrollToken
+
+__all__ = (
+    # Exceptions
+    'InvalidScrollToken',
+
+    # Classes
+    'ScrollRegistry',
+
+    # Registry
+    'scroll_registry'
+    )
+
+
+class _ScrollEntry(object):
+    """
+    An open cursor held by the registry.
+    """
+
+    __slots__ = ('cursor', 'frame_cls', 'last_used', 'lock')
+
+    def __init__(self, cursor, frame_cls):
+        self.cursor = cursor
+        self.frame_cls = frame_cls
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+class ScrollRegistry(object):
+    """
+    An in-process registry of open cursors keyed by an opaque scroll token.
+
+    Cursors that have not been read for `idle_timeout` seconds are closed, and
+    once `max_open` cursors are held the least recently used one is closed to
+    make room for a new one. Cursors being read are never closed to make room.
+
+    Unknown or expired tokens, and tokens issued for another frame class, raise
+    `InvalidScrollToken` (a 400 response).
+    """
+
+    def __init__(self, idle_timeout=300, max_open=1000):
+
+        # The number of seconds a cursor may stay unread before it is closed
+        self.idle_timeout = idle_timeout
+
+        # The maximum number of cursors held open at the same time
+        self.max_open = max_open
+
+        # Open cursors ordered from least to most recently used
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, token):
+        return token in self._entries
+
+    # Public methods
+
+    def open(self, frame_cls, cursor):
+        """Register a cursor and return the scroll token issued for it"""
+        self._purge()
+        while len(self._entries) >= self.max_open:
+            evict = next((t for t, e in self._entries.items() if not e.lock.locked()), None)
+            if evict is None:
+                # Every cursor is being read, let the registry grow
+                break
+            self._close(self._entries.pop(evict))
+
+        token = secrets.token_urlsafe(24)
+        self._entries[token] = _ScrollEntry(cursor, frame_cls)
+        return token
+
+    async def take(self, frame_cls, token, length):
+        """
+        Read up to `length` documents from the cursor registered against
+        `token`. Return the documents and the token to use for the next read,
+        which is None once the cursor is exhausted.
+        """
+        self._purge()
+        entry = self._entries.get(token)
+        if entry is None or entry.frame_cls is not frame_cls:
+            raise InvalidScrollToken()
+
+        async with entry.lock:
+            # The cursor may have been evicted while we waited for the lock
+            if self._entries.get(token) is not entry:
+                raise InvalidScrollToken()
+
+            self._entries.move_to_end(token)
+            documents = await entry.cursor.to_list(length=length)
+            entry.last_used = time.monotonic()
+
+            if len(documents) < length or not entry.cursor.alive:
+                self.close(token)
+                return documents, None
+
+        return documents, token
+
+    def close(self, token):
+        """Close the cursor registered against `token` (if there is one)"""
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._close(entry)
+
+    def clear(self):
+        """Close every cursor held by the registry"""
+        while self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._close(entry)
+
+    # Private methods
+
+    def _purge(self):
+        """
+        Close cursors that have been idle for longer than the timeout (except
+        those being read).
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        for token, entry in self._entries.items():
+            if entry.last_used > deadline:
+                break
+            if not entry.lock.locked():
+                expired.append(token)
+        for token in expired:
+            self._close(self._entries.pop(token))
+
+    @staticmethod
+    def _close(entry):
+        # Closing a motor cursor returns a future, kill it in the background
+        # rather than making every caller await the server round-trip.
+        result = entry.cursor.close()
+        if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
+
+
+# The registry used by `Frame.scroll`
+scroll_registry = ScrollRegistry()
@@ -0,0 +1,118 @@
+"""
+Support for files stored in GridFS (see `FileField`).
+
+Files are streamed to and from GridFS a chunk at a time, uploads read from the
+source as chunks are written and downloads are async iterators of chunks (e.g.
+for a `StreamingHttpResponse`), so memory use doesn't grow with the size of a
+file.
+"""
+
+import asyncio
+import inspect
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+__all__ = (
+    'FileTooLarge',
+    'delete_files',
+    'get_bucket',
+    'iter_file',
+    'upload_file'
+    )
+
+
+class FileTooLarge(Exception):
+    """Raised when an upload exceeds the `max_size` of its field"""
+
+
+def get_bucket(db, field):
+    """Return the GridFS bucket (in the given database) for a file field"""
+    return AsyncIOMotorGridFSBucket(db, bucket_name=field.bucket, chunk_size_bytes=field.chunk_size)
+
+
+async def upload_file(bucket, field, source, filename, content_type=None, metadata=None):
+    """
+    Upload a file to a bucket from a source and return its Id. The source may
+    be bytes, an async iterable of bytes (e.g. an ASGI body), an object with a
+    `read(size)` method (e.g. a Django `Request` or `UploadedFile`, read in the
+    default executor unless `read` is a coroutine function) or an iterable of
+    bytes. The upload is aborted (the chunks written are removed) if the
+    source raises, the file exceeds the field's `max_size` or it can't be
+    closed.
+    """
+    metadata = dict(metadata or {})
+    if content_type:
+        metadata['content_type'] = content_type
+
+    grid_in = bucket.open_upload_stream(filename, metadata=metadata)
+    length = 0
+    try:
+        async for chunk in _read_chunks(source, field.chunk_size):
+            length += len(chunk)
+            if field.max_size is not None and length > field.max_size:
+                raise FileTooLarge(filename)
+            await grid_in.write(chunk)
+        await grid_in.close()
+    except BaseException:
+        await grid_in.abort()
+        raise
+
+    # The file only exists once closed
+    return grid_in._id
+
+
+async def iter_file(bucket, file_id):
+    """Return an async iterator over the chunks of a file"""
+    grid_out = await bucket.open_download_stream(file_id)
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
+
+
+async def delete_files(bucket, file_ids):
+    """Delete files from a bucket, files that don't exist are ignored"""
+    for file_id in file_ids:
+        try:
+            await bucket.delete(file_id)
+        except NoFile:
+            pass
+
+
+# Private functions
+
+async def _read_chunks(source, chunk_size):
+    """Yield the bytes of a source in chunks of at most `chunk_size` bytes"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+
+    elif hasattr(source, '__aiter__'):
+        async for chunk in source:
+            if chunk:
+                yield chunk
+
+    elif hasattr(source, 'read'):
+        # Reads from a file (or a request body) block, they're run in the
+        # default executor rather than on the event loop
+        if inspect.iscoroutinefunction(source.read):
+            read = source.read
+        else:
+            loop = asyncio.get_running_loop()
+
+            def read(size):
+                return loop.run_in_executor(None, source.read, size)
+
+        while True:
+            chunk = await read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
@@ -1,15 +1,34 @@
-import ast
+import asyncio
+import logging
+import time
+from collections import OrderedDict
 
 from django.core.exceptions import ValidationError
 from contextlib import contextmanager
 
 # from blinker import signal
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 from datetime import date, datetime, timezone
 
 from base.db.fields import ObjectIdField, ForeignFrame, NOT_PROVIDED, Field, ArrayField, EmbeddedField, ForeignKey, \
-    UTC_NOW, AUTO_NOW, DateField, DateTimeField
-from base.db.frames_motor.queries import to_refs, Condition, Group
+    UTC_NOW, AUTO_NOW, DateField, DateTimeField, BinaryField, EncryptedField, FileField, IntegerField
+from base.db.frames_motor.aliases import Aliases, migrate_aliases
+from base.db.frames_motor.chunking import ChunkedCursor, find_in, gather_chunks, split_in
+from base.db.frames_motor.cursors import scroll_registry
+from base.db.frames_motor.files import FileTooLarge, delete_files, get_bucket, iter_file, upload_file
+from base.db.frames_motor.hedging import LatencyTracker, hedged
+from base.db.frames_motor.limiter import LimitedCollection, get_limiter
+from base.db.frames_motor.normalization import normalize_filter
+from base.db.frames_motor.queries import requires_collation, to_filter, to_refs, Condition, Group
+from base.db.frames_motor.queryset import DeferredFieldError, QuerySet, load_deferred
+from base.db.frames_motor.routing import get_read_preference, record_read
+from base.db.frames_motor.scopes import SessionCollection, current_session, options_key, resolve_options, \
+    scope_options, scoped_options
+from base.db.frames_motor.transcode import bson_to_json, bsons_to_json
+from base.db.frames_motor.updates import compile_updates
+from base.db.frames_motor.validation import POOL_CHUNK_SIZE, compile_validator, validate_batch, \
+    validate_batch_in_pool
 
 __all__ = [
     'Frame',
@@ -20,15 +39,44 @@ __all__ = [
     'SET_DEFAULT'
 ]
 
-from base.rf.exceptions import FrameValidation
+from base.rf.exceptions import FrameValidation, VersionConflict
+
+# NumPy is optional (packed arrays are memoryviews without it)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 CASCADE = '_cascade'
 RESTRICT = '_restrict'
 SET_NULL = '_set_null'
 SET_DEFAULT = '_set_default'
 
+# The number of collection handles (by client, database and options) cached
+# for each frame class, the least recently used are dropped
+HANDLES_CACHE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+
+class _BaseFrameMeta(type):
+    """
+    Meta class for frames to collect the fields declared on the class into
+    `_fields`, the schema used to compile queries against the class, to
+    compile the translation of the fields' names to the names they're stored
+    under and to generate the function validating the fields.
+    """
+
+    def __new__(meta, name, bases, dct):
+        cls = super(_BaseFrameMeta, meta).__new__(meta, name, bases, dct)
+        cls._fields = {key: value for key, value in dct.items() if isinstance(value, Field)}
+        cls._file_fields = {key: value for key, value in cls._fields.items() if isinstance(value, FileField)}
+        cls._aliases = Aliases(cls._fields)
+        cls._validate_fields = staticmethod(compile_validator(cls._fields))
+        return cls
+
 
-class _BaseFrame:
+class _BaseFrame(metaclass=_BaseFrameMeta):
     """
     Base class for Frames and SubFrames.
     """
@@ -38,6 +86,9 @@ class _BaseFrame:
     _validators = list()
     _meta = {}
 
+    # The names of the fields that weren't loaded with a partial frame
+    _deferred = frozenset()
+
     def __init__(self, *args, **kwargs):
         self._update_field = set()
         self.errors = dict()
@@ -47,15 +98,7 @@ class _BaseFrame:
         for key, value in self.__class__.__dict__.items():
             if isinstance(value, Field):
                 self._meta[key] = value
-                if value.default == NOT_PROVIDED:
-                    value = None
-                elif value.default == UTC_NOW:
-                    value = datetime.utcnow()
-                elif value.default == AUTO_NOW:
-                    value = datetime.now()
-                else:
-                    value = value.default
-                self[key] = value
+                self[key] = self._field_default(value)
             elif isinstance(value, ForeignFrame):
                 self._child_frames[key] = value
         self._update_field.clear()
@@ -77,11 +120,39 @@ class _BaseFrame:
         super(_BaseFrame, self).__setattr__(key, value)
         if key in self._meta.keys():
             self._update_field.add(key)
+            if key in self._deferred:
+                # The (immutable) set may be shared by the frames loaded together
+                self._deferred = self._deferred.difference([key])
+
+    def _missing_field(self, field):
+        """Return the value for a field the frame holds no value for"""
+        if field.name in self._deferred:
+            raise DeferredFieldError(
+                '`{0}` was deferred when the {1} was loaded, await '
+                '`load_deferred()` before reading it'.format(
+                    field.name,
+                    self.__class__.__name__
+                )
+            )
+        return field
+
+    @staticmethod
+    def _field_default(field):
+        """Return the initial value for a field"""
+        if field.default == NOT_PROVIDED:
+            return None
+        elif field.default == UTC_NOW:
+            return datetime.utcnow()
+        elif field.default == AUTO_NOW:
+            return datetime.now()
+        return field.default
 
     def set_items(self, dictionary):
         if isinstance(dictionary, dict):
             dictionary = dictionary.items()
         for key, value in dictionary:
+            # Stored documents hold the stored names of aliased fields
+            key = self._aliases.to_python.get(key, key)
             if key in self._child_frames.keys():
                 if value:
                     pass
@@ -110,6 +181,8 @@ class _BaseFrame:
             ret_val = value._get_document()
         elif isinstance(cls, DateField) and not isinstance(cls, DateTimeField):
             ret_val = datetime(value.year, value.month, value.day)
+        elif isinstance(cls, BinaryField):
+            ret_val = cls.get_prep_value(value)
         else:
             ret_val = value
         return ret_val
@@ -118,37 +191,42 @@ class _BaseFrame:
         document = dict()
         valid_keys = self._update_field if self._update_field else self._meta.keys()
         for key in self._meta.keys():
-            if key in valid_keys:
-                if self[key]:
-                    document[key] = self._get_document_value(self._meta[key], self[key])
+            # Deferred fields were never loaded, writing them would overwrite
+            # the stored values.
+            if key in valid_keys and key not in self._deferred:
+                # Read without the field's descriptor so values still in their
+                # stored form aren't decoded only to be encoded again.
+                value = self.__dict__[key]
+                stored_key = self._aliases.to_db.get(key, key)
+                if value is not None:
+                    document[stored_key] = self._get_document_value(self._meta[key], value)
                 else:
-                    document[key] = self[key]
+                    document[stored_key] = value
         return document
 
     # Serializing
 
     def is_valid(self, raise_exceptions=True):
-        if not (getattr(self, '_id', None) and '_id' in self._meta.keys()):
+        # New documents are validated in full, for stored documents only the
+        # changed fields are validated (the loaded values are trusted).
+        if not (getattr(self, '_id', None) and '_id' in self._meta):
             validate_fields = self._meta.keys()
-        elif self._update_field:
-            validate_fields = self._update_field
         else:
-            validate_fields = self._meta.keys()
-        for key, value in self._meta.items():
-            if key in validate_fields:
-                try:
-                    cleaned = value.clean(self[key])
-                    self[key] = cleaned
-                except ValidationError as e:
-                    er = {key: e.messages[0]}
-                    self.errors.update(er)
-                except FrameValidation as e:
-                    er = {key: e.message}
-                    self.errors.update(er)
+            validate_fields = self._update_field
+        if self._deferred:
+            validate_fields = set(validate_fields).difference(self._deferred)
+
+        if validate_fields:
+            self._validate_fields(self.__dict__, validate_fields, self.errors)
+
+            # Cleaned values are written to the document
+            self._update_field.update(validate_fields)
 
         if self.errors and raise_exceptions:
             raise FrameValidation(self.errors)
         for item in self._validators:
+            if item[0] in self._deferred:
+                continue
             try:
                 item[1](getattr(self, item[0], None))
             except FrameValidation as e:
@@ -189,6 +267,8 @@ class _BaseFrame:
         temp.extend(self.additional)
         result = dict()
         for key in temp:
+            if key in self._deferred:
+                continue
             result.update({key: self._json_safe(self[key])})
         return result
 
@@ -207,6 +287,10 @@ class _BaseFrame:
         elif isinstance(value, ObjectId):
             return str(value)
 
+        # Packed arrays
+        elif isinstance(value, memoryview) or (numpy is not None and isinstance(value, numpy.ndarray)):
+            return value.tolist()
+
         # Frame
         elif isinstance(value, _BaseFrame):
             return value.to_json_type()
@@ -231,10 +315,10 @@ class _BaseFrame:
         return decorator
 
 
-class _FrameMeta(type):
+class _FrameMeta(_BaseFrameMeta):
     """
     Meta class for `Frame`s to ensure an `_id` is present in any defined set of
-    fields.
+    fields, and a `_version` for versioned classes.
     """
 
     def __new__(meta, name, bases, dct):
@@ -245,7 +329,19 @@ class _FrameMeta(type):
 
         if dct.get('_id') is None:
             dct['_id'] = ObjectIdField(null=True)
-        return super(_FrameMeta, meta).__new__(meta, name, bases, dct)
+
+        versioned = dct.get('_versioned', any(getattr(b, '_versioned', False) for b in bases))
+        if versioned and dct.get('_version') is None:
+            dct['_version'] = IntegerField(null=True)
+
+        cls = super(_FrameMeta, meta).__new__(meta, name, bases, dct)
+
+        # The collection handles of the class, by client, database and options
+        cls._handles = OrderedDict()
+
+        # The latency of the class's hedged reads
+        cls._latency = LatencyTracker()
+        return cls
 
 
 class Frame(_BaseFrame, metaclass=_FrameMeta):
@@ -263,6 +359,67 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
     # The database collection this class represents
     _collection = None
 
+    # Flag indicating if filters should be normalized against the fields of
+    # the class (values cast to the stored type) before they are sent
+    _normalize_filters = True
+
+    # Flag indicating if the values cast when normalizing filters should be
+    # logged
+    _debug_filters = False
+
+    # The collation used by queries with case insensitive conditions (e.g
+    # `IEquals`), this must match the collation of the indexes those queries
+    # are expected to use.
+    _collation = {'locale': 'en', 'strength': 2}
+
+    # Queries, updates and deletes with an `$in` list longer than this are
+    # split into chunks of this size...
+    _in_chunk_size = 5000
+
+    # ...of which at most this many are run at once
+    _in_parallelism = 4
+
+    # The frames loaded by the same query as a partial frame, their deferred
+    # fields are loaded together
+    _partial_frames = None
+
+    # Flag indicating if documents are versioned (optimistic concurrency), a
+    # `_version` field is added to the class which updates must match and
+    # increment, updating a document changed since it was loaded raises
+    # `VersionConflict`. Updates of the documents matching a filter (e.g.
+    # `raw_update_many`) increment the version without matching it.
+    _versioned = False
+
+    # The durability profile (see `concerns.WRITE_CONCERNS`) or `WriteConcern`
+    # documents are written with, the client's write concern if None. Write
+    # methods take a `write_concern` overriding it for a call.
+    _write_concern = None
+
+    # The read preference (see `routing.READ_PREFERENCES`) or `ReadPreference`
+    # documents are read with, the client's read preference if None, and the
+    # max staleness in seconds of the secondaries read from. Read methods take
+    # a `read_preference` and `max_staleness` overriding them for a call.
+    _read_preference = None
+    _max_staleness = None
+
+    # Flag indicating if reads of a single document are hedged (see
+    # `hedging`), a second attempt is sent to another member if the first
+    # hasn't returned within the `_hedge_percentile` of the recent latency.
+    # Hedges are sent with `_hedge_read_preference`, by default only reads
+    # that may be served by a secondary are hedged (with the same read
+    # preference), a read from the primary is never hedged to a secondary
+    # unless the hedge read preference is set. `one` and its variants take a
+    # `hedge` overriding the flag for a call.
+    _hedge = False
+    _hedge_percentile = 95
+    _hedge_read_preference = None
+
+    # Flag indicating if the operations on the collection are run under an
+    # adaptive concurrency limit (see `limiter`), the limiter is shared by the
+    # classes of a collection and created with `_limiter_options`.
+    _limit_concurrency = False
+    _limiter_options = {}
+
     # def __init__(self, *args, **kwargs):
     #     super(Frame, self).__init__(*args, **kwargs)
 
@@ -285,14 +442,14 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
 
     # Operations
 
-    async def save(self):
+    async def save(self, write_concern=None):
         """Insert or Update document"""
         if self["_id"] is None:
-            return await self.insert()
+            return await self.insert(write_concern)
         else:
-            return await self.update()
+            return await self.update(write_concern)
 
-    async def insert(self):
+    async def insert(self, write_concern=None):
         """Insert this document"""
         # Send insert signal
         # signal('insert1').send(self.__class__, frames=[self])
@@ -303,12 +460,14 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         document = self._get_document()
         if self._id is None:
             document.pop('_id')
+        if self._versioned and self._version is None:
+            document[self._aliases.path('_version')] = self.__dict__['_version'] = 1
         # validate data
 
         # TODO -> IMPLEMENT SAGA
 
         # Insert the document and update the Id
-        inserted_field = await self.get_collection().insert_one(document)
+        inserted_field = await self._get_write_collection(write_concern).insert_one(document)
         if inserted_field.inserted_id:
             self._id = inserted_field.inserted_id
             return True
@@ -317,8 +476,14 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         # signal('inserted').send(self.__class__, frames=[self])
 
     @classmethod
-    async def insert_many(cls, documents, ordered=True):
-        """Insert a list of documents"""
+    async def insert_many(cls, documents, ordered=True, executor=None, write_concern=None):
+        """
+        Insert a list of documents. Dictionaries are validated as a batch (see
+        `validation.validate_batch`), if an `executor` (e.g. a process pool)
+        is given large batches are validated by it in chunks. Invalid documents
+        raise `FrameValidation` with an `{'index': ..., 'errors': {...}}` entry
+        per invalid document.
+        """
         error_list = list()
         list_of_frames = list()
         if isinstance(documents, list) and documents[0]:
@@ -327,23 +492,22 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
                     d = doc._get_document()
                     if doc._id is None:
                         d.pop('_id')
+                    if cls._versioned and doc._version is None:
+                        doc.__dict__['_version'] = 1
                     list_of_frames.append(d)
+            elif executor is not None and len(documents) > POOL_CHUNK_SIZE:
+                list_of_frames, error_list = await validate_batch_in_pool(cls, documents, executor)
             else:
-                for index, doc in enumerate(documents):
-                    try:
-                        frame = cls(doc).is_valid()
-                    except ValidationError as e:
-                        error_list.append({"index": index, "errors": ast.literal_eval(e.message)})
-                        continue
-                    if frame._id is None:
-                        dd = frame._get_document()
-                        dd.pop('_id')
-                        list_of_frames.append(dd)
-                    else:
-                        list_of_frames.append(frame._get_document())
+                list_of_frames, error_list = validate_batch(cls, documents)
         if error_list:
-            raise ValidationError(message=str(error_list))
-        inserted_ids = await cls.get_collection().insert_many(list_of_frames, ordered=ordered)
+            raise FrameValidation(error_list)
+        if cls._versioned:
+            version_key = cls._aliases.path('_version')
+            for document in list_of_frames:
+                if document.get(version_key) is None:
+                    document[version_key] = 1
+        collection = cls._get_write_collection(write_concern)
+        inserted_ids = await collection.insert_many(list_of_frames, ordered=ordered)
         return True
 
     async def unset(self, *fields):
@@ -355,22 +519,24 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         # Clear the fields from the document and build the unset object
         unset = {}
         for field in fields:
-            unset[field] = True
+            unset[self._aliases.path(field)] = True
             self[field] = None
 
         # Update the document
-        self.get_collection().update_one(
-            {'_id': self._id},
-            {'$unset': unset}
-        )
+        update_result = await self._get_write_collection().update_one(*self._instance_update({'$unset': unset}))
+        self._updated(update_result.matched_count)
 
         # Send updated signal
         # signal('updated').send(self.__class__, frames=[self])
 
-    async def update(self):
+    async def update(self, write_concern=None):
         """
         Update this document. Optionally a specific list of fields to update can
         be specified.
+
+        Versioned documents are only updated if they're still at the version
+        they were loaded at, else (or if the document was deleted)
+        `VersionConflict` is raised.
         """
 
         # assert '_id' in self.__dict__, "Can't update documents without `_id`"
@@ -380,132 +546,334 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
 
         # Check for selective updates
         self.is_valid()
-        document = self._get_document()
-        # Update the document_
-        if not isinstance(self._id, ObjectId):
-            self._id = ObjectId(self._id)
-        if document == {}:
+        request = self._update_request()
+        if request is None:
             return False
-        update_result = await self.get_collection().update_one({'_id': self._id}, {'$set': document})
+        update_result = await self._get_write_collection(write_concern).update_one(*request)
+        self._updated(update_result.matched_count)
         return update_result.matched_count + update_result.modified_count
 
         # Send updated signal
         # signal('updated').send(self.__class__, frames=[self])
 
     @classmethod
-    async def raw_update_one(cls, filter, update, **kwargs):
-        update_result = await cls.get_collection().update_one(filter, update, **kwargs)
-        return update_result.matched_count + update_result.modified_count
+    async def update_many(cls, frames, parallelism=None, write_concern=None):
+        """
+        Update a list of (stored) frames as `update()` would, all frames are
+        validated before any is updated. Invalid frames raise `FrameValidation`
+        with an `{'index': ..., 'errors': {...}}` entry per invalid frame.
+
+        Frames of a versioned class are updated concurrently (at most
+        `parallelism` at once), those changed since they were loaded aren't
+        updated and once the others are `VersionConflict` is raised with an
+        `{'index': ..., '_id': ...}` entry per conflicting frame. Other frames
+        are updated in a single bulk write.
+        """
+        error_list = []
+        for index, frame in enumerate(frames):
+            try:
+                frame.is_valid()
+            except FrameValidation as e:
+                error_list.append({'index': index, 'errors': e.message})
+        if error_list:
+            raise FrameValidation(error_list)
+
+        requests = [(i, f, f._update_request()) for i, f in enumerate(frames)]
+        requests = [r for r in requests if r[2] is not None]
+        if not requests:
+            return 0
+        collection = cls._get_write_collection(write_concern)
+
+        if not cls._versioned:
+            result = await collection.bulk_write([UpdateOne(*r) for _, _, r in requests], ordered=False)
+            return result.matched_count + result.modified_count
+
+        async def update(indexed):
+            index, frame, request = indexed
+            update_result = await collection.update_one(*request)
+            try:
+                frame._updated(update_result.matched_count)
+            except VersionConflict:
+                return None
+            return update_result.matched_count + update_result.modified_count
+
+        results = await gather_chunks(
+            requests,
+            update,
+            parallelism or cls._in_parallelism,
+            lambda r: r or 0
+        )
+        conflicts = [
+            {'index': index, '_id': str(frame._id)}
+            for (index, frame, _), result in zip(requests, results)
+            if result is None
+        ]
+        if conflicts:
+            raise VersionConflict(conflicts)
+        return sum(results)
+
+    def _update_request(self):
+        """
+        Return the `(filter, update)` updating the (validated) document, or None
+        if there's nothing to update. Versioned documents are matched on their
+        version, which is incremented.
+        """
+        document = self._get_document()
+        if not isinstance(self._id, ObjectId):
+            self._id = ObjectId(self._id)
+
+        filter = {'_id': self._id}
+        update = {}
+        if self._versioned:
+            version_key = self._aliases.path('_version')
+            document.pop(version_key, None)
+            filter[version_key] = self.__dict__['_version']
+            update['$inc'] = {version_key: 1}
+        if document == {}:
+            return None
+        update['$set'] = document
+        return filter, update
+
+    def _updated(self, matched_count):
+        """
+        Apply the result of an update to a versioned document (see
+        `_update_request`), raising `VersionConflict` if it wasn't matched.
+        """
+        if not self._versioned:
+            return
+        if not matched_count:
+            raise VersionConflict()
+        self.__dict__['_version'] = (self.__dict__['_version'] or 0) + 1
+
+    def _instance_update(self, update):
+        """
+        Return the `(filter, update)` applying an update (with the stored names)
+        to this document. Versioned documents are matched on their version,
+        which is incremented (see `_updated`).
+        """
+        filter = {'_id': self._id}
+        if self._versioned:
+            filter[self._aliases.path('_version')] = self.__dict__['_version']
+            update = self._increment_version(update)
+        return filter, update
 
     @classmethod
-    async def raw_update_many(cls, filter, update, **kwargs):
-        update_result = await cls.get_collection().update_many(filter, update, **kwargs)
+    async def raw_update_one(cls, filter, update, write_concern=None, **kwargs):
+        """
+        Apply a pymongo update to the first document matching the filter, the
+        versions of versioned documents are incremented.
+        """
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        if cls._versioned:
+            update = cls._increment_version(update)
+        update = cls._aliases.update(update)
+        update_result = await cls._get_write_collection(write_concern).update_one(filter, update, **kwargs)
         return update_result.matched_count + update_result.modified_count
 
-    async def delete(self):
+    @classmethod
+    async def raw_update_many(cls, filter, update, write_concern=None, **kwargs):
+        """
+        Apply a pymongo update to the documents matching the filter, the
+        versions of versioned documents are incremented.
+        """
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        if cls._versioned:
+            update = cls._increment_version(update)
+        update = cls._aliases.update(update)
+        collection = cls._get_write_collection(write_concern)
+        update_results = await cls._fan_out(
+            filter,
+            lambda f: collection.update_many(f, update, **kwargs),
+            lambda r: r.matched_count + r.modified_count
+        )
+        return sum(r.matched_count + r.modified_count for r in update_results)
+
+    @classmethod
+    async def update_where(cls, filter, *updates, **kwargs):
+        """
+        Apply update operators (`Set`, `Inc`, `Push`...) to the documents
+        matching the filter in a single server-side update, the values are
+        cleaned by the fields they're written to. The versions of versioned
+        documents are incremented.
+        """
+        update = compile_updates(updates, cls._fields)
+        return await cls.raw_update_many(filter, update, **kwargs)
+
+    @classmethod
+    def _increment_version(cls, update):
+        """
+        Return an update (or pipeline update) also incrementing `_version`
+        (under its stored name).
+        """
+        version_key = cls._aliases.path('_version')
+        if isinstance(update, list):
+            return update + [{'$set': {version_key: {'$add': [{'$ifNull': ['$' + version_key, 0]}, 1]}}}]
+        increments = update.get('$inc', {})
+        assert '_version' not in increments and version_key not in increments, '`_version` is incremented by updates'
+        return {**update, '$inc': {**increments, version_key: 1}}
+
+    async def delete(self, write_concern=None):
         """Delete this document"""
         if self._child_frames:
             for value in self._child_frames.values():
                 if not await getattr(self, value.on_delete, None)(value):
                     return False
-        delete_res = await self.get_collection().delete_one({"_id": ObjectId(self._id)})
+        collection = self._get_write_collection(write_concern)
+        delete_res = await collection.delete_one({"_id": ObjectId(self._id)})
         if delete_res.deleted_count >= 1:
+            await self._delete_files([self.__dict__])
             return delete_res.deleted_count
         return False
 
     @classmethod
-    async def raw_delete_one(cls, filter, **kwargs):
+    async def raw_delete_one(cls, filter, write_concern=None, **kwargs):
         """Delete multiple documents"""
-        await cls.get_collection().delete_one(filter, **kwargs)
+        kwargs = {**cls._query_options(filter), **kwargs}
+        document = None
+        if cls._file_fields:
+            # Delete the document the files were read from
+            document = await cls._find_one(filter, cls._file_projection(), collection=cls.get_collection())
+            if document:
+                filter = {'_id': document['_id']}
+        filter = cls._prepare_filter(filter)
+        delete_res = await cls._get_write_collection(write_concern).delete_one(filter, **kwargs)
+        if document and delete_res.deleted_count:
+            await cls._delete_files([document])
 
         return True
 
     @classmethod
-    async def delete_many(cls, key, id):
+    async def delete_many(cls, key, id, write_concern=None):
         """Delete multiple documents"""
         if not isinstance(id, ObjectId):
             id = ObjectId(id)
-        await cls.get_collection().delete_many({key: ObjectId(id)})
+        documents = None
+        if cls._file_fields:
+            documents = await cls._find(
+                {key: id},
+                cls._file_projection(),
+                collection=cls.get_collection()
+            ).to_list(length=None)
+        await cls._get_write_collection(write_concern).delete_many({cls._aliases.path(key): ObjectId(id)})
+        if documents:
+            await cls._delete_files(documents)
 
         return True
 
     @classmethod
-    async def raw_delete_many(cls, filter, **kwargs):
+    async def raw_delete_many(cls, filter, write_concern=None, **kwargs):
         """Delete multiple documents"""
-        res = await cls.get_collection().delete_many(filter, **kwargs)
-        return res.deleted_count
+        documents = None
+        if cls._file_fields:
+            documents = await cls._find(
+                filter,
+                cls._file_projection(),
+                collection=cls.get_collection()
+            ).to_list(length=None)
+
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        collection = cls._get_write_collection(write_concern)
+        results = await cls._fan_out(
+            filter,
+            lambda f: collection.delete_many(f, **kwargs),
+            lambda r: r.deleted_count
+        )
+
+        if documents:
+            await cls._delete_files(documents)
+        return sum(r.deleted_count for r in results)
+
+    # Files
+
+    async def upload(self, name, source, filename=None, content_type=None, metadata=None):
+        """
+        Upload the file for a file field from a source (bytes, a `Request`, an
+        `UploadedFile`, an (async) iterable of bytes...), streamed to GridFS a
+        chunk at a time. If the frame is stored the field is updated (as
+        `update()` would for a versioned frame) and the file it held is deleted.
+        Return the Id of the file.
+        """
+        field = self._file_fields[name]
+        bucket = get_bucket(self.get_db(), field)
+        try:
+            file_id = await upload_file(bucket, field, source, filename or name, content_type, metadata)
+        except FileTooLarge:
+            raise FrameValidation({name: field.error_messages['too_large'] % {'max_size': field.max_size}})
+
+        previous = self.__dict__.get(name)
+        if self._id is None:
+            self[name] = file_id
+            return file_id
+
+        update_result = await self._get_write_collection().update_one(
+            *self._instance_update({'$set': {self._aliases.path(name): file_id}})
+        )
+        try:
+            self._updated(update_result.matched_count)
+        except VersionConflict:
+            # The file isn't referenced by the document
+            await delete_files(bucket, [file_id])
+            raise
+        self[name] = file_id
+        self._update_field.discard(name)
+        if previous:
+            await delete_files(bucket, [previous])
+        return file_id
+
+    def download(self, name):
+        """
+        Return an async iterator over the chunks of the file of a file field
+        (e.g. for a `StreamingHttpResponse`).
+        """
+        return iter_file(get_bucket(self.get_db(), self._file_fields[name]), self[name])
 
     async def _get_parent_key(self, frame):
         for key, value in self._meta.items():
-            if isinstance(value, ForeignKey):
-                if isinstance(value.to, str):
+            array = isinstance(value, ArrayField)
+            field = value.to if array else value
+            if isinstance(field, ForeignKey):
+                if isinstance(field.to, str):
                     str_frame = frame.__class__.__name__
                 else:
-                    str_frame = frame
-                if value.to == str_frame:
-                    return key, False, value.default
-            if isinstance(value, ArrayField):
-                if isinstance(value.to, ForeignKey):
-                    if isinstance(value.to, str):
-                        str_frame = frame.__class__.__name__
-                    else:
-                        str_frame = frame
-                    if value.to == str_frame:
-                        return key, True, value.default
+                    str_frame = frame.__class__
+                if field.to == str_frame:
+                    return key, array, self._field_default(value)
 
     async def _cascade(self, value=None):
         """Delete multiple documents"""
         child = value.frame
         pr_key, array, default_value = await child()._get_parent_key(self)
         if array:
-            children = await child.many({pr_key: ObjectId(self._id)})
-            for ch in children:
-                await ch.update({pr_key: ObjectId(self._id)}, {"$pull": {pr_key: ObjectId(self._id)}})
+            await child.raw_update_many({pr_key: ObjectId(self._id)}, {'$pull': {pr_key: ObjectId(self._id)}})
         else:
             child_class = child()
             if child_class._child_frames:
+                # Delete the children one at a time so their own children
+                # are handled as well.
                 children = await child.many({pr_key: ObjectId(self._id)})
                 for ch in children:
-                    ch.delete_without_trans()
+                    await ch.delete()
             else:
-                await child.get_collection().delete_many({pr_key: ObjectId(self._id)})
+                await child.raw_delete_many({pr_key: ObjectId(self._id)})
         return True
 
     async def _restrict(self, value=None):
         """Not delete a document if its have a child"""
         child = value.frame
         pr_key, array, default_value = await child()._get_parent_key(self)
-        if array:
-            children = await child.many({pr_key: ObjectId(self._id)})
-            if children:
-                return False
-        else:
-            child_class = child()
-            if child_class._child_frames:
-                children = await child.many({pr_key: ObjectId(self._id)})
-                for ch in children:
-                    ch.delete_without_trans()
-            else:
-                return False
-        return True
+        return not await child.count_by_filter({pr_key: ObjectId(self._id)})
 
     async def _set_null(self, value=None):
         """set null for all child of document"""
         child = value.frame
         pr_key, array, default_value = await child()._get_parent_key(self)
         if array:
-            children = await child.many({pr_key: ObjectId(self._id)})
-            for ch in children:
-                await ch.update({pr_key: ObjectId(self._id)}, {"$pull": {pr_key: ObjectId(self._id)}})
+            await child.raw_update_many({pr_key: ObjectId(self._id)}, {'$pull': {pr_key: ObjectId(self._id)}})
         else:
-            child_class = child()
-            if child_class._child_frames:
-                children = await child.many({pr_key: ObjectId(self._id)})
-                for ch in children:
-                    ch.delete_without_trans()
-            else:
-                await child.get_collection().update_many({pr_key: ObjectId(self._id)},
-                                                         {"$set": {pr_key: None}})
+            await child.raw_update_many({pr_key: ObjectId(self._id)}, {'$set': {pr_key: None}})
         return True
 
     async def _set_default(self, value=None):
@@ -513,53 +881,120 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         child = value.frame
         pr_key, array, default_value = await child()._get_parent_key(self)
         if array:
-            children = await child.many({pr_key: ObjectId(self._id)})
-            for ch in children:
-                await ch.update({pr_key: ObjectId(self._id)}, {"$pull": {pr_key: ObjectId(self._id)}})
+            await child.raw_update_many({pr_key: ObjectId(self._id)}, {'$pull': {pr_key: ObjectId(self._id)}})
         else:
-            child_class = child()
-            if child_class._child_frames:
-                children = await child.many({pr_key: ObjectId(self._id)})
-                for ch in children:
-                    ch.delete_without_trans()
-            else:
-                await child.get_collection().update_many({pr_key: ObjectId(self._id)},
-                                                         {"$set": {pr_key: default_value}})
+            await child.raw_update_many({pr_key: ObjectId(self._id)}, {'$set': {pr_key: default_value}})
         return True
 
     async def pull(self, pull_condition):
-        update_result = await self.get_collection().update_one({'_id': self._id}, {'$pull': pull_condition})
+        update_result = await self._get_write_collection().update_one(
+            *self._instance_update(self._aliases.update({'$pull': pull_condition}))
+        )
+        self._updated(update_result.matched_count)
         return update_result.matched_count + update_result.modified_count
 
     async def push(self, key, document):
         document._update_field.clear()
         document = document._get_document()
-        update_result = await self.get_collection().update_one({'_id': self._id}, {'$push': {key: document}})
+        update_result = await self._get_write_collection().update_one(
+            *self._instance_update({'$push': {self._aliases.path(key): document}})
+        )
+        self._updated(update_result.matched_count)
         return update_result.matched_count + update_result.modified_count
 
+    async def load_deferred(self):
+        """
+        Load the deferred fields of a partial frame, along with those of the
+        other partial frames loaded by the same query (in a single query).
+        """
+        await load_deferred(self._partial_frames or [self])
+
+    def _set_deferred_values(self, document):
+        """
+        Set the values of the deferred fields from a document holding them, the
+        loaded values aren't flagged for update.
+        """
+        deferred = self._deferred
+        self._deferred = frozenset()
+        document = self._aliases.to_python_document(document)
+        self.set_items([
+            (key, document[key] if key in document else self._field_default(self._meta[key]))
+            for key in deferred
+        ])
+        self._update_field.difference_update(deferred)
+
+    @classmethod
+    async def decrypt_fields(cls, frames, *names, executor=None):
+        """
+        Decrypt the values of the encrypted fields (all if none are named) of a
+        list of frames (e.g. from `many()`), a column at a time. Decryption is
+        CPU bound, if an `executor` is given each column is decrypted by it.
+        """
+        if not names:
+            names = [k for k, v in cls._fields.items() if isinstance(v, EncryptedField)]
+
+        loop = asyncio.get_running_loop()
+        for name in names:
+            field = cls._fields[name]
+            pending = [f for f in frames if field.is_db_value(f.__dict__.get(name))]
+            if not pending:
+                continue
+
+            values = [f.__dict__[name] for f in pending]
+            if executor is not None:
+                decrypted = await loop.run_in_executor(executor, field.decrypt_values, field.get_key(), values)
+            else:
+                decrypted = field.decrypt_many(values)
+
+            # Set as loaded values (not flagged for update)
+            for frame, value in zip(pending, decrypted):
+                frame.__dict__[name] = value
+
+    @classmethod
+    def _file_projection(cls):
+        """Return the projection for the files of documents"""
+        return {key: 1 for key in cls._file_fields}
+
+    @classmethod
+    async def _delete_files(cls, documents):
+        """Delete the files of the file fields of documents (or frames' values)"""
+        documents = [cls._aliases.to_python_document(d) for d in documents]
+        for key, field in cls._file_fields.items():
+            file_ids = [d[key] for d in documents if d.get(key)]
+            if file_ids:
+                await delete_files(get_bucket(cls.get_db(), field), file_ids)
+
+    @classmethod
+    def _from_db(cls, document):
+        """
+        Return a frame for a document loaded from the database, the loaded
+        values are trusted and only validated once changed.
+        """
+        frame = cls(document)
+        frame.clear_update_fields()
+        return frame
+
+    @classmethod
+    def query(cls):
+        """Return a lazy, chainable query set for the class"""
+        return QuerySet(cls)
+
     @classmethod
-    async def one(cls, filter=None, **kwargs):
+    async def one(cls, filter=None, read_preference=None, max_staleness=None, hedge=None, **kwargs):
         """Return the first document matching the filter"""
-        if kwargs:
-            document = await cls.get_collection().find_one(filter, kwargs)
-        else:
-            document = await cls.get_collection().find_one(filter)
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        document = await cls._read_one(filter, kwargs or None, collection, hedge)
 
         # Make sure we found a document
         if not document:
             return
-        doc = cls(document)
-        doc.clear_update_fields()
-        return doc
+        return cls._from_db(document)
 
     @classmethod
-    async def one_json(cls, filter=None, **kwargs):
+    async def one_json(cls, filter=None, read_preference=None, max_staleness=None, hedge=None, **kwargs):
         """Return the first document matching the filter"""
-
-        if kwargs:
-            document = await cls.get_collection().find_one(filter, kwargs)
-        else:
-            document = await cls.get_collection().find_one(filter)
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        document = await cls._read_one(filter, kwargs or None, collection, hedge)
 
         # Make sure we found a document
         if not document:
@@ -570,39 +1005,70 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         return result
 
     @classmethod
-    async def one_no_cast(cls, filter=None, **kwargs):
-        """Return the first document matching the filter without casting to frame"""
-        if kwargs:
-            document = await cls.get_collection().find_one(filter, kwargs)
-        else:
-            document = await cls.get_collection().find_one(filter)
+    async def one_raw_json(cls, filter=None, read_preference=None, max_staleness=None, hedge=None, **kwargs):
+        """
+        Return the JSON (as `RawJSON` bytes for `Response`) for the first
+        document matching the filter, transcoded straight from BSON.
+        """
+        collection = cls._get_raw_collection(read_preference, max_staleness)
+        document = await cls._read_one(filter, cls._json_projection(kwargs), collection, hedge)
+        cls.include.clear()
+        cls.exclude.clear()
 
         # Make sure we found a document
         if not document:
             return
-        return document
+        return bson_to_json(document.raw, collection.codec_options, cls._aliases.json_names())
 
     @classmethod
-    async def many(cls, filter=None, **kwargs):
-        """Return a list of documents matching the filter"""
+    async def one_no_cast(cls, filter=None, read_preference=None, max_staleness=None, hedge=None, **kwargs):
+        """Return the first document matching the filter without casting to frame"""
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        document = await cls._read_one(filter, kwargs or None, collection, hedge)
 
-        if kwargs:
-            documents = cls.get_collection().find(filter, kwargs)
-        else:
-            documents = cls.get_collection().find(filter)
+        # Make sure we found a document
+        if not document:
+            return
+        return cls._aliases.to_python_document(document)
+
+    @classmethod
+    async def many(cls, filter=None, sort=None, skip=0, limit=0, preserve_order=False, read_preference=None,
+                 max_staleness=None, **kwargs):
+        """
+        Return a list of documents matching the filter, if `preserve_order` is
+        True they are returned in the order of the filter's `$in` list.
+        """
+        documents = cls._find(
+            filter,
+            kwargs or None,
+            preserve_order=preserve_order,
+            collection=cls._get_read_collection(read_preference, max_staleness),
+            sort=sort,
+            skip=skip,
+            limit=limit
+        )
 
         if documents is None:
             return None
 
-        return [cls(d) async for d in documents]
+        return [cls._from_db(d) async for d in documents]
 
     @classmethod
-    async def many_json(cls, filter=None, **kwargs):
-        """Return a list of documents matching the filter"""
-        if kwargs:
-            documents = cls.get_collection().find(filter, kwargs)
-        else:
-            documents = cls.get_collection().find(filter)
+    async def many_json(cls, filter=None, sort=None, skip=0, limit=0, preserve_order=False, read_preference=None,
+                        max_staleness=None, **kwargs):
+        """
+        Return a list of documents matching the filter, if `preserve_order` is
+        True they are returned in the order of the filter's `$in` list.
+        """
+        documents = cls._find(
+            filter,
+            kwargs or None,
+            preserve_order=preserve_order,
+            collection=cls._get_read_collection(read_preference, max_staleness),
+            sort=sort,
+            skip=skip,
+            limit=limit
+        )
 
         if documents is None:
             return None
@@ -613,26 +1079,79 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         return result
 
     @classmethod
-    async def many_no_cast(cls, filter=None, **kwargs):
-        """Return a list of documents matching the filter"""
-        if kwargs:
-            documents = cls.get_collection().find(filter, kwargs)
-        else:
-            documents = cls.get_collection().find(filter)
+    async def many_raw_json(cls, filter=None, sort=None, skip=0, limit=0, read_preference=None, max_staleness=None,
+                            **kwargs):
+        """
+        Return the JSON array (as `RawJSON` bytes for `Response`) of the
+        documents matching the filter, transcoded straight from BSON.
+        """
+        collection = cls._get_raw_collection(read_preference, max_staleness)
+        documents = cls._find(
+            filter,
+            cls._json_projection(kwargs),
+            collection=collection,
+            sort=sort,
+            skip=skip,
+            limit=limit
+        )
+        cls.include.clear()
+        cls.exclude.clear()
+
+        return bsons_to_json(
+            [d.raw async for d in documents],
+            collection.codec_options,
+            cls._aliases.json_names()
+        )
+
+    @classmethod
+    async def scroll(cls, filter=None, token=None, per_page=20, sort=None, **kwargs):
+        """
+        Return a page of documents matching the filter and the token to pass
+        back for the next page (None once the results are exhausted).
+
+        The first call (without a token) opens a cursor which is kept alive in
+        `scroll_registry`, following calls with the returned token carry on
+        reading from it so later pages are neither re-queried nor skipped to.
+        The filter, sort and projection are only used when opening the cursor.
+        """
+        if token is None:
+            documents = cls._find(filter, kwargs or None, sort=sort, batch_size=per_page)
+            token = scroll_registry.open(cls, documents)
+
+        documents, token = await scroll_registry.take(cls, token, per_page)
+        return [cls._from_db(d) for d in documents], token
+
+    @classmethod
+    async def many_no_cast(cls, filter=None, sort=None, skip=0, limit=0, preserve_order=False, read_preference=None,
+                           max_staleness=None, **kwargs):
+        """
+        Return a list of documents matching the filter, if `preserve_order` is
+        True they are returned in the order of the filter's `$in` list.
+        """
+        documents = cls._find(
+            filter,
+            kwargs or None,
+            preserve_order=preserve_order,
+            collection=cls._get_read_collection(read_preference, max_staleness),
+            sort=sort,
+            skip=skip,
+            limit=limit
+        )
 
         if documents is None:
             return None
 
-        return [d async for d in documents]
+        return [cls._aliases.to_python_document(d) async for d in documents]
 
     @classmethod
-    async def aggregate(cls, pipeline):
+    async def aggregate(cls, pipeline, read_preference=None, max_staleness=None):
         additional = list()
         for item in pipeline:
             proj = item.get('$project', None)
             if proj:
                 additional.extend(list(proj.keys()))
-        documents = cls.get_collection().aggregate(pipeline)
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        documents = collection.aggregate(cls._prepare_pipeline(pipeline))
         # if documents in None:
         #     return
         doc = []
@@ -647,13 +1166,14 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         return doc
 
     @classmethod
-    async def aggregate_json(cls, pipeline):
+    async def aggregate_json(cls, pipeline, read_preference=None, max_staleness=None):
         additional = list()
         for item in pipeline:
             proj = item.get('$project', None)
             if proj:
                 additional.extend(list(proj.keys()))
-        documents = cls.get_collection().aggregate(pipeline)
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        documents = collection.aggregate(cls._prepare_pipeline(pipeline))
         # if documents in None:
         #     return
         doc = []
@@ -670,28 +1190,39 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
         return doc
 
     @classmethod
-    async def aggregate_no_cast(cls, pipeline):
-        documents = cls.get_collection().aggregate(pipeline)
+    async def aggregate_no_cast(cls, pipeline, read_preference=None, max_staleness=None):
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        documents = collection.aggregate(cls._prepare_pipeline(pipeline))
         # if documents in None:
         #     return
-        return [d async for d in documents]
+        return [cls._aliases.to_python_document(d) async for d in documents]
 
     @classmethod
-    async def counts(cls, pipeline):
+    async def counts(cls, pipeline, read_preference=None, max_staleness=None):
         pipeline.append({"$count": "count"})
-        documents = cls.get_collection().aggregate(pipeline)
+        collection = cls._get_read_collection(read_preference, max_staleness)
+        documents = collection.aggregate(cls._prepare_pipeline(pipeline))
         async for d in documents:
             return d.get("count")
         # result = await documents
 
     @classmethod
     async def find_and_update(cls, filter=None, update=None, projection=None, sort=None, upsert=False, **kwargs):
-        """Return a doc of documents matching the filter and update that doc"""
-        res = await cls.get_collection().find_one_and_update(filter=filter, update=update, projection=projection,
-                                                             sort=sort,
-                                                             upsert=upsert, **kwargs)
+        """
+        Return a doc of documents matching the filter and update that doc, the
+        version of a versioned document is incremented.
+        """
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        if cls._versioned:
+            update = cls._increment_version(update)
+        res = await cls._get_write_collection().find_one_and_update(filter=filter,
+                                                                    update=cls._aliases.update(update),
+                                                                    projection=cls._aliases.projection(projection),
+                                                                    sort=cls._aliases.sort(sort),
+                                                                    upsert=upsert, **kwargs)
         if res:
-            return cls(res)
+            return cls._from_db(res)
 
     #
     #     # Ensure all documents have been converted to frames
@@ -815,42 +1346,38 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
 
     async def reload(self, **kwargs):
         """Reload the document"""
-        return self.one({'_id': self._id}, **kwargs)
+        return await self.one({'_id': self._id}, **kwargs)
 
     @classmethod
     async def count_by_filter(cls, filter=None, **kwargs):
         """Return a count of documents matching the filter"""
 
-        if isinstance(filter, (Condition, Group)):
-            filter = filter.to_dict()
-
-        filter = to_refs(filter)
+        if not isinstance(filter, (Condition, Group)):
+            filter = to_refs(filter)
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
 
+        collection = cls._get_read_collection()
         if filter:
-            return cls.get_collection().count_documents(
-                to_refs(filter),
-                **kwargs
-            )
+            counts = await cls._fan_out(filter, lambda f: collection.count_documents(f, **kwargs), int)
+            return sum(counts)
         else:
-            return cls.get_collection().estimated_document_count(**kwargs)
+            return await collection.estimated_document_count(**kwargs)
 
     @classmethod
     async def ids(cls, filter, **kwargs):
         """Return a list of Ids for documents matching the filter"""
-        documents = cls.get_collection().find(
-            filter,
-            projection={'_id': 1},
-            **kwargs
-        )
+        documents = cls._find(filter, {'_id': 1}, **kwargs)
         return [d["_id"] async for d in documents]
 
     @classmethod
     async def nullify(cls, filter, fields):
         """Nullify a reference field (does not emit signals)"""
-        cls.get_collection().update_many(
-            filter,
-            {'$set': [{field: None} for field in fields]}
-        )
+        filter = cls._prepare_filter(filter)
+        update = {'$set': {cls._aliases.path(field): None for field in fields}}
+        if cls._versioned:
+            update = cls._increment_version(update)
+        await cls._get_write_collection().update_many(filter, update)
 
     # Signals
 
@@ -867,14 +1394,287 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
     # Misc.
 
     @classmethod
-    def get_collection(cls):
-        """Return a reference to the database collection for the class"""
-        return getattr(
-            cls,
-            '_collection_context',
-            getattr(cls.get_db(), cls._collection)
+    def _prepare_filter(cls, filter):
+        """
+        Return the pymongo filter to send for a filter (a condition, group or
+        raw filter), normalized against the fields of the class and with the
+        fields' stored names.
+        """
+        filter = to_filter(filter)
+        if not filter:
+            return filter
+        if not cls._normalize_filters:
+            return cls._aliases.filter(filter)
+
+        casts = [] if cls._debug_filters else None
+        filter = normalize_filter(filter, cls._fields, casts)
+        if casts:
+            for path, original, cast in casts:
+                logger.info(
+                    '%s filter cast `%s` from %r to %r',
+                    cls.__name__,
+                    path,
+                    original,
+                    cast
+                )
+        return cls._aliases.filter(filter)
+
+    @classmethod
+    def _query_options(cls, filter):
+        """Return the options a query must be run with for a filter"""
+        if requires_collation(filter):
+            return {'collation': cls._collation}
+        return {}
+
+    @classmethod
+    def _find(cls, filter=None, projection=None, preserve_order=False, collection=None, **kwargs):
+        """
+        Return a cursor for the documents matching the filter, the filter is
+        prepared and run with the options it requires. Filters with a huge
+        `$in` list are split into chunks (see `chunking`), if `preserve_order`
+        is True documents are returned in the order of the `$in` list.
+        """
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        projection = cls._aliases.projection(projection)
+        if kwargs.get('sort'):
+            kwargs['sort'] = cls._aliases.sort(kwargs['sort'])
+        if collection is None:
+            collection = cls._get_read_collection()
+
+        filters = split_in(filter, cls._in_chunk_size, cls._aliases.is_scalar)
+        order = find_in(filter, cls._aliases.is_scalar) if preserve_order else None
+        if filters is None and order is None:
+            return collection.find(filter, projection, **kwargs)
+
+        return ChunkedCursor(
+            collection,
+            filters or [filter],
+            projection,
+            parallelism=cls._in_parallelism,
+            order=order,
+            **kwargs
+        )
+
+    @classmethod
+    async def _find_one(cls, filter=None, projection=None, collection=None, **kwargs):
+        """Return the first document matching the filter"""
+        kwargs = {**cls._query_options(filter), **kwargs}
+        filter = cls._prepare_filter(filter)
+        projection = cls._aliases.projection(projection)
+        if kwargs.get('sort'):
+            kwargs['sort'] = cls._aliases.sort(kwargs['sort'])
+        if collection is None:
+            collection = cls._get_read_collection()
+
+        filters = split_in(filter, cls._in_chunk_size, cls._aliases.is_scalar)
+        if filters is None:
+            return await collection.find_one(filter, projection, **kwargs)
+
+        documents = await ChunkedCursor(
+            collection,
+            filters,
+            projection,
+            parallelism=cls._in_parallelism,
+            limit=1,
+            **kwargs
+        ).to_list()
+        return documents[0] if documents else None
+
+    @classmethod
+    async def _read_one(cls, filter, projection, collection, hedge=None):
+        """
+        Return the first document matching the filter read from a collection,
+        hedged if `hedge` (by default the class's `_hedge`) is True. Reads in a
+        client session aren't hedged, a session can't run two operations at
+        once.
+        """
+        hedge_collection = None
+        if (cls._hedge if hedge is None else hedge) and not isinstance(collection, SessionCollection):
+            hedge_collection = cls._get_hedge_collection(collection)
+        if hedge_collection is None:
+            return await cls._find_one(filter, projection, collection=collection)
+
+        start = time.perf_counter()
+
+        async def first():
+            try:
+                return await cls._find_one(filter, projection, collection=collection)
+            finally:
+                # The first attempt's own latency (the time until it was
+                # cancelled if the hedge returned first), the hedge's would
+                # bias the percentile down
+                cls._latency.record(time.perf_counter() - start)
+
+        return await hedged(
+            first,
+            lambda: cls._find_one(filter, projection, collection=hedge_collection),
+            cls._latency.percentile(cls._hedge_percentile)
         )
 
+    @classmethod
+    def _get_hedge_collection(cls, collection):
+        """
+        Return the collection a read from a collection is hedged with, None if
+        the read isn't hedged. Without a `_hedge_read_preference` reads from
+        the primary aren't hedged (a secondary may return stale data) and
+        others are hedged with their own read preference (server selection
+        picks a member at random among those eligible).
+        """
+        read_preference = cls._hedge_read_preference
+        if read_preference is None:
+            read_preference = collection.read_preference
+            if read_preference.mongos_mode in ('primary', 'primaryPreferred'):
+                return None
+            return collection
+        return collection.with_options(read_preference=get_read_preference(read_preference))
+
+    @classmethod
+    async def _fan_out(cls, filter, func, count=None):
+        """
+        Return the results of awaiting `func(filter)` for a prepared filter,
+        or for each chunk of a filter with a huge `$in` list (see
+        `chunking.gather_chunks` for `count`).
+        """
+        filters = split_in(filter, cls._in_chunk_size, cls._aliases.is_scalar)
+        if filters is None:
+            return [await func(filter)]
+        return await gather_chunks(filters, func, cls._in_parallelism, count)
+
+    @classmethod
+    def _prepare_pipeline(cls, pipeline):
+        """
+        Return an aggregation pipeline with the leading `$match` stages (those
+        that still see documents shaped as the class) normalized, and the
+        fields' stored names used by the stages that see them.
+        """
+        prepared = list(pipeline)
+        start = 0
+        if cls._normalize_filters:
+            while start < len(prepared):
+                stage = prepared[start]
+                if not (isinstance(stage, dict) and list(stage.keys()) == ['$match']):
+                    break
+                prepared[start] = {'$match': cls._prepare_filter(stage['$match'])}
+                start += 1
+        return prepared[:start] + cls._aliases.pipeline(prepared[start:])
+
+    @classmethod
+    async def migrate_db_fields(cls, batch_size=1000, reverse=False):
+        """
+        Rename the keys of stored documents to the names the fields are stored
+        under (`db_field`), or back if `reverse` is True, in batches (see
+        `aliases.migrate_aliases`). Return the number of documents renamed.
+        """
+        return await migrate_aliases(cls, batch_size, reverse)
+
+    @classmethod
+    def _get_read_collection(cls, read_preference=None, max_staleness=None, **options):
+        """
+        Return the collection for the class set to read with a read preference
+        (a mode, see `routing.READ_PREFERENCES`, or `ReadPreference`) and max
+        staleness, by default the read preference scoped to the current context
+        or else the class's `_read_preference`.
+        """
+        if read_preference is None and 'read_preference' not in (scoped_options(cls) or {}):
+            read_preference = cls._read_preference
+            if max_staleness is None:
+                max_staleness = cls._max_staleness
+        if read_preference is not None:
+            # A max staleness scoped to the context only applies to the scoped
+            # read preference
+            options['read_preference'] = read_preference
+            options['max_staleness'] = max_staleness
+        elif max_staleness is not None:
+            # Applied to the scoped read preference
+            options['max_staleness'] = max_staleness
+
+        collection = cls.get_collection(**options)
+        record_read(collection.read_preference)
+        return collection
+
+    @classmethod
+    def _get_raw_collection(cls, read_preference=None, max_staleness=None):
+        """
+        Return the collection for the class set to return documents as raw
+        BSON (`RawBSONDocument`), and read as `_get_read_collection`.
+        """
+        return cls._get_read_collection(read_preference, max_staleness, codec_options='raw')
+
+    @classmethod
+    def _get_write_collection(cls, write_concern=None):
+        """
+        Return the collection for the class set to write with a write concern
+        (a profile name or `WriteConcern`), by default the write concern scoped
+        to the current context or else the class's `_write_concern`.
+        """
+        if write_concern is None and 'write_concern' not in (scoped_options(cls) or {}):
+            write_concern = cls._write_concern
+        if write_concern is None:
+            return cls.get_collection()
+        return cls.get_collection(write_concern=write_concern)
+
+    @classmethod
+    def _json_projection(cls, projection=None):
+        """
+        Return the projection for documents returned as JSON, an explicit
+        projection or else the class's fields (honouring `include` and
+        `exclude`).
+        """
+        if projection:
+            return projection
+        if cls.include:
+            return {key: 1 for key in cls._fields if key in cls.include}
+        return {key: 1 for key in cls._fields if key not in cls.exclude}
+
+    @classmethod
+    def get_collection(cls, **options):
+        """
+        Return a reference to the database collection for the class, set to
+        the options scoped to the current context (see `with_options`) and the
+        given options. Operations on the collection are run in the session of
+        the current context (see `scopes.use_session`), and under the
+        collection's concurrency limit if `_limit_concurrency` is set.
+        """
+        scoped = scoped_options(cls)
+        if scoped:
+            options = {**scoped, **options}
+
+        # Handles are cached, options mostly come from a small set (class
+        # defaults, profiles and scopes) but per call options (e.g. a max
+        # staleness) may not
+        key = (cls._client, cls._db, options_key(options) if options else ())
+        collection = cls._handles.get(key)
+        if collection is not None:
+            cls._handles.move_to_end(key)
+        else:
+            collection = getattr(cls.get_db(), cls._collection)
+            if options:
+                collection = collection.with_options(**resolve_options(collection, options))
+            if cls._limit_concurrency:
+                collection = LimitedCollection(
+                    collection,
+                    get_limiter(collection.full_name, **cls._limiter_options)
+                )
+            cls._handles[key] = collection
+            if len(cls._handles) > HANDLES_CACHE_SIZE:
+                cls._handles.popitem(last=False)
+
+        session = current_session()
+        if session is not None and session.client is cls._client:
+            return SessionCollection(collection, session)
+        return collection
+
+    @classmethod
+    async def create_index(cls, keys, collated=False, **kwargs):
+        """
+        Create an index on the collection, collated indexes are created with the
+        class's collation so case insensitive conditions can use them.
+        """
+        if collated:
+            kwargs['collation'] = cls._collation
+        return await cls.get_collection().create_index(keys, **kwargs)
+
     @classmethod
     def get_db(cls):
         """Return the database for the collection"""
@@ -885,19 +1685,14 @@ class Frame(_BaseFrame, metaclass=_FrameMeta):
     @classmethod
     @contextmanager
     def with_options(cls, **options):
-        existing_context = getattr(cls, '_collection_context', None)
-
-        try:
-            collection = getattr(cls.get_db(), cls._collection)
-            cls._collection_context = collection.with_options(**options)
-            yield cls._collection_context
-
-        finally:
-            if existing_context is None:
-                del cls._collection_context
-
-            else:
-                cls._collection_context = existing_context
+        """
+        Run the operations of the class in the current context (the coroutine
+        and the tasks it starts) with collection options, e.g.
+        `write_concern='fast'`, and yield the collection. Concurrent requests
+        aren't affected.
+        """
+        with scope_options(cls, options):
+            yield cls.get_collection()
 
 
 class SubFrame(_BaseFrame):
@@ -0,0 +1,148 @@
+"""
+Hedged reads, for the tail latency added by slow replica set members.
+
+A hedged read sends a second attempt to another member when the first hasn't
+returned within a percentile of the recent latency of the frame's reads, and
+returns whichever attempt returns first (the other is cancelled):
+
+    class Dragon(Frame):
+        _hedge = True
+        _hedge_percentile = 95
+
+    await Dragon.one(Q.name == 'Burt', hedge=True)
+
+Only idempotent reads (`one` and its variants) are hedged, and not those run in
+a client session (a session can't run two operations at once). Hedges are
+limited by a budget shared by all frames (`hedge_budget`), hedges may only make
+up a ratio of the reads so a slow cluster isn't sent up to twice the load.
+"""
+
+import asyncio
+from collections import deque
+
+__all__ = (
+    'HedgeBudget',
+    'LatencyTracker',
+    'hedge_budget',
+    'hedged'
+    )
+
+
+class LatencyTracker(object):
+    """
+    The latencies (in seconds) of the last `size` reads of a frame class, the
+    latency at a percentile is computed once there are `min_samples` latencies
+    and recomputed every `refresh` reads.
+    """
+
+    def __init__(self, size=1000, refresh=50, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.refresh = refresh
+        self.min_samples = min_samples
+        self._percentiles = {}
+        self._recorded = 0
+
+    def record(self, latency):
+        """Record the latency of a read"""
+        self.samples.append(latency)
+        self._recorded += 1
+        if self._recorded >= self.refresh:
+            self._percentiles.clear()
+            self._recorded = 0
+
+    def percentile(self, percentile):
+        """Return the latency at a percentile, None until there are enough latencies"""
+        if len(self.samples) < self.min_samples:
+            return None
+        try:
+            return self._percentiles[percentile]
+        except KeyError:
+            pass
+
+        ordered = sorted(self.samples)
+        latency = ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+        self._percentiles[percentile] = latency
+        return latency
+
+
+class HedgeBudget(object):
+    """
+    The budget for hedges, each read earns `ratio` of a hedge (at most `burst`
+    hedges are saved) and each hedge spends one.
+    """
+
+    def __init__(self, ratio=0.05, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+        # Counts of the reads, the hedges sent (and denied by the budget) and
+        # the hedges that returned before the first attempt
+        self.reads = 0
+        self.hedges = 0
+        self.denied = 0
+        self.wins = 0
+
+    def earn(self):
+        """Earn a ratio of a hedge for a read"""
+        self.reads += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self):
+        """Return True if there's a hedge to spend (and spend it)"""
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+    def report(self):
+        """Return the counts of reads and hedges"""
+        return {
+            'reads': self.reads,
+            'hedges': self.hedges,
+            'denied': self.denied,
+            'wins': self.wins,
+            'tokens': round(self.tokens, 2)
+        }
+
+
+# The budget shared by all frames
+hedge_budget = HedgeBudget()
+
+
+async def hedged(first, second, delay, budget=hedge_budget):
+    """
+    Return the result of awaiting `first()`, or if it hasn't returned within
+    `delay` seconds (and the budget allows a hedge) of whichever of `first()`
+    and `second()` returns first. An attempt that raises is ignored while the
+    other may still return, if both raise the first attempt's error is raised.
+    No hedge is sent if `delay` is None.
+    """
+    budget.earn()
+    attempt = asyncio.ensure_future(first())
+    hedge = None
+    try:
+        if delay is None:
+            return await attempt
+
+        done, _ = await asyncio.wait({attempt}, timeout=delay)
+        if done or not budget.spend():
+            return await attempt
+
+        hedge = asyncio.ensure_future(second())
+        pending = {attempt, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        budget.wins += 1
+                    return task.result()
+        return attempt.result()
+
+    finally:
+        for task in (attempt, hedge):
+            if task is not None and not task.done():
+                task.cancel()
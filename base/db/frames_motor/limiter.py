@@ -0,0 +1,312 @@
+"""
+Adaptive concurrency limits for the operations on a collection.
+
+When a collection gets slow every request piles more concurrent operations
+onto it until the connection pool is exhausted and every collection stalls. A
+`ConcurrencyLimiter` caps the operations running at once on a collection and
+adapts the cap to the observed latency (AIMD): the limit grows by one for
+every `limit` operations completing at their usual latency and is cut by
+`backoff` when they run `tolerance` times slower (or fail with a timeout or
+network error). Operations over the limit wait in a queue, writes ahead of
+reads, and fail with `Overloaded` after `queue_timeout` seconds.
+
+Frames opt in with `_limit_concurrency`, one limiter is shared by the classes
+of a collection:
+
+    class Event(Frame):
+        _limit_concurrency = True
+        _limiter_options = {'initial': 20, 'max_limit': 100, 'queue_timeout': 0.5}
+
+`limiter_metrics()` returns the limit, operations running and queue depths of
+each collection's limiter.
+"""
+
+import asyncio
+import functools
+import time
+from collections import deque
+
+from pymongo.errors import AutoReconnect, ExecutionTimeout, WTimeoutError
+
+from base.rf.exceptions import Overloaded
+
+__all__ = (
+    'ConcurrencyLimiter',
+    'LimitedCollection',
+    'LimitedCursor',
+    'get_limiter',
+    'limiter_metrics'
+    )
+
+# The collection methods returning cursors, running operations and of those
+# the writes
+_CURSOR_METHODS = frozenset(['aggregate', 'aggregate_raw_batches', 'find', 'find_raw_batches', 'list_indexes'])
+_WRITE_METHODS = frozenset([
+    'bulk_write', 'delete_many', 'delete_one', 'find_one_and_delete', 'find_one_and_replace', 'find_one_and_update',
+    'insert_many', 'insert_one', 'replace_one', 'update_many', 'update_one'
+])
+_METHODS = _WRITE_METHODS | {'count_documents', 'distinct', 'estimated_document_count', 'find_one'}
+
+# The cursor methods returning the cursor (for chaining)
+_CURSOR_CHAIN = frozenset([
+    'add_option', 'allow_disk_use', 'batch_size', 'collation', 'comment', 'hint', 'limit', 'max', 'max_await_time_ms',
+    'max_time_ms', 'min', 'remove_option', 'skip', 'sort', 'where'
+])
+
+# The number of documents a limited cursor fetches at once unless given a
+# batch size (the server's default size of a first batch)
+_FETCH_SIZE = 101
+
+# Errors signalling an overloaded server
+_OVERLOAD_ERRORS = (AutoReconnect, ExecutionTimeout, WTimeoutError)
+
+# The limiters of each collection
+_limiters = {}
+
+
+class ConcurrencyLimiter(object):
+    """
+    An adaptive (AIMD) limit on the number of operations running at once, see
+    the module's documentation. The latency of each kind of operation (e.g.
+    `find_one`, `aggregate`) is compared to its own baseline, the lowest
+    latency observed drifting up by `drift` of the difference on each slower
+    operation so the baseline follows a lasting change in latency.
+    """
+
+    def __init__(self, initial=20, min_limit=2, max_limit=200, tolerance=2.0, backoff=0.9, drift=0.01,
+                 queue_timeout=1.0, max_queued=None):
+        assert min_limit <= initial <= max_limit, '`initial` must be between `min_limit` and `max_limit`'
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.drift = drift
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+
+        self.in_flight = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+        self._writes = deque()
+        self._reads = deque()
+        self._baselines = {}
+        self._last_decrease = 0
+
+    async def run(self, kind, write, func, *args, **kwargs):
+        """
+        Return the result of awaiting `func(*args, **kwargs)`, an operation of
+        a kind (the name its latency is tracked under), once under the limit.
+        """
+        await self.acquire(write)
+        start = time.perf_counter()
+        failed = cancelled = False
+        try:
+            return await func(*args, **kwargs)
+        except _OVERLOAD_ERRORS:
+            failed = True
+            raise
+        except asyncio.CancelledError:
+            # A cancelled operation (e.g. the slower attempt of a hedged read)
+            # says nothing of the latency
+            cancelled = True
+            raise
+        finally:
+            self.release(kind, None if cancelled else time.perf_counter() - start, failed)
+
+    async def acquire(self, write=False, timeout=None):
+        """
+        Wait for a slot under the limit, writes are given slots ahead of reads.
+        Raise `Overloaded` if no slot is given within `timeout` seconds (by
+        default `queue_timeout`) or the queue is full.
+        """
+        if self.in_flight < self.limit and not (self._writes or self._reads):
+            self.in_flight += 1
+            return
+
+        if self.max_queued is not None and len(self._writes) + len(self._reads) >= self.max_queued:
+            self.rejected += 1
+            raise Overloaded()
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._writes if write else self._reads
+        queue.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout if timeout is None else timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Given a slot as the wait was cancelled, pass it on
+                self.in_flight -= 1
+                self._wake()
+            else:
+                try:
+                    queue.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise Overloaded() from None
+            raise
+
+    def release(self, kind, latency=None, failed=False):
+        """
+        Release a slot, adapting the limit to the operation's latency (unless
+        None).
+        """
+        self.in_flight -= 1
+        if latency is not None:
+            self._adapt(kind, latency, failed)
+        self._wake()
+
+    def report(self):
+        """Return the limit, the operations running and the queue depths"""
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'queued_writes': len(self._writes),
+            'queued_reads': len(self._reads),
+            'timeouts': self.timeouts,
+            'rejected': self.rejected
+        }
+
+    # Private methods
+
+    def _adapt(self, kind, latency, failed):
+        """Adapt the limit to the latency of an operation"""
+        baseline = self._baselines.get(kind)
+        if baseline is None or latency < baseline:
+            self._baselines[kind] = latency
+        else:
+            self._baselines[kind] = baseline + (latency - baseline) * self.drift
+
+        if failed or (baseline is not None and latency > baseline * self.tolerance):
+            # Decrease at most once per round-trip, operations started before
+            # a decrease complete after it
+            now = time.monotonic()
+            if now - self._last_decrease > latency:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Only grow a limit that's being used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _wake(self):
+        """Give the free slots to the waiting operations"""
+        while self.in_flight < self.limit:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _next_waiter(self):
+        """Return the next waiting operation (writes first)"""
+        for queue in (self._writes, self._reads):
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    return waiter
+        return None
+
+
+class LimitedCollection(object):
+    """A collection whose operations are run under a concurrency limiter"""
+
+    __slots__ = ('collection', 'limiter')
+
+    def __init__(self, collection, limiter):
+        self.collection = collection
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name in _METHODS:
+            return functools.partial(self.limiter.run, name, name in _WRITE_METHODS, attr)
+        if name in _CURSOR_METHODS:
+            return functools.partial(_limited_cursor, name, attr, self.limiter)
+        return attr
+
+    def with_options(self, **options):
+        return LimitedCollection(self.collection.with_options(**options), self.limiter)
+
+
+class LimitedCursor(object):
+    """
+    A cursor whose documents are fetched in batches (of the cursor's batch
+    size) under a concurrency limiter, documents already fetched are returned
+    without waiting for a slot.
+    """
+
+    __slots__ = ('cursor', 'documents', 'fetch_size', 'kind', 'limiter')
+
+    def __init__(self, cursor, kind, limiter):
+        self.cursor = cursor
+        self.kind = kind
+        self.limiter = limiter
+        self.documents = deque()
+        self.fetch_size = _FETCH_SIZE
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if name in _CURSOR_CHAIN:
+            def chain(*args, **kwargs):
+                attr(*args, **kwargs)
+                return self
+            return chain
+        return attr
+
+    def __aiter__(self):
+        return self
+
+    @property
+    def alive(self):
+        return bool(self.documents) or self.cursor.alive
+
+    def batch_size(self, batch_size):
+        self.cursor.batch_size(batch_size)
+        self.fetch_size = batch_size or _FETCH_SIZE
+        return self
+
+    async def next(self):
+        if not self.documents:
+            self.documents.extend(await self.limiter.run(self.kind, False, self.cursor.to_list, self.fetch_size))
+            if not self.documents:
+                raise StopAsyncIteration
+        return self.documents.popleft()
+
+    __anext__ = next
+
+    async def to_list(self, length=None):
+        documents = []
+        while self.documents and (length is None or len(documents) < length):
+            documents.append(self.documents.popleft())
+        if length is None or len(documents) < length:
+            documents += await self.limiter.run(
+                self.kind,
+                False,
+                self.cursor.to_list,
+                None if length is None else length - len(documents)
+            )
+        return documents
+
+
+def get_limiter(name, **options):
+    """Return the limiter for a collection, created with the given options"""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = _limiters[name] = ConcurrencyLimiter(**options)
+    return limiter
+
+
+def limiter_metrics():
+    """Return the metrics (see `ConcurrencyLimiter.report`) of each collection's limiter"""
+    return {name: limiter.report() for name, limiter in _limiters.items()}
+
+
+# Private functions
+
+def _limited_cursor(kind, method, limiter, *args, **kwargs):
+    """Return a cursor returned by a collection method as a limited cursor"""
+    return LimitedCursor(method(*args, **kwargs), kind, limiter)
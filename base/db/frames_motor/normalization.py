@@ -0,0 +1,164 @@
+"""
+Normalization of pymongo filters against the fields declared on a frame.
+
+Filters built from request data often compare fields with values of the wrong
+type (a string id against an `ObjectIdField`, an ISO string against a
+`DateField`...), such comparisons never match an index entry of the right BSON
+type. Normalizing casts those values to the stored type, sorts keys into a
+canonical order and merges `$and` conditions on the same field into a single
+range predicate.
+
+Encrypted fields are encrypted with a random IV, the same value is never
+encrypted the same way twice, so comparing them with a value is refused
+rather than silently matching nothing.
+"""
+
+from base.db.fields import ArrayField, EncryptedField
+from base.db.frames_motor.paths import element_field, is_operators, resolve_field, sub_fields
+
+__all__ = (
+    'normalize_filter',
+    )
+
+# Operators whose value is compared with the field's value
+COMPARISON_OPERATORS = frozenset(['$eq', '$ne', '$gt', '$gte', '$lt', '$lte'])
+
+# Operators whose value is a list of values compared with the field's value
+LIST_OPERATORS = frozenset(['$in', '$nin', '$all'])
+
+# Operators grouping a list of filters
+LOGICAL_OPERATORS = frozenset(['$and', '$or', '$nor'])
+
+
+def normalize_filter(filter, fields, casts=None):
+    """
+    Return a normalized copy of a pymongo filter for a frame with the given
+    fields (a dictionary of name to `Field`). If a `casts` list is given each
+    cast value is appended to it as a `(path, original, cast)` tuple.
+
+    A filter that isn't a dictionary is treated as an `_id` (as pymongo's
+    `find_one` does).
+    """
+    if filter is None:
+        return filter
+    if not isinstance(filter, dict):
+        filter = {'_id': filter}
+    return _normalize(filter, fields, casts, '')
+
+
+# Private functions
+
+def _normalize(filter, fields, casts, prefix):
+    """Normalize a filter (the keys of which are paths or logical operators)"""
+    normalized = {}
+    for key in sorted(filter):
+        value = filter[key]
+
+        if key in LOGICAL_OPERATORS and isinstance(value, (list, tuple)):
+            value = [
+                _normalize(f, fields, casts, prefix) if isinstance(f, dict) else f
+                for f in value
+            ]
+
+        elif not key.startswith('$'):
+            field = resolve_field(fields, key)
+            if field is not None:
+                value = _normalize_condition(field, value, casts, prefix + key)
+
+        normalized[key] = value
+
+    if isinstance(normalized.get('$and'), list):
+        _merge_and(normalized)
+        normalized = {k: normalized[k] for k in sorted(normalized)}
+
+    return normalized
+
+
+def _normalize_condition(field, value, casts, path):
+    """Normalize the condition (value or operators) for a field"""
+    if not is_operators(value):
+        return _cast(field, value, casts, path)
+
+    normalized = {}
+    for operator in sorted(value):
+        operand = value[operator]
+
+        if operator in COMPARISON_OPERATORS:
+            operand = _cast(field, operand, casts, path)
+
+        elif operator in LIST_OPERATORS and isinstance(operand, (list, tuple)):
+            operand = [_cast(field, v, casts, path) for v in operand]
+
+        elif operator == '$not' and is_operators(operand):
+            operand = _normalize_condition(field, operand, casts, path)
+
+        elif operator == '$elemMatch' and isinstance(operand, dict):
+            if is_operators(operand):
+                element = element_field(field)
+                if element is not None:
+                    operand = _normalize_condition(element, operand, casts, path)
+            else:
+                fields = sub_fields(field)
+                if fields is not None:
+                    operand = _normalize(operand, fields, casts, path + '.')
+
+        normalized[operator] = operand
+    return normalized
+
+
+def _cast(field, value, casts, path):
+    """Cast a value compared with a field to the type stored for the field"""
+    if isinstance(field, ArrayField):
+        element = element_field(field)
+        if element is None:
+            return value
+
+        # A list is compared with the whole array, anything else with its
+        # elements.
+        if isinstance(value, list):
+            return [_cast(element, v, casts, path) for v in value]
+        return _cast(element, value, casts, path)
+
+    if isinstance(field, EncryptedField) and value is not None:
+        raise ValueError(
+            '`{0}` is encrypted (with a random IV), it can\'t be compared with a value'.format(path)
+        )
+
+    cast = field.get_prep_value(value)
+    if casts is not None and (cast is not value and type(cast) is not type(value)):
+        casts.append((path, value, cast))
+    return cast
+
+
+def _merge_and(filter):
+    """
+    Merge the conditions of an `$and` into the filter where they don't clash
+    with an existing condition, so conditions on the same field become a
+    single (range) predicate.
+    """
+    remaining = []
+    for condition in filter.pop('$and'):
+        if not isinstance(condition, dict):
+            remaining.append(condition)
+            continue
+
+        for key, value in condition.items():
+            existing = filter.get(key, None)
+            if key == '$and' and isinstance(value, list):
+                remaining.extend(value)
+            elif key not in filter:
+                filter[key] = value
+            elif (
+                    not key.startswith('$')
+                    and is_operators(existing)
+                    and is_operators(value)
+                    and not set(existing).intersection(value)
+            ):
+                merged = dict(existing)
+                merged.update(value)
+                filter[key] = {k: merged[k] for k in sorted(merged)}
+            else:
+                remaining.append({key: value})
+
+    if remaining:
+        filter['$and'] = remaining
@@ -5,7 +5,7 @@ Support for paginating frames.
 from copy import deepcopy
 import math
 
-from base.db import Condition, Group, to_refs
+from base.db.frames_motor.queries import Condition, Group, to_refs
 
 
 __all__ = (
@@ -93,6 +93,16 @@ class Paginator(object):
     """
     A pagination class for slicing query results into pages. This class is
     designed to work with Frame classes.
+
+    The paginator must be awaited (to count the results) before it's used,
+    pages are awaited (`paginator[n]` returns a coroutine) and iterated with
+    `async for`, for example:
+
+        paginator = await Paginator(MyFrame, Q.active == True, by_creation=DESCENDING)
+        page = await paginator[1]
+        async for page in paginator:
+            ...
+
     """
 
     def __init__(
@@ -101,6 +111,7 @@ class Paginator(object):
             filter=None,
             per_page=20,
             orphans=0,
+            by_creation=None,
             **filter_args
             ):
 
@@ -108,9 +119,11 @@ class Paginator(object):
         self._frame_cls = frame_cls
 
         # The filter applied when selecting results from the database (we
-        # flattern the filter at this point which effectively deep copies.
+        # flattern raw filters at this point which effectively deep copies,
+        # conditions and groups are immutable and kept so the frame can see
+        # which options (e.g collation) they must be run with.
         if isinstance(filter, (Condition, Group)):
-            self._filter = filter.to_dict()
+            self._filter = filter
         else:
             self._filter = to_refs(filter)
 
@@ -118,6 +131,13 @@ class Paginator(object):
         # sort and projection,
         self._filter_args = filter_args
 
+        # Documents can be ordered by their creation time (ASCENDING or
+        # DESCENDING) using the timestamp encoded in their `_id`, which avoids
+        # a separate creation date field and index.
+        if by_creation is not None:
+            assert 'sort' not in filter_args, '`by_creation` and `sort` can\'t both be given'
+            self._filter_args['sort'] = [('_id', by_creation)]
+
         # The number of results that will be displayed per page
         self._per_page = per_page
 
@@ -127,17 +147,29 @@ class Paginator(object):
         # results.
         self._orphans = orphans
 
+        # The total results, number of pages and the page numbers that can be
+        # used to navigate the results are set when the paginator is awaited.
+        self._items_count = None
+        self._page_count = None
+        self._page_numbers = None
+
+    def __await__(self):
+        return self._count().__await__()
+
+    async def _count(self):
         # Count the total results being paginated
-        self._items_count = frame_cls.count(self._filter)
+        self._items_count = await self._frame_cls.count_by_filter(self._filter)
 
         # Calculated the number of pages
-        total = self._items_count - orphans
+        total = self._items_count - self._orphans
         self._page_count = max(1, int(math.ceil(total / float(self._per_page))))
 
         # Create a list of page number that can be used to navigate the results
         self._page_numbers = range(1, self._page_count + 1)
 
-    def __getitem__(self, page_number):
+        return self
+
+    async def __getitem__(self, page_number):
         if page_number not in self._page_numbers:
             raise InvalidPage(page_number, self.page_count)
 
@@ -155,7 +187,7 @@ class Paginator(object):
             filter_args['limit'] += self.orphans
 
         # Select the results for the page
-        items = self._frame_cls.many(self._filter, **filter_args)
+        items = await self._frame_cls.many(self._filter, **filter_args)
 
         # Build the page
         return Page(
@@ -166,9 +198,9 @@ class Paginator(object):
             prev=prev
             )
 
-    def __iter__(self):
+    async def __aiter__(self):
         for page_number in self._page_numbers:
-            yield self[page_number]
+            yield await self[page_number]
 
     # Read-only properties
 
@@ -0,0 +1,104 @@
+"""
+Paths into documents and the fields they resolve to.
+
+Paths are dot separated (e.g. `'stats.kills'` or `Q.stats.kills`), array
+indexes and positional operators (`'log.0.date'`, `'log.$.date'`) address an
+element of the array they follow. The helpers here are shared by the modules
+translating, normalizing, compiling and splitting queries and updates.
+"""
+
+from collections.abc import Mapping
+
+from base.db.fields import ArrayField, EmbeddedField, Field
+from base.db.frames_motor.queries import Q
+
+__all__ = (
+    'element_field',
+    'get_path',
+    'is_operators',
+    'is_positional',
+    'resolve_field',
+    'sub_fields',
+    'to_path'
+    )
+
+
+def to_path(path):
+    """Return the path for a `Q` or path"""
+    if isinstance(path, Q):
+        return path._path
+    return path
+
+
+def is_positional(part):
+    """Return True if a path part addresses an element of an array"""
+    return part.isdigit() or part.startswith('$')
+
+
+def is_operators(value):
+    """Return True if the value is a dictionary of (query or update) operators"""
+    return isinstance(value, dict) and bool(value) and all(
+        isinstance(k, str) and k.startswith('$') for k in value
+    )
+
+
+def get_path(document, path):
+    """
+    Return the value at a (dot separated) path in a document (or frame), None
+    if the path is missing.
+    """
+    value = document
+    for key in path.split('.'):
+        if isinstance(value, Mapping):
+            value = value.get(key)
+        elif isinstance(value, (list, tuple)) and key.isdigit():
+            index = int(key)
+            value = value[index] if index < len(value) else None
+        elif value is not None:
+            value = getattr(value, key, None)
+        if value is None:
+            return None
+    return value
+
+
+def sub_fields(field):
+    """Return the fields of the documents embedded in the given field"""
+    if isinstance(field, ArrayField):
+        field = field.to
+    if isinstance(field, EmbeddedField):
+        return getattr(field.to, '_fields', None)
+    return None
+
+
+def element_field(field):
+    """Return the field used for elements of the given field"""
+    if isinstance(field, ArrayField):
+        return field.to if isinstance(field.to, Field) else None
+    return field
+
+
+def resolve_field(fields, path):
+    """
+    Return the field for a (dot separated) path or None if the path can't be
+    resolved against the given fields (a dictionary of name to `Field`).
+    """
+    field = None
+    for part in path.split('.'):
+
+        # Array indexes and positional operators address an element of the
+        # array we're already in.
+        if field is not None and is_positional(part):
+            if not isinstance(field, ArrayField):
+                return None
+            continue
+
+        if field is not None:
+            fields = sub_fields(field)
+            if fields is None:
+                return None
+
+        field = fields.get(part)
+        if not isinstance(field, Field):
+            return None
+
+    return field
@@ -3,11 +3,17 @@ A set of helpers to simplify the creation of MongoDB queries.
 """
 
 import re
+from bson import ObjectId
+from functools import lru_cache
 from pymongo import (ASCENDING, DESCENDING)
 
 __all__ = [
     # Queries
     'Q',
+    'Param',
+
+    # Expressions
+    'Expr',
 
     # Operators
     'All',
@@ -19,6 +25,16 @@ __all__ = [
     'Size',
     'Type',
 
+    # Text operators
+    'IEquals',
+    'IStartsWith',
+    'StartsWith',
+
+    # Creation time operators
+    'CreatedAfter',
+    'CreatedBefore',
+    'CreatedBetween',
+
     # Groups
     'And',
     'Or',
@@ -28,29 +44,187 @@ __all__ = [
     'SortBy',
 
     # Utils
+    'compile_filter',
+    'requires_collation',
+    'to_expression',
+    'to_filter',
     'to_refs'
 ]
 
+# The maximum number of compiled filters cached by `compile_filter`
+COMPILE_CACHE_SIZE = 1024
+
+# The maximum number of values a condition or group may hold to be cached,
+# freezing larger values (e.g. a long `$in` list) for a cache key costs about
+# as much as compiling them and the cache would keep them alive
+COMPILE_CACHE_MAX_VALUES = 64
+
+
+# Expressions
+
+class ExpressionOperators:
+    """
+    Arithmetic operators building aggregation expressions from `Q` paths and
+    expressions, for example:
+
+        Q.price * Q.qty
+    """
+
+    __slots__ = ()
+
+    def __add__(self, other):
+        return Expr('$add', self, other)
+
+    def __radd__(self, other):
+        return Expr('$add', other, self)
+
+    def __sub__(self, other):
+        return Expr('$subtract', self, other)
+
+    def __rsub__(self, other):
+        return Expr('$subtract', other, self)
+
+    def __mul__(self, other):
+        return Expr('$multiply', self, other)
+
+    def __rmul__(self, other):
+        return Expr('$multiply', other, self)
+
+    def __truediv__(self, other):
+        return Expr('$divide', self, other)
+
+    def __rtruediv__(self, other):
+        return Expr('$divide', other, self)
+
+    def __mod__(self, other):
+        return Expr('$mod', self, other)
+
+    def __rmod__(self, other):
+        return Expr('$mod', other, self)
+
+
+class Expr(ExpressionOperators):
+    """
+    An aggregation expression, an operator applied to a list of arguments
+    (`Q` paths, expressions or values), for example:
+
+        Expr('$round', Q.price * Q.qty, 2)
+
+    Expressions are used to compute values server-side (e.g. in pipeline
+    updates, see `updates.Set`).
+    """
+
+    __slots__ = ('operator', 'args')
+
+    def __init__(self, operator, *args):
+        object.__setattr__(self, 'operator', operator)
+        object.__setattr__(self, 'args', args)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Expressions are immutable')
+
+    def __reduce__(self):
+        return Expr, (self.operator,) + self.args
+
+    def __repr__(self):
+        return '<Expr {0} {1!r}>'.format(self.operator, list(self.args))
+
+    def to_expression(self):
+        """Return the expression as a MongoDB aggregation expression"""
+        args = [to_expression(a) for a in self.args]
+        return {self.operator: args[0] if len(args) == 1 else args}
+
 
 # Queries
 
 class Condition:
     """
     A query condition of the form `{path: {operator: value}}`.
+
+    Conditions are immutable and hash/compare by their structure so they can
+    be used as cache keys, the pymongo filter they compile to is cached.
+
+    Collated conditions compare strings case insensitively and must be run
+    with the collation of the frame (see `Frame._collation`).
     """
 
-    def __init__(self, q, value, operator):
-        self.q = q
-        self.value = value
-        self.operator = operator
+    __slots__ = ('q', 'value', 'operator', 'collated', '_key')
+
+    def __init__(self, q, value, operator, collated=False):
+        object.__setattr__(self, 'q', q)
+        object.__setattr__(self, 'value', value)
+        object.__setattr__(self, 'operator', operator)
+        object.__setattr__(self, 'collated', collated)
+        object.__setattr__(self, '_key', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Conditions are immutable')
+
+    def __reduce__(self):
+        return Condition, (self.q, self.value, self.operator, self.collated)
+
+    def __eq__(self, other):
+        if not isinstance(other, Condition):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '<Condition {0!r} {1} {2!r}>'.format(self.q, self.operator, self.value)
+
+    @property
+    def key(self):
+        """Return a hashable representation of the condition's structure"""
+        if self._key is None:
+            object.__setattr__(
+                self,
+                '_key',
+                (self.q, self.operator, self.collated, _freeze(self.value))
+            )
+        return self._key
+
+    def bind(self, **params):
+        """Return the filter for this condition with `Param` values bound"""
+        return _bind(self, params)
 
     def to_dict(self):
         """Return a dictionary suitable for use with pymongo as a filter"""
-        if self.operator == '$eq':
-            return {self.q: self.value}
-        if self.q is None:
-            return {self.operator: self.value}
-        return {self.q: {self.operator: self.value}}
+        return _copy(compile_filter(self)[0])
+
+
+class Param:
+    """
+    A placeholder for a value supplied when a query is bound, allowing a query
+    template to be compiled once and bound per call, for example:
+
+        by_workspace = Q.workspace == Param('ws')
+        by_workspace.bind(ws=workspace_id)
+
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Params are immutable')
+
+    def __reduce__(self):
+        return Param, (self.name,)
+
+    def __eq__(self, other):
+        if not isinstance(other, Param):
+            return NotImplemented
+        return self.name == other.name
+
+    def __hash__(self):
+        return hash((Param, self.name))
+
+    def __repr__(self):
+        return 'Param({0!r})'.format(self.name)
 
 
 class QMeta(type):
@@ -59,6 +233,8 @@ class QMeta(type):
     """
 
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
         return Q(name)
 
     def __getitem__(self, name):
@@ -82,18 +258,33 @@ class QMeta(type):
     def __ne__(self, other):
         return Condition(None, other, '$ne')
 
+    __hash__ = type.__hash__
+
 
-class Q(metaclass=QMeta):
+class Q(ExpressionOperators, metaclass=QMeta):
     """
     Start point for the query creation, the Q class is a special type of class
     that's typically initialized by appending an attribute, for example:
 
         Q.hit_points > 100
 
+    Q instances are immutable, appending an attribute returns a new instance.
+    Arithmetic on Q instances builds expressions (see `Expr`).
     """
 
+    __slots__ = ('_path',)
+
     def __init__(self, path):
-        self._path = path
+        object.__setattr__(self, '_path', path)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Q paths are immutable')
+
+    def __reduce__(self):
+        return Q, (self._path,)
+
+    def __repr__(self):
+        return 'Q({0!r})'.format(self._path)
 
     def __eq__(self, other):
         return Condition(self._path, other, '$eq')
@@ -114,12 +305,35 @@ class Q(metaclass=QMeta):
         return Condition(self._path, other, '$ne')
 
     def __getattr__(self, name):
-        self._path = '{0}.{1}'.format(self._path, name)
-        return self
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Q('{0}.{1}'.format(self._path, name))
 
     def __getitem__(self, name):
-        self._path = '{0}.{1}'.format(self._path, name)
-        return self
+        return Q('{0}.{1}'.format(self._path, name))
+
+    # ObjectId creation time helpers
+
+    def created_after(self, dt):
+        """
+        Select documents where the ObjectId at this path was created at or after
+        the given datetime (see `CreatedAfter`).
+        """
+        return CreatedAfter(dt, self)
+
+    def created_before(self, dt):
+        """
+        Select documents where the ObjectId at this path was created before the
+        given datetime (see `CreatedBefore`).
+        """
+        return CreatedBefore(dt, self)
+
+    def created_between(self, start, end):
+        """
+        Select documents where the ObjectId at this path was created in the
+        given range (see `CreatedBetween`).
+        """
+        return CreatedBetween(start, end, self)
 
 
 # Operators
@@ -174,7 +388,8 @@ def Not(condition):
     return Condition(
         condition.q,
         {condition.operator: condition.value},
-        '$not'
+        '$not',
+        condition.collated
     )
 
 
@@ -202,6 +417,81 @@ def Type(q, value):
     return Condition(q._path, value, '$type')
 
 
+# Text operators
+
+def StartsWith(q, prefix, as_range=False):
+    """
+    The StartsWith operator selects documents where the value of the field
+    starts with the given prefix. By default it compiles to an anchored regular
+    expression (which MongoDB turns into tight index bounds), with `as_range`
+    it compiles to the equivalent `$gte`/`$lt` range.
+    """
+    if not as_range:
+        return Condition(q._path, '^' + re.escape(prefix), '$regex')
+
+    upper = _successor(prefix)
+    if upper is None:
+        return Condition(q._path, prefix, '$gte')
+    return And(
+        Condition(q._path, prefix, '$gte'),
+        Condition(q._path, upper, '$lt')
+    )
+
+
+def IEquals(q, value):
+    """
+    The IEquals operator selects documents where the value of the field equals
+    the given value ignoring case. Rather than an (unindexable) `/i` regular
+    expression it's run with the frame's collation so it can use an index
+    built with the same collation.
+    """
+    return Condition(q._path, value, '$eq', True)
+
+
+def IStartsWith(q, prefix):
+    """
+    The IStartsWith operator selects documents where the value of the field
+    starts with the given prefix ignoring case. It compiles to a range run with
+    the frame's collation, U+FFFF has the highest primary weight in collations
+    so it bounds every string starting with the prefix.
+    """
+    return And(
+        Condition(q._path, prefix, '$gte', True),
+        Condition(q._path, prefix + '\uffff', '$lt', True)
+    )
+
+
+# Creation time operators
+
+def CreatedAfter(dt, q=None):
+    """
+    The CreatedAfter operator selects documents created at or after the given
+    datetime using the timestamp encoded in their `_id` (or the ObjectId at the
+    path `q`), so no separate creation date field or index is needed. Naive
+    datetimes are taken as UTC and ObjectIds have a precision of one second.
+    """
+    q = Q._id if q is None else q
+    return Condition(q._path, ObjectId.from_datetime(dt), '$gte')
+
+
+def CreatedBefore(dt, q=None):
+    """
+    The CreatedBefore operator selects documents created before the given
+    datetime using the timestamp encoded in their `_id` (see `CreatedAfter`).
+    """
+    q = Q._id if q is None else q
+    return Condition(q._path, ObjectId.from_datetime(dt), '$lt')
+
+
+def CreatedBetween(start, end, q=None):
+    """
+    The CreatedBetween operator selects documents created at or after `start`
+    and before `end` using the timestamp encoded in their `_id` (see
+    `CreatedAfter`).
+    """
+    return And(CreatedAfter(start, q), CreatedBefore(end, q))
+
+
 # Groups
 
 class Group:
@@ -210,20 +500,64 @@ class Group:
     two or more conditions.
     """
 
+    __slots__ = ('conditions', '_key', '_collated')
+
     operator = ''
 
     def __init__(self, *conditions):
-        self.conditions = conditions
+        object.__setattr__(self, 'conditions', conditions)
+        object.__setattr__(self, '_key', None)
+        object.__setattr__(self, '_collated', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Groups are immutable')
+
+    def __reduce__(self):
+        return self.__class__, self.conditions
+
+    def __eq__(self, other):
+        if not isinstance(other, Group):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(self.__class__.__name__, list(self.conditions))
+
+    @property
+    def key(self):
+        """Return a hashable representation of the group's structure"""
+        if self._key is None:
+            object.__setattr__(
+                self,
+                '_key',
+                (self.operator, tuple(_freeze(c) for c in self.conditions))
+            )
+        return self._key
+
+    @property
+    def collated(self):
+        """Return True if any of the group's conditions are collated"""
+        if self._collated is None:
+            object.__setattr__(
+                self,
+                '_collated',
+                any(
+                    c.collated for c in self.conditions
+                    if isinstance(c, (Condition, Group))
+                )
+            )
+        return self._collated
+
+    def bind(self, **params):
+        """Return the filter for this group with `Param` values bound"""
+        return _bind(self, params)
 
     def to_dict(self):
         """Return a dictionary suitable for use with pymongo as a filter"""
-        raw_conditions = []
-        for condition in self.conditions:
-            if isinstance(condition, (Condition, Group)):
-                raw_conditions.append(condition.to_dict())
-            else:
-                raw_conditions.append(condition)
-        return {self.operator: raw_conditions}
+        return _copy(compile_filter(self)[0])
 
 
 class And(Group):
@@ -232,6 +566,8 @@ class And(Group):
     selects the documents that satisfy all the conditions.
     """
 
+    __slots__ = ()
+
     operator = '$and'
 
 
@@ -242,6 +578,8 @@ class Or(Group):
     conditions.
     """
 
+    __slots__ = ()
+
     operator = '$or'
 
 
@@ -251,6 +589,8 @@ class Nor(Group):
     selects the documents that fail all the conditions.
     """
 
+    __slots__ = ()
+
     operator = '$nor'
 
 
@@ -311,3 +651,203 @@ def to_refs(value):
         return {k: to_refs(v) for k, v in value.items()}
 
     return value
+
+
+def to_expression(value):
+    """
+    Return a value as an aggregation expression, `Q` instances become field
+    paths and strings that would be read as a field path are made literal.
+    Dictionaries are taken to be raw expressions and returned as is.
+    """
+
+    # Paths
+    if isinstance(value, Q):
+        return '$' + value._path
+
+    # Expressions
+    elif isinstance(value, Expr):
+        return value.to_expression()
+
+    # Strings
+    elif isinstance(value, str) and value.startswith('$'):
+        return {'$literal': value}
+
+    # Lists
+    elif isinstance(value, (list, tuple)):
+        return [to_expression(v) for v in value]
+
+    # Raw expressions
+    elif isinstance(value, dict):
+        return value
+
+    return to_refs(value)
+
+
+def requires_collation(filter):
+    """Return True if the filter must be run with the frame's collation"""
+    return isinstance(filter, (Condition, Group)) and filter.collated
+
+
+def to_filter(filter, **params):
+    """
+    Return a pymongo filter for the given condition, group or raw filter,
+    binding any `Param` values. Filters compiled from conditions and groups are
+    shared with the compilation cache and must not be mutated.
+    """
+    if isinstance(filter, (Condition, Group)):
+        return _bind(filter, params)
+    return filter
+
+
+def compile_filter(node):
+    """
+    Return the pymongo filter for a condition or group and whether it contains
+    `Param` values that must be bound before use. Results are cached by the
+    node's structure and shared, so they must not be mutated. Nodes holding
+    more than `COMPILE_CACHE_MAX_VALUES` values aren't cached (bind a `Param`
+    to a long list instead).
+    """
+    if _count_values(node, COMPILE_CACHE_MAX_VALUES) > COMPILE_CACHE_MAX_VALUES:
+        return _compile(node)
+    try:
+        return _compile_cached(node)
+    except TypeError:
+        # The node holds an unhashable value so it can't be cached
+        return _compile(node)
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_cached(node):
+    return _compile(node)
+
+
+def _compile(node):
+    """Compile a condition or group to a pymongo filter"""
+
+    # Condition
+    if isinstance(node, Condition):
+        value = to_refs(node.value)
+        has_params = _has_params(value)
+        if node.operator == '$eq':
+            return {node.q: value}, has_params
+        if node.q is None:
+            return {node.operator: value}, has_params
+        return {node.q: {node.operator: value}}, has_params
+
+    # Group
+    raw_conditions = []
+    has_params = False
+    for condition in node.conditions:
+        if isinstance(condition, (Condition, Group)):
+            condition, condition_params = compile_filter(condition)
+        else:
+            condition_params = _has_params(condition)
+        raw_conditions.append(condition)
+        has_params = has_params or condition_params
+    return {node.operator: raw_conditions}, has_params
+
+
+def _bind(node, params):
+    """Return the compiled filter for a node with `Param` values bound"""
+    filter, has_params = compile_filter(node)
+    if not has_params:
+        return filter
+    return _substitute(filter, params)
+
+
+def _substitute(value, params):
+    """Return a copy of a compiled value with `Param` values replaced"""
+
+    # Params
+    if isinstance(value, Param):
+        if value.name not in params:
+            raise KeyError('No value bound for {0!r}'.format(value))
+        return to_refs(params[value.name])
+
+    # Lists
+    elif isinstance(value, (list, tuple)):
+        return [_substitute(v, params) for v in value]
+
+    # Dictionaries
+    elif isinstance(value, dict):
+        return {k: _substitute(v, params) for k, v in value.items()}
+
+    return value
+
+
+def _has_params(value):
+    """Return True if the given value contains a `Param`"""
+    if isinstance(value, Param):
+        return True
+    elif isinstance(value, (list, tuple)):
+        return any(_has_params(v) for v in value)
+    elif isinstance(value, dict):
+        return any(_has_params(v) for v in value.values())
+    return False
+
+
+def _count_values(value, limit):
+    """
+    Return the number of values held by a condition, group or query value,
+    counting stops once past `limit`.
+    """
+    if isinstance(value, Condition):
+        return _count_values(value.value, limit)
+    elif isinstance(value, Group):
+        value = value.conditions
+    elif isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, (list, tuple)):
+        return 1
+
+    count = 0
+    for v in value:
+        count += _count_values(v, limit - count)
+        if count > limit:
+            break
+    return count
+
+
+def _freeze(value):
+    """Return a hashable representation of a query value"""
+
+    # Conditions and groups
+    if isinstance(value, (Condition, Group)):
+        return value.key
+
+    # Lists
+    elif isinstance(value, (list, tuple)):
+        return list, tuple(_freeze(v) for v in value)
+
+    # Dictionaries (key order is significant to MongoDB)
+    elif isinstance(value, dict):
+        return dict, tuple((k, _freeze(v)) for k, v in value.items())
+
+    # The type is kept so that values which compare equal but are stored
+    # differently by MongoDB (e.g `1` and `True`) don't share a key.
+    return type(value), value
+
+
+def _copy(value):
+    """Return a copy of a compiled filter that is safe to mutate"""
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    return value
+
+
+def _successor(prefix):
+    """
+    Return the smallest string greater than every string starting with the
+    prefix (in binary/code point order) or None if there isn't one.
+    """
+    chars = list(prefix)
+    while chars:
+        code = ord(chars.pop()) + 1
+        if code == 0xD800:
+            # Surrogates can't be encoded as UTF-8
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return ''.join(chars) + chr(code)
+    return None
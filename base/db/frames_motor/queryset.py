@@ -0,0 +1,299 @@
+"""
+Lazy, chainable queries against a frame class, for example:
+
+    frames = await Dragon.query().filter(Q.level > 10).sort(Q.name).limit(20)
+
+    async for dragon in Dragon.query().filter(Q.breed == 'red'):
+        ...
+
+Nothing is sent to the database until the query set is awaited, iterated or
+one of its terminal methods (`exists`, `first`, `count`, `values_list`,
+`in_bulk`) is called.
+
+Query sets projected with `only` or `defer` return partial frames, reading a
+field that wasn't loaded raises a `DeferredFieldError` until the missing fields
+are loaded with `await frame.load_deferred()` (which loads them for every
+partial frame from the same query at once). Saving a partial frame never writes
+the fields that weren't loaded.
+"""
+
+from pymongo import ASCENDING, DESCENDING
+
+from base.db.frames_motor.paths import get_path, to_path
+from base.db.frames_motor.queries import And, In, Q, SortBy
+
+__all__ = (
+    # Exceptions
+    'DeferredFieldError',
+
+    # Classes
+    'QuerySet',
+
+    # Functions
+    'load_deferred'
+    )
+
+
+class DeferredFieldError(Exception):
+    """
+    An error raised when reading a field that wasn't loaded with a partial
+    frame.
+    """
+
+
+class QuerySet(object):
+    """
+    A lazy query against a frame class. Query sets are immutable, each chained
+    method returns a new query set.
+    """
+
+    def __init__(self, frame_cls):
+
+        # The frame class the query is run against
+        self._frame_cls = frame_cls
+
+        # The conditions, groups or raw filters the documents must all match
+        self._conditions = ()
+
+        # A list of sort instructions
+        self._sort = None
+
+        # The paths to project documents to (all fields if None)
+        self._only = None
+
+        # The paths to exclude from documents
+        self._defer = ()
+
+        self._skip = 0
+        self._limit = 0
+
+        # Flag indicating if frames should be returned in the order of the
+        # filter's `$in` list
+        self._preserve_order = False
+
+    def __repr__(self):
+        return '<QuerySet {0} {1!r}>'.format(
+            self._frame_cls.__name__,
+            self.get_filter()
+        )
+
+    def __await__(self):
+        return self._fetch().__await__()
+
+    async def __aiter__(self):
+        partial_frames = []
+        async for document in self._cursor():
+            yield self._to_frame(document, partial_frames)
+
+    # Chaining
+
+    def filter(self, *conditions, **values):
+        """
+        Return a query set further filtered by the given conditions (conditions,
+        groups or raw filters) and field values.
+        """
+        conditions += tuple(Q[k] == v for k, v in values.items())
+        return self._clone(_conditions=self._conditions + conditions)
+
+    def sort(self, *keys):
+        """
+        Return a query set sorted by the given keys, each key can be a `Q`
+        (`Q.name.desc` for descending), a path (`-name` for descending) or a
+        `(path, direction)` tuple.
+        """
+        sort = []
+        for key in keys:
+            if isinstance(key, Q):
+                sort.extend(SortBy(key))
+            elif isinstance(key, str):
+                if key.startswith('-'):
+                    sort.append((key[1:], DESCENDING))
+                else:
+                    sort.append((key, ASCENDING))
+            else:
+                sort.append(tuple(key))
+        return self._clone(_sort=sort or None)
+
+    def only(self, *paths):
+        """Return a query set that only loads the given paths (or `Q`s)"""
+        return self._clone(_only=tuple(to_path(p) for p in paths) or None)
+
+    def defer(self, *paths):
+        """Return a query set that doesn't load the given paths (or `Q`s)"""
+        paths = tuple(to_path(p) for p in paths)
+        return self._clone(_defer=self._defer + paths)
+
+    def preserve_order(self):
+        """
+        Return a query set returning frames in the order of the values in its
+        `$in` condition (e.g. `In(Q._id, ids)`).
+        """
+        return self._clone(_preserve_order=True)
+
+    def skip(self, skip):
+        """Return a query set skipping the given number of documents"""
+        return self._clone(_skip=skip)
+
+    def limit(self, limit):
+        """Return a query set limited to the given number of documents"""
+        return self._clone(_limit=limit)
+
+    # Terminals
+
+    async def exists(self):
+        """Return True if any document matches the query"""
+        document = await self._frame_cls._find_one(
+            self.get_filter(),
+            {'_id': 1},
+            skip=self._skip
+        )
+        return document is not None
+
+    async def first(self):
+        """
+        Return the first frame matching the query (in `_id` order unless the
+        query is sorted) or None.
+        """
+        document = await self._frame_cls._find_one(
+            self.get_filter(),
+            self._projection(),
+            sort=self._sort or [('_id', ASCENDING)],
+            skip=self._skip
+        )
+        if document is None:
+            return None
+        return self._to_frame(document)
+
+    async def count(self):
+        """Return the number of documents matching the query"""
+        count = await self._frame_cls.count_by_filter(self.get_filter())
+        count = max(count - self._skip, 0)
+        if self._limit:
+            count = min(count, self._limit)
+        return count
+
+    async def values_list(self, *paths, flat=False):
+        """
+        Return a list of tuples holding the stored values of the given paths
+        (or `Q`s) for each document matching the query, only those paths are
+        loaded. If `flat` is True (and a single path is given) return a list of
+        values instead.
+        """
+        assert paths, 'At least one path must be given'
+        assert not flat or len(paths) == 1, '`flat` requires a single path'
+
+        paths = [to_path(p) for p in paths]
+        projection = {path: 1 for path in paths}
+        if '_id' not in projection:
+            projection['_id'] = 0
+
+        # Documents are read as stored
+        stored_paths = [self._frame_cls._aliases.path(p) for p in paths]
+        documents = self._cursor(projection)
+        if flat:
+            return [get_path(d, stored_paths[0]) async for d in documents]
+        return [tuple(get_path(d, p) for p in stored_paths) async for d in documents]
+
+    async def in_bulk(self, values=None, path='_id'):
+        """
+        Return a dictionary of the frames matching the query keyed by the value
+        of the given path (which should be unique). If a list of values is given
+        only frames with one of those values are returned.
+        """
+        path = to_path(path)
+        query_set = self
+        if values is not None:
+            values = list(values)
+            if not values:
+                return {}
+            query_set = self.filter(In(Q[path], values))
+        return {
+            get_path(frame, path): frame
+            for frame in await query_set
+        }
+
+    # Helpers
+
+    def get_filter(self):
+        """Return the filter (condition, group or raw filter) for the query"""
+        if not self._conditions:
+            return None
+        if len(self._conditions) == 1:
+            return self._conditions[0]
+        return And(*self._conditions)
+
+    def _clone(self, **changes):
+        query_set = self.__class__.__new__(self.__class__)
+        query_set.__dict__.update(self.__dict__)
+        query_set.__dict__.update(changes)
+        return query_set
+
+    def _projection(self):
+        # MongoDB doesn't allow inclusions and exclusions to be mixed so
+        # deferred paths are dropped from the paths to include.
+        if self._only is not None:
+            return {path: 1 for path in self._only if path not in self._defer}
+        if self._defer:
+            return {path: 0 for path in self._defer}
+        return None
+
+    def _deferred_fields(self):
+        """
+        Return the names of the fields that won't be (fully) loaded by the
+        query, a field is only loaded if its whole value is projected.
+        """
+        fields = set(self._frame_cls._fields)
+        fields.discard('_id')
+        if self._only is not None:
+            fields.difference_update(self._projection())
+            return fields
+        return fields.intersection(p.split('.')[0] for p in self._defer)
+
+    def _cursor(self, projection=None):
+        return self._frame_cls._find(
+            self.get_filter(),
+            projection or self._projection(),
+            preserve_order=self._preserve_order,
+            sort=self._sort,
+            skip=self._skip,
+            limit=self._limit
+        )
+
+    async def _fetch(self):
+        partial_frames = []
+        return [self._to_frame(d, partial_frames) async for d in self._cursor()]
+
+    def _to_frame(self, document, partial_frames=None):
+        frame = self._frame_cls._from_db(document)
+        deferred = frozenset(self._deferred_fields())
+        if deferred:
+            for name in deferred:
+                frame.__dict__.pop(name, None)
+            frame._deferred = deferred
+            if partial_frames is not None:
+                partial_frames.append(frame)
+                frame._partial_frames = partial_frames
+        return frame
+
+
+# Functions
+
+async def load_deferred(frames):
+    """
+    Load the deferred fields of the given partial frames (of the same class)
+    with a single query.
+    """
+    frames = [f for f in frames if f._deferred]
+    if not frames:
+        return
+
+    frame_cls = frames[0].__class__
+    projection = {name: 1 for f in frames for name in f._deferred}
+    documents = frame_cls._find(
+        {'_id': {'$in': list({f._id for f in frames})}},
+        projection
+    )
+    documents = {d['_id']: d async for d in documents}
+
+    for frame in frames:
+        frame._set_deferred_values(documents.get(frame._id, {}))
@@ -0,0 +1,206 @@
+"""
+Read routing, the read preference (and max staleness) frames are read with,
+and metrics for the reads sent on each route and the connection pools serving
+them, for example:
+
+    class Report(Frame):
+        _read_preference = 'secondaryPreferred'
+        _max_staleness = 120
+
+    await Order.many(Q.open == True, read_preference='nearest', max_staleness=90)
+
+Reads routed to secondaries may not see the latest writes, even those made
+earlier in the same request. Only reads run in a causally consistent session
+(see `scopes.start_session`) see the writes made before them in the session,
+across a failover only if those are written with the 'majority' write
+concern.
+
+Pool metrics are collected by a `PoolMetrics` listener registered with the
+client:
+
+    pool_metrics = PoolMetrics()
+    client = AsyncIOMotorClient(uri, event_listeners=[pool_metrics])
+    ...
+    pool_metrics.report(client)
+"""
+
+import threading
+from collections import Counter
+from functools import lru_cache
+
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.server_type import SERVER_TYPE
+
+__all__ = (
+    'READ_PREFERENCES',
+    'PoolMetrics',
+    'get_read_preference',
+    'route_reads'
+    )
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+# The number of reads sent on each route (read preference mode)
+_reads = Counter()
+
+
+def get_read_preference(read_preference, max_staleness=None):
+    """
+    Return the read preference for a mode name or pymongo `ReadPreference`,
+    reads from secondaries may be limited to those lagging at most
+    `max_staleness` seconds behind the primary (at least 90).
+    """
+    if isinstance(read_preference, str):
+        return _named_read_preference(read_preference, max_staleness)
+    if max_staleness is None:
+        return read_preference
+
+    assert read_preference.mongos_mode != 'primary', 'Reads from the primary have no max staleness'
+    return READ_PREFERENCES[read_preference.mongos_mode](
+        tag_sets=read_preference.tag_sets,
+        max_staleness=max_staleness
+    )
+
+
+def record_read(read_preference):
+    """Count a read sent with a read preference"""
+    _reads[read_preference.mongos_mode] += 1
+
+
+def route_reads():
+    """Return the number of reads sent on each route"""
+    return dict(_reads)
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """
+    A connection pool listener tracking the connections checked out of the
+    pool of each server, `report()` returns the pool size and utilization of
+    each server and route.
+    """
+
+    def __init__(self):
+        # Events are published from the driver's threads
+        self._lock = threading.Lock()
+        self._checked_out = Counter()
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self._checked_out[event.address] += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._checked_out[event.address] -= 1
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._checked_out.pop(event.address, None)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def report(self, client):
+        """
+        Return the pool metrics for a client, a dictionary holding for each
+        server (`host:port`) and route (read preference mode) the pool size
+        (the maximum number of connections), the connections checked out, their
+        utilization and, for routes, the reads sent.
+        """
+        max_pool_size = client.options.pool_options.max_pool_size
+        servers = {}
+        types = {}
+        with self._lock:
+            for address, server in client.topology_description.server_descriptions().items():
+                types[address] = server.server_type
+                servers[address] = _pool_report(max_pool_size, self._checked_out.get(address, 0))
+                servers[address]['type'] = server.server_type_name
+
+        routes = {}
+        reads = route_reads()
+        for name in READ_PREFERENCES:
+            addresses = _route_servers(name, types)
+            routes[name] = _pool_report(
+                max_pool_size * len(addresses),
+                sum(servers[a]['checked_out'] for a in addresses)
+            )
+            routes[name]['servers'] = ['{0}:{1}'.format(*a) for a in addresses]
+            routes[name]['reads'] = reads.get(name, 0)
+
+        return {
+            'servers': {'{0}:{1}'.format(*a): s for a, s in servers.items()},
+            'routes': routes
+        }
+
+
+# Private functions
+
+@lru_cache(maxsize=256)
+def _named_read_preference(name, max_staleness=None):
+    """Return the read preference for a mode name (and max staleness)"""
+    assert name in READ_PREFERENCES, 'Unknown read preference `{0}`'.format(name)
+    if name == 'primary':
+        assert max_staleness is None, 'Reads from the primary have no max staleness'
+        return Primary()
+    return READ_PREFERENCES[name](max_staleness=-1 if max_staleness is None else max_staleness)
+
+
+def _pool_report(pool_size, checked_out):
+    """Return the size, connections checked out and utilization of a pool"""
+    return {
+        'pool_size': pool_size,
+        'checked_out': checked_out,
+        'utilization': round(checked_out / pool_size, 3) if pool_size else 0
+    }
+
+
+def _route_servers(name, types):
+    """
+    Return the addresses of the servers reads on a route may be sent to, given
+    the type of each server.
+    """
+    # Reads through mongos, a load balancer or to a standalone server aren't
+    # routed by the client
+    routers = [a for a, t in types.items() if t in (SERVER_TYPE.Mongos, SERVER_TYPE.LoadBalancer,
+                                                     SERVER_TYPE.Standalone)]
+    if routers:
+        return routers
+
+    primary = [a for a, t in types.items() if t == SERVER_TYPE.RSPrimary]
+    secondaries = [a for a, t in types.items() if t == SERVER_TYPE.RSSecondary]
+    if name == 'primary':
+        return primary
+    if name == 'primaryPreferred':
+        return primary or secondaries
+    if name == 'secondary':
+        return secondaries
+    if name == 'secondaryPreferred':
+        return secondaries or primary
+    return primary + secondaries
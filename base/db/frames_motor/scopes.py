@@ -0,0 +1,138 @@
+"""
+Collection options and client sessions scoped to the current context.
+
+The options set by `Frame.with_options()` and the session set by
+`use_session()` / `start_session()` are held in context variables, so they
+apply to the coroutine that set them (and the tasks it starts) and never leak
+into the requests running concurrently:
+
+    with Dragon.with_options(write_concern='fast'):
+        await Dragon.insert_many(dragons)
+
+    async with start_session(Dragon):
+        await dragon.update()
+        await Dragon.one(Q.name == 'Burt')
+
+Options may be given by name, a write concern by its profile (see
+`concerns.WRITE_CONCERNS`), a read preference by its mode (see
+`routing.READ_PREFERENCES`) or as a `ReadPreference`, along with a
+`max_staleness`, and `codec_options='raw'` for raw BSON documents.
+"""
+
+import contextvars
+import functools
+from contextlib import asynccontextmanager, contextmanager
+
+from base.db.frames_motor.concerns import get_write_concern
+from base.db.frames_motor.routing import get_read_preference
+from base.db.frames_motor.transcode import raw_codec_options
+
+__all__ = (
+    'SessionCollection',
+    'current_session',
+    'start_session',
+    'use_session'
+    )
+
+# The collection methods that accept a session
+_SESSION_METHODS = frozenset([
+    'aggregate', 'bulk_write', 'count_documents', 'create_index', 'delete_many', 'delete_one', 'distinct',
+    'estimated_document_count', 'find', 'find_one', 'find_one_and_delete', 'find_one_and_replace',
+    'find_one_and_update', 'insert_many', 'insert_one', 'replace_one', 'update_many', 'update_one', 'watch'
+])
+
+# The options scoped to the current context, a dictionary of frame class to
+# options (replaced, never changed in place)
+_options = contextvars.ContextVar('frame_options', default={})
+
+# The client session operations in the current context are run in
+_session = contextvars.ContextVar('frame_session', default=None)
+
+
+class SessionCollection(object):
+    """
+    A collection whose operations are run in a client session (unless another
+    session is given).
+    """
+
+    __slots__ = ('collection', 'session')
+
+    def __init__(self, collection, session):
+        self.collection = collection
+        self.session = session
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name in _SESSION_METHODS:
+            return functools.partial(attr, session=self.session)
+        return attr
+
+    def with_options(self, **options):
+        return SessionCollection(self.collection.with_options(**options), self.session)
+
+
+def scoped_options(frame_cls):
+    """Return the options scoped to the current context for a frame class"""
+    return _options.get().get(frame_cls)
+
+
+@contextmanager
+def scope_options(frame_cls, options):
+    """Scope options for a frame class to the current context"""
+    scoped = _options.get()
+    token = _options.set({**scoped, frame_cls: {**scoped.get(frame_cls, {}), **options}})
+    try:
+        yield
+    finally:
+        _options.reset(token)
+
+
+def current_session():
+    """Return the client session for the current context (or None)"""
+    return _session.get()
+
+
+@contextmanager
+def use_session(session):
+    """Run the frame operations in the current context in a client session"""
+    token = _session.set(session)
+    try:
+        yield session
+    finally:
+        _session.reset(token)
+
+
+@asynccontextmanager
+async def start_session(frame_cls, causal_consistency=True, **kwargs):
+    """
+    Start a client session on the client of a frame class and run the frame
+    operations in the current context in it, causally consistent by default
+    (reads see the writes made before them in the session, across a failover
+    only if those are written with the 'majority' write concern).
+    """
+    session = await frame_cls._client.start_session(causal_consistency=causal_consistency, **kwargs)
+    try:
+        with use_session(session):
+            yield session
+    finally:
+        await session.end_session()
+
+
+def options_key(options):
+    """Return a hashable key for a dictionary of collection options"""
+    return tuple(sorted((k, v if isinstance(v, str) else repr(v)) for k, v in options.items()))
+
+
+def resolve_options(collection, options):
+    """Return collection options with the options given by name resolved"""
+    resolved = dict(options)
+    if isinstance(resolved.get('write_concern'), str):
+        resolved['write_concern'] = get_write_concern(resolved['write_concern'])
+    max_staleness = resolved.pop('max_staleness', None)
+    if max_staleness is not None:
+        assert resolved.get('read_preference') is not None, 'A max staleness can only be given with a read preference'
+    if resolved.get('read_preference') is not None:
+        resolved['read_preference'] = get_read_preference(resolved['read_preference'], max_staleness)
+    if resolved.get('codec_options') == 'raw':
+        resolved['codec_options'] = raw_codec_options(collection.codec_options)
+    return resolved
@@ -0,0 +1,237 @@
+"""
+Transcoding of raw BSON documents straight to JSON.
+
+Read-only API responses don't need documents decoded into Python dictionaries
+(let alone frames) only to be encoded to JSON again. Queries run with
+`RawBSONDocument` as the document class return the documents' BSON bytes,
+which are transcoded here to the JSON the `_json` methods would have produced:
+ObjectIds and datetimes become strings as `_json_safe` makes them, the values
+of binary fields (packed arrays, compressed and encrypted values) are decoded
+by their field, everything else is written as `json.dumps` would write it.
+"""
+
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+
+from bson import Binary, decode
+from bson.raw_bson import RawBSONDocument
+from django.core.serializers.json import DjangoJSONEncoder
+
+from base.rf.response import RawJSON
+
+__all__ = (
+    'bson_to_json',
+    'bsons_to_json',
+    'raw_codec_options'
+    )
+
+_encode_string = json.encoder.encode_basestring_ascii
+_double = struct.Struct('<d').unpack_from
+_int32 = struct.Struct('<i').unpack_from
+_int64 = struct.Struct('<q').unpack_from
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_AWARE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class _Unsupported(Exception):
+    """Raised when a document holds a BSON type that isn't transcoded"""
+
+
+def raw_codec_options(codec_options):
+    """Return the given codec options set to return raw BSON documents"""
+    return codec_options.with_options(document_class=RawBSONDocument)
+
+
+def bson_to_json(data, codec_options=None, names=None):
+    """
+    Return the JSON for a BSON document. Datetimes are written as they're
+    decoded with the given codec options (naive UTC by default).
+
+    Keys are written under the names given for them in `names`, and the values
+    of the binary fields given there decoded (see `Aliases.json_names`).
+    """
+    out = []
+    try:
+        _write_document(data, 0, out, False, codec_options, names)
+    except _Unsupported:
+        return _fallback(data, codec_options, names)
+    return RawJSON(''.join(out).encode('ascii'))
+
+
+def bsons_to_json(documents, codec_options=None, names=None):
+    """Return the JSON array for a list of BSON documents"""
+    return RawJSON(b'[' + b', '.join(bson_to_json(d, codec_options, names) for d in documents) + b']')
+
+
+# Private functions
+
+def _write_document(data, start, out, array, codec_options, names=None, field=None):
+    """
+    Write the JSON for the document (or array) starting at `start` and return
+    the position after it. The names for the keys of a document (or of the
+    documents in an array) are looked up in `names`, the elements of an array
+    of a binary field's values are decoded by the field.
+    """
+    size = _int32(data, start)[0]
+    end = start + size - 1
+    position = start + 4
+    first = True
+
+    out.append('[' if array else '{')
+    while position < end:
+        kind = data[position]
+        name_end = data.index(b'\x00', position + 1)
+
+        if first:
+            first = False
+        else:
+            out.append(', ')
+
+        value_names = names
+        value_field = field
+        if not array:
+            key = data[position + 1:name_end].decode('utf-8')
+            value_field = None
+            if names is not None:
+                key, value_names, value_field = names.get(key, (key, None, None))
+            out.append(_encode_string(key))
+            out.append(': ')
+
+        position = _write_value(kind, data, name_end + 1, out, codec_options, value_names, value_field)
+    out.append(']' if array else '}')
+
+    return start + size
+
+
+def _write_value(kind, data, position, out, codec_options, names=None, field=None):
+    """
+    Write the JSON for a value and return the position after it, the value of
+    a binary field is decoded by the field.
+    """
+
+    # String
+    if kind == 0x02:
+        length = _int32(data, position)[0]
+        out.append(_encode_string(data[position + 4:position + 3 + length].decode('utf-8')))
+        return position + 4 + length
+
+    # ObjectId
+    elif kind == 0x07:
+        out.append('"' + data[position:position + 12].hex() + '"')
+        return position + 12
+
+    # Int32
+    elif kind == 0x10:
+        out.append(int.__repr__(_int32(data, position)[0]))
+        return position + 4
+
+    # Int64
+    elif kind == 0x12:
+        out.append(int.__repr__(_int64(data, position)[0]))
+        return position + 8
+
+    # Double
+    elif kind == 0x01:
+        out.append(_float(_double(data, position)[0]))
+        return position + 8
+
+    # Boolean
+    elif kind == 0x08:
+        out.append('true' if data[position] else 'false')
+        return position + 1
+
+    # Null
+    elif kind == 0x0A:
+        out.append('null')
+        return position
+
+    # Datetime
+    elif kind == 0x09:
+        out.append('"' + str(_datetime(_int64(data, position)[0], codec_options)) + '"')
+        return position + 8
+
+    # Document
+    elif kind == 0x03:
+        return _write_document(data, position, out, False, codec_options, names)
+
+    # Array (of a binary field's values if the field is given)
+    elif kind == 0x04:
+        return _write_document(data, position, out, True, codec_options, names, field)
+
+    # Binary (of a binary field)
+    elif kind == 0x05 and field is not None:
+        length = _int32(data, position)[0]
+        value = Binary(data[position + 5:position + 5 + length], data[position + 4])
+        if not field.is_db_value(value):
+            raise _Unsupported(kind)
+        out.append(_encode_value(field.from_db_value(value)))
+        return position + 5 + length
+
+    raise _Unsupported(kind)
+
+
+def _float(value):
+    # As written by `json.dumps`
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _datetime(milliseconds, codec_options):
+    """Return a datetime as decoded with the given codec options"""
+    delta = timedelta(milliseconds=milliseconds)
+    if codec_options is None or not codec_options.tz_aware:
+        return _EPOCH + delta
+
+    value = _EPOCH_AWARE + delta
+    if codec_options.tzinfo is not None:
+        value = value.astimezone(codec_options.tzinfo)
+    return value
+
+
+def _encode_value(value):
+    """Return the JSON for a decoded value, as the `_json` methods write it"""
+    from .frames import _BaseFrame
+
+    return json.dumps(_BaseFrame._json_safe(value), cls=DjangoJSONEncoder)
+
+
+def _fallback(data, codec_options, names):
+    """Return the JSON for a document by decoding and encoding it in full"""
+    if codec_options is not None:
+        codec_options = codec_options.with_options(document_class=dict)
+        document = decode(data, codec_options)
+    else:
+        document = decode(data)
+    if names is not None:
+        document = _rename(document, names)
+    return RawJSON(_encode_value(document).encode('ascii'))
+
+
+def _rename(value, names):
+    """
+    Return a decoded value with its keys renamed, and the values of binary
+    fields decoded, as given in `names`.
+    """
+    if isinstance(value, list):
+        return [_rename(v, names) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    renamed = {}
+    for key, item in value.items():
+        key, item_names, field = names.get(key, (key, None, None))
+        if field is not None and field.is_db_value(item):
+            item = field.from_db_value(item)
+        elif field is not None and isinstance(item, list):
+            item = [field.from_db_value(v) if field.is_db_value(v) else v for v in item]
+        elif item_names is not None:
+            item = _rename(item, item_names)
+        renamed[key] = item
+    return renamed
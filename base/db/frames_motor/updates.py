@@ -0,0 +1,273 @@
+"""
+Typed update operators compiled against the fields of a frame, for example:
+
+    await Dragon.update_where(
+        Q.name == 'Burt',
+        Inc(Q.kills, 1),
+        Push(Q.log, entry, slice=-100)
+    )
+
+Values are cleaned (validated and cast) by the fields they're written to, and
+the operators compile to a single pymongo update document so the change is
+applied atomically in one round-trip.
+
+Values computed from other fields are set with expressions built from `Q`
+paths, which compile to a pipeline update run server-side, for example:
+
+    await Order.update_where(Q.total == None, Set(Q.total, Q.price * Q.qty))
+"""
+
+import numbers
+
+from django.core.exceptions import ValidationError
+
+from base.db.fields import ArrayField, FloatField, IntegerField
+from base.db.frames_motor.paths import element_field, is_positional, resolve_field, to_path
+from base.db.frames_motor.queries import Condition, Expr, Group, Q, to_expression, to_filter
+from base.db.frames_motor.validation import to_document_value
+from base.rf.exceptions import FrameValidation
+
+__all__ = (
+    # Operators
+    'Set',
+    'Inc',
+    'Min',
+    'Max',
+    'Push',
+    'AddToSet',
+    'Pull',
+
+    # Utils
+    'compile_updates'
+    )
+
+
+# Operators
+
+class Update(object):
+    """
+    Base class for update operators, an operator holds the path it updates and
+    the value it's applied with.
+    """
+
+    __slots__ = ('q', 'value')
+
+    operator = ''
+
+    def __init__(self, q, value):
+        self.q = to_path(q)
+        self.value = value
+
+    def __repr__(self):
+        return '<{0} {1!r} {2!r}>'.format(self.__class__.__name__, self.q, self.value)
+
+    def compile(self, field, element):
+        """
+        Return the operand for the operator, cast for the field being updated.
+        If `element` is True the path addresses an element of the field (an
+        array).
+        """
+        if element:
+            field = element_field(field)
+        return _clean(field, self.value)
+
+
+class Set(Update):
+    """
+    Set the value of a field, the value may be an expression (a `Q` path or
+    `Expr`) computed server-side from the document's values.
+    """
+
+    __slots__ = ()
+
+    operator = '$set'
+
+    @property
+    def computed(self):
+        """Return True if the value is computed by an expression"""
+        return isinstance(self.value, (Q, Expr))
+
+    def compile(self, field, element):
+        if self.computed:
+            return to_expression(self.value)
+        return super(Set, self).compile(field, element)
+
+
+class Min(Update):
+    """Set a field to the value if it's less than the field's current value"""
+
+    __slots__ = ()
+
+    operator = '$min'
+
+
+class Max(Update):
+    """Set a field to the value if it's greater than the field's current value"""
+
+    __slots__ = ()
+
+    operator = '$max'
+
+
+class Inc(Update):
+    """Increment a numeric field by an amount"""
+
+    __slots__ = ()
+
+    operator = '$inc'
+
+    def __init__(self, q, amount=1):
+        super(Inc, self).__init__(q, amount)
+
+    def compile(self, field, element):
+        if element:
+            field = element_field(field)
+
+        if field is not None and not isinstance(field, (IntegerField, FloatField)):
+            raise ValidationError('Only numeric fields can be incremented.', code='invalid')
+
+        value = self.value if field is None else field.to_python(self.value)
+        if isinstance(value, bool) or not isinstance(value, numbers.Number):
+            raise ValidationError(
+                '“%(value)s” is not a valid amount.',
+                code='invalid',
+                params={'value': self.value}
+            )
+        return value
+
+
+class Push(Update):
+    """
+    Append one or more values to an array, optionally at a `position`, then
+    `sort` and/or `slice` the array (e.g. `slice=-100` keeps the last 100
+    values).
+    """
+
+    __slots__ = ('modifiers',)
+
+    operator = '$push'
+
+    def __init__(self, q, *values, slice=None, sort=None, position=None):
+        assert values, 'At least one value must be given'
+        super(Push, self).__init__(q, values)
+        self.modifiers = {
+            k: v for k, v in (('$position', position), ('$slice', slice), ('$sort', sort))
+            if v is not None
+        }
+
+    def compile(self, field, element):
+        field = element_field(field)
+        values = [_clean(field, v) for v in self.value]
+        if len(values) == 1 and not self.modifiers:
+            return values[0]
+        return {'$each': values, **self.modifiers}
+
+
+class AddToSet(Update):
+    """Add one or more values to an array unless they are already present"""
+
+    __slots__ = ()
+
+    operator = '$addToSet'
+
+    def __init__(self, q, *values):
+        assert values, 'At least one value must be given'
+        super(AddToSet, self).__init__(q, values)
+
+    def compile(self, field, element):
+        field = element_field(field)
+        values = [_clean(field, v) for v in self.value]
+        if len(values) == 1:
+            return values[0]
+        return {'$each': values}
+
+
+class Pull(Update):
+    """
+    Remove the values of an array equal to a value or matching a condition (the
+    paths of which are relative to the array's elements).
+    """
+
+    __slots__ = ()
+
+    operator = '$pull'
+
+    def compile(self, field, element):
+        if isinstance(self.value, (Condition, Group)):
+            return to_filter(self.value)
+        if isinstance(self.value, dict):
+            return self.value
+
+        field = element_field(field)
+        if field is None:
+            return self.value
+        return field.get_prep_value(self.value)
+
+
+# Utils
+
+def compile_updates(updates, fields):
+    """
+    Return the pymongo update document for a list of update operators against
+    the given fields (a dictionary of name to `Field`). Values that fail to
+    clean raise a `FrameValidation` error holding the errors for each path.
+
+    If any value is computed by an expression a pipeline update is returned
+    instead, pipeline updates only support `Set`.
+    """
+    document = {}
+    errors = {}
+    for update in updates:
+        path = update.q
+        parts = path.split('.')
+        if parts[0] not in fields:
+            errors[path] = 'Unknown field.'
+            continue
+
+        field = resolve_field(fields, path)
+        element = isinstance(field, ArrayField) and is_positional(parts[-1])
+
+        try:
+            operand = update.compile(field, element)
+        except ValidationError as e:
+            errors[path] = e.messages[0]
+            continue
+        except FrameValidation as e:
+            errors[path] = e.message
+            continue
+
+        operands = document.setdefault(update.operator, {})
+        if path in operands:
+            raise ValueError('Conflicting {0} updates for `{1}`'.format(update.operator, path))
+        operands[path] = operand
+
+    if errors:
+        raise FrameValidation(errors)
+
+    computed = {u.q for u in updates if isinstance(u, Set) and u.computed}
+    if not computed:
+        return document
+
+    if set(document) != {'$set'}:
+        raise ValueError('Only `Set` can be combined with computed values')
+
+    # In a pipeline plain values would be read as expressions
+    return [{
+        '$set': {
+            path: value if path in computed else {'$literal': value}
+            for path, value in document['$set'].items()
+        }
+    }]
+
+
+# Private functions
+
+def _clean(field, value):
+    """Return a value cleaned by a field and converted to its stored form"""
+    if field is None:
+        return value
+
+    # Array fields clean their values in place
+    if isinstance(value, list):
+        value = list(value)
+    return to_document_value(field, field.clean(value))
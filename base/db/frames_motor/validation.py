@@ -0,0 +1,255 @@
+"""
+Validation of frames against their fields.
+
+Each frame class gets a validation function generated for its fields, the
+function cleans the values of the named fields in place and collects the errors
+rather than raising for each field.
+
+Lists of documents (e.g. for `Frame.insert_many`) are validated in batches,
+column by column, with the checks for numeric fields vectorized when NumPy is
+installed. Very large batches can be split across a process pool.
+"""
+
+import asyncio
+from datetime import date, datetime
+from functools import partial
+
+from django.core import validators
+from django.core.exceptions import ValidationError
+
+from base.db.fields import ArrayField, BinaryField, DateField, DateTimeField, EmbeddedField, Field
+from base.rf.exceptions import FrameValidation
+
+# NumPy is optional, without it every value is cleaned individually
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    _type_of = None
+else:
+    _type_of = numpy.frompyfunc(type, 1, 1)
+
+__all__ = (
+    'compile_validator',
+    'to_document_value',
+    'validate_batch',
+    'validate_batch_in_pool'
+    )
+
+# The minimum number of values in a column for its checks to be vectorized
+VECTORIZE_MIN_ROWS = 1000
+
+# The number of documents validated by each process of a pool
+POOL_CHUNK_SIZE = 10000
+
+
+def compile_validator(fields):
+    """
+    Return a function `validate(values, names, errors)` for the given fields (a
+    dictionary of name to `Field`). The function cleans the values (a frame's
+    `__dict__`) of the fields named in `names` in place and adds an error
+    message to the `errors` dictionary for each value that fails to clean.
+    """
+    namespace = {
+        'ValidationError': ValidationError,
+        'FrameValidation': FrameValidation
+    }
+    lines = ['def validate(values, names, errors):']
+    for index, (name, field) in enumerate(fields.items()):
+        clean = 'clean_{0}'.format(index)
+        namespace[clean] = field.clean
+        lines.extend([
+            '    if {0!r} in names:'.format(name),
+            '        try:',
+            '            values[{0!r}] = {1}(values.get({0!r}))'.format(name, clean),
+            '        except ValidationError as e:',
+            '            errors[{0!r}] = e.messages[0]'.format(name),
+            '        except FrameValidation as e:',
+            '            errors[{0!r}] = e.message'.format(name)
+        ])
+    lines.append('    return errors')
+
+    exec(compile('\n'.join(lines), '<frame validator>', 'exec'), namespace)
+    return namespace['validate']
+
+
+def to_document_value(field, value):
+    """Return the stored form of a value cleaned by a field"""
+    if value is None:
+        return value
+
+    if isinstance(field, ArrayField):
+        if not isinstance(field.to, Field):
+            return value
+        return [to_document_value(field.to, v) for v in value]
+
+    if isinstance(field, EmbeddedField):
+        value._update_field.clear()
+        return value._get_document()
+
+    if isinstance(field, DateField) and not isinstance(field, DateTimeField):
+        if isinstance(value, date) and not isinstance(value, datetime):
+            return datetime(value.year, value.month, value.day)
+
+    if isinstance(field, BinaryField):
+        return field.get_prep_value(value)
+
+    return value
+
+
+# Batches
+
+def validate_batch(frame_cls, documents, offset=0):
+    """
+    Validate a list of documents (dictionaries) for a frame class as `is_valid`
+    would for new frames, one field (column) at a time. Return the list of
+    documents to insert (cleaned values in their stored form, with defaults
+    for missing fields) for the valid rows, and a list of errors, one
+    `{'index': index, 'errors': {field: message}}` per invalid row (indexes are
+    offset by `offset`).
+    """
+    fields = frame_cls._fields
+    row_errors = {}
+    columns = {}
+
+    for name, field in fields.items():
+        default = frame_cls._field_default(field)
+        column = [d.get(name, default) if isinstance(d, dict) else default for d in documents]
+        columns[name] = _clean_column(field, column, name, row_errors)
+
+    # Class validators are run for the rows with valid fields (as `is_valid`
+    # only runs them once the fields are valid).
+    for tag, func in frame_cls._validators:
+        column = columns.get(tag)
+        for index in range(len(documents)):
+            if index in row_errors:
+                continue
+            try:
+                func(column[index] if column is not None else None)
+            except FrameValidation as e:
+                row_errors.setdefault(index, {})[tag] = e.message
+            except ValidationError as e:
+                row_errors.setdefault(index, {})[tag] = e.messages[0]
+
+    valid = []
+    stored_names = {name: frame_cls._aliases.to_db.get(name, name) for name in fields}
+    for index in range(len(documents)):
+        if index in row_errors:
+            continue
+        document = {
+            stored_names[name]: to_document_value(field, columns[name][index])
+            for name, field in fields.items()
+        }
+        if document.get('_id', 0) is None:
+            document.pop('_id')
+        valid.append(document)
+
+    errors = [
+        {'index': index + offset, 'errors': row_errors[index]}
+        for index in sorted(row_errors)
+    ]
+    return valid, errors
+
+
+async def validate_batch_in_pool(frame_cls, documents, executor, chunk_size=POOL_CHUNK_SIZE):
+    """
+    Validate a list of documents (see `validate_batch`) in chunks run by the
+    given executor (typically a `concurrent.futures.ProcessPoolExecutor`). The
+    frame class and the documents must be picklable, so the class must be
+    importable by the worker processes.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(
+            executor,
+            partial(validate_batch, frame_cls, documents[start:start + chunk_size], start)
+        )
+        for start in range(0, len(documents), chunk_size)
+    ])
+
+    valid = []
+    errors = []
+    for chunk_valid, chunk_errors in results:
+        valid.extend(chunk_valid)
+        errors.extend(chunk_errors)
+    return valid, errors
+
+
+# Private functions
+
+def _clean_column(field, column, name, row_errors):
+    """
+    Return the cleaned values of a column, adding the error for each value that
+    fails to clean to `row_errors` (keyed by row index).
+    """
+    passed = _vectorized_check(field, column)
+    clean = field.clean
+    cleaned = []
+    for index, value in enumerate(column):
+        if passed is not None and passed[index]:
+            cleaned.append(value)
+            continue
+        # Array fields clean their values in place
+        if isinstance(value, list):
+            value = list(value)
+        try:
+            cleaned.append(clean(value))
+        except ValidationError as e:
+            row_errors.setdefault(index, {})[name] = e.messages[0]
+            cleaned.append(value)
+        except FrameValidation as e:
+            row_errors.setdefault(index, {})[name] = e.message
+            cleaned.append(value)
+    return cleaned
+
+
+def _vectorized_check(field, column):
+    """
+    Return a boolean array flagging the values of a numeric column known to be
+    clean, or None if the column's checks can't be vectorized. Values that
+    aren't flagged are cleaned individually (to raise the usual errors).
+    """
+    if numpy is None or len(column) < VECTORIZE_MIN_ROWS or field.python_type not in (int, float):
+        return None
+
+    # Only the standard clean with range validators can be vectorized
+    cls = type(field)
+    if (
+            cls.clean is not Field.clean
+            or cls.validate is not Field.validate
+            or cls.run_validators is not Field.run_validators
+    ):
+        return None
+
+    bounds = []
+    for validator in field.validators:
+        if isinstance(validator, validators.MinValueValidator):
+            bounds.append((numpy.greater_equal, validator.limit_value))
+        elif isinstance(validator, validators.MaxValueValidator):
+            bounds.append((numpy.less_equal, validator.limit_value))
+        else:
+            return None
+        if callable(bounds[-1][1]):
+            return None
+
+    python_type = field.python_type
+    objects = numpy.fromiter(column, dtype=object, count=len(column))
+    exact = numpy.equal(_type_of(objects), python_type).astype(bool)
+    if not exact.any():
+        return exact
+
+    try:
+        values = numpy.where(exact, objects, 0).astype(numpy.int64 if python_type is int else numpy.float64)
+    except OverflowError:
+        # Integers too large for int64 are cleaned individually
+        return None
+
+    passed = exact
+    for compare, limit in bounds:
+        passed &= compare(values, limit)
+
+    if field.choices:
+        choices = [c for c in field.choices if type(c) in (int, float)]
+        passed &= numpy.isin(values, choices)
+
+    return passed
@@ -190,6 +190,36 @@ class AlreadyInUse(BaseException):
             self.message = message
 
 
+class VersionConflict(BaseException):
+    status_code = status.HTTP_409_CONFLICT
+    message = _('This item was modified by another request, reload it and try again')
+    default_code = 'VersionConflict'
+
+    def __init__(self, message=None):
+        if message is not None:
+            self.message = message
+
+
+class Overloaded(BaseException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    message = _('The service is overloaded, try again later')
+    default_code = 'Overloaded'
+
+    def __init__(self, message=None):
+        if message is not None:
+            self.message = message
+
+
+class InvalidScrollToken(BaseException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    message = _('The scroll token is unknown or has expired, start scrolling again')
+    default_code = 'InvalidScrollToken'
+
+    def __init__(self, message=None):
+        if message is not None:
+            self.message = message
+
+
 class DatabaseSaveError(BaseException):
     status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     message = _('Error Storing the data in the database')
@@ -1,6 +1,24 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http.response import JsonResponse
 
 
+class RawJSON(bytes):
+    """
+    Encoded JSON (e.g. transcoded straight from BSON) to be written to a
+    response as is.
+    """
+
+
+def _json_options(encoder=DjangoJSONEncoder, safe=True, json_dumps_params=None, **kwargs):
+    """
+    Return the encoder, `json.dumps` parameters and other (response) keyword
+    arguments from the arguments `JsonResponse` takes.
+    """
+    return encoder, json_dumps_params or {}, kwargs
+
+
 class Response(JsonResponse):
 
     def __init__(self, data=None, messages=None, status_code=200, result=True, *args, **kwargs):
@@ -35,4 +53,19 @@ class Response(JsonResponse):
             result = False
         result = {'result': result, 'status': status_code, 'messages': final_msgs, 'data': data}
 
-        super(Response, self).__init__(data=result, status=status, *args, *kwargs)
+        if isinstance(data, RawJSON):
+            # Encode the envelope's other members (with the encoder and
+            # parameters given as for `JsonResponse`), the encoded data is
+            # written as is
+            encoder, json_dumps_params, kwargs = _json_options(*args, **kwargs)
+            members = [
+                '{0}: {1}'.format(json.dumps(key), json.dumps(value, cls=encoder, **json_dumps_params)).encode()
+                for key, value in result.items() if key != 'data'
+            ]
+            members.append(b'"data": ' + data)
+            content = b'{' + b', '.join(members) + b'}'
+            kwargs.setdefault('content_type', 'application/json')
+            super(JsonResponse, self).__init__(content=content, status=status, **kwargs)
+            return
+
+        super(Response, self).__init__(data=result, status=status, *args, **kwargs)
@@ -0,0 +1,114 @@
+from base.db.fields import ArrayField, CharField, EmbeddedField, IntegerField, JSONField
+from base.db.frames_motor import Frame, SubFrame
+from base.db.frames_motor.aliases import Aliases
+
+
+class Stat(SubFrame):
+    name = CharField(max_length=20, db_field='n')
+    value = IntegerField(db_field='v')
+
+
+class Hero(Frame):
+    _collection = 'heroes'
+    name = CharField(max_length=20)
+    level = IntegerField(db_field='l')
+    best = EmbeddedField(Stat, db_field='b')
+    stats = ArrayField(EmbeddedField(Stat), db_field='s')
+    extra = JSONField()
+
+
+aliases = Hero._aliases
+
+
+def test_path():
+    assert aliases.path('level') == 'l'
+    assert aliases.path('best.value') == 'b.v'
+    assert aliases.path('stats.0.name') == 's.0.n'
+    assert aliases.path('stats.$.value') == 's.$.v'
+    assert aliases.path('extra.level') == 'extra.level'
+
+
+def test_is_scalar():
+    assert aliases.is_scalar('l')
+    assert aliases.is_scalar('b.v')
+    assert not aliases.is_scalar('s.v')
+    assert not aliases.is_scalar('extra.x')
+    assert not aliases.is_scalar('unknown')
+
+
+def test_filter():
+    filter = {
+        'level': {'$gt': 3},
+        '$or': [{'best.value': 1}, {'name': 'Burt'}],
+        'stats': {'$elemMatch': {'name': 'hp', 'value': {'$gte': 10}}},
+        '$expr': {'$gt': ['$level', '$best.value']}
+    }
+    assert aliases.filter(filter) == {
+        'l': {'$gt': 3},
+        '$or': [{'b.v': 1}, {'name': 'Burt'}],
+        's': {'$elemMatch': {'n': 'hp', 'v': {'$gte': 10}}},
+        '$expr': {'$gt': ['$l', '$b.v']}
+    }
+
+
+def test_projection_and_sort():
+    assert aliases.projection({'level': 1, 'best.name': 1}) == {'l': 1, 'b.n': 1}
+    assert aliases.projection(['level']) == ['l']
+    assert aliases.sort([('level', -1), ('name', 1)]) == [('l', -1), ('name', 1)]
+    assert aliases.sort('best.value') == 'b.v'
+
+
+def test_update():
+    update = {
+        '$set': {'level': 2, 'best': {'name': 'hp', 'value': 3}, 'stats.0': {'name': 'mp', 'value': 1}},
+        '$inc': {'best.value': 1},
+        '$push': {'stats': {'$each': [{'name': 'xp', 'value': 0}], '$sort': {'value': -1}}},
+        '$addToSet': {'stats': {'name': 'hp', 'value': 3}},
+        '$setOnInsert': {'stats': [{'name': 'hp', 'value': 0}]},
+        '$pull': {'stats': {'name': 'mp'}},
+        '$rename': {'level': 'best.value'},
+        '$unset': {'extra': ''}
+    }
+    assert aliases.update(update) == {
+        '$set': {'l': 2, 'b': {'n': 'hp', 'v': 3}, 's.0': {'n': 'mp', 'v': 1}},
+        '$inc': {'b.v': 1},
+        '$push': {'s': {'$each': [{'n': 'xp', 'v': 0}], '$sort': {'v': -1}}},
+        '$addToSet': {'s': {'n': 'hp', 'v': 3}},
+        '$setOnInsert': {'s': [{'n': 'hp', 'v': 0}]},
+        '$pull': {'s': {'n': 'mp'}},
+        '$rename': {'l': 'b.v'},
+        '$unset': {'extra': ''}
+    }
+
+    # Documents already in their stored form are kept
+    assert aliases.update({'$set': {'best': {'n': 'hp', 'v': 3}}}) == {'$set': {'b': {'n': 'hp', 'v': 3}}}
+
+
+def test_pipeline():
+    pipeline = [
+        {'$match': {'level': 1}},
+        {'$set': {'total': {'$add': ['$level', '$best.value']}}},
+        {'$sort': {'level': 1}},
+        {'$group': {'_id': '$best.name', 'levels': {'$sum': '$level'}}},
+        {'$match': {'level': 1}}
+    ]
+    assert aliases.pipeline(pipeline) == [
+        {'$match': {'l': 1}},
+        {'$set': {'total': {'$add': ['$l', '$b.v']}}},
+        {'$sort': {'l': 1}},
+        {'$group': {'_id': '$b.n', 'levels': {'$sum': '$l'}}},
+        {'$match': {'level': 1}}
+    ]
+    assert aliases.update([{'$set': {'level': {'$literal': '$level'}}}]) == [{'$set': {'l': {'$literal': '$level'}}}]
+
+
+def test_documents():
+    document = {'name': 'Burt', 'level': 3, 'best': {'name': 'hp', 'value': 1}, 'stats': [{'name': 'mp'}]}
+    stored = {'name': 'Burt', 'l': 3, 'b': {'n': 'hp', 'v': 1}, 's': [{'n': 'mp'}]}
+    assert aliases.to_db_document(document) == stored
+    assert aliases.to_python_document(stored) == document
+
+
+def test_inactive():
+    filter = {'name': 'x'}
+    assert Aliases({'name': CharField()}).filter(filter) is filter
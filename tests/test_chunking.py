@@ -0,0 +1,136 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from bson import Binary, MaxKey, MinKey, ObjectId
+
+from base.db.frames_motor.chunking import ChunkedCursor, ChunksFailed, find_in, gather_chunks, split_in
+from base.db.frames_motor.chunking import _sort_key
+
+
+class FakeCursor(object):
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def to_list(self, length=None):
+        return self.documents
+
+
+class FakeCollection(object):
+    """A collection finding the documents whose `_id` is in the filter's list"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.filters = []
+
+    def find(self, filter, projection=None, sort=None, limit=0, **kwargs):
+        self.filters.append(filter)
+        ids = filter['_id']['$in']
+        documents = [d for d in self.documents if d['_id'] in ids]
+        for path, direction in reversed(sort or []):
+            documents.sort(key=lambda d: _sort_key(d.get(path)), reverse=direction < 0)
+        return FakeCursor(documents[:limit] if limit else documents)
+
+
+def test_find_in():
+    filter = {'_id': {'$in': [1, 2, 3]}, 'tags': {'$in': [1, 2, 3, 4]}, '$or': [{'a': 1}]}
+    assert find_in(filter) == ('tags', [1, 2, 3, 4])
+    assert find_in(filter, lambda path: path != 'tags') == ('_id', [1, 2, 3])
+    assert find_in({'_id': 1}) is None
+
+
+def test_split_in():
+    filter = {'_id': {'$in': list(range(5))}, 'open': True}
+    assert split_in(filter, 5) is None
+    assert split_in(filter, 2) == [
+        {'_id': {'$in': [0, 1]}, 'open': True},
+        {'_id': {'$in': [2, 3]}, 'open': True},
+        {'_id': {'$in': [4]}, 'open': True}
+    ]
+
+    # Only paths holding a single value are split
+    assert split_in(filter, 2, lambda path: False) is None
+
+
+def test_split_in_deduplicates_as_mongodb_compares():
+    filter = {'x': {'$in': [1, 1.0, True, 'a', 1, ObjectId(b'a' * 12)]}}
+    values = [v for f in split_in(filter, 2) for v in f['x']['$in']]
+    assert values == [1, True, 'a', ObjectId(b'a' * 12)]
+    assert type(values[1]) is bool
+
+    # Unhashable values aren't split
+    assert split_in({'x': {'$in': [{'a': 1}, {'a': 2}]}}, 1) is None
+
+
+def test_sort_key_bson_order():
+    values = [
+        MaxKey(), datetime(2020, 1, 1), True, ObjectId(b'a' * 12), Binary(b'a'), {'a': 1}, 'a', 2, 1.5,
+        float('nan'), None, [], MinKey()
+    ]
+    assert sorted(values, key=_sort_key)[::-1] == values[:9] + [values[9]] + values[10:]
+    assert _sort_key([3, 1, 2]) == _sort_key(1)
+    assert _sort_key([3, 1, 2], reverse=True) == _sort_key(3)
+
+
+def test_chunked_cursor_merges_sorted_chunks():
+    documents = [{'_id': i, 'rank': (i * 7) % 10} for i in range(10)]
+    collection = FakeCollection(documents)
+    cursor = ChunkedCursor(
+        collection,
+        split_in({'_id': {'$in': list(range(10))}}, 3),
+        sort=[('rank', -1)],
+        skip=1,
+        limit=4
+    )
+    result = asyncio.run(cursor.to_list())
+    assert [d['rank'] for d in result] == [8, 7, 6, 5]
+    assert len(collection.filters) == 4
+
+
+def test_chunked_cursor_preserves_order():
+    collection = FakeCollection([{'_id': i} for i in range(6)])
+    ids = [4, 1, 5, 0, 3, 2]
+    cursor = ChunkedCursor(collection, split_in({'_id': {'$in': ids}}, 2), order=('_id', ids))
+    assert [d['_id'] for d in asyncio.run(cursor.to_list())] == ids
+
+
+def test_chunked_cursor_requires_sort_keys():
+    filters = split_in({'_id': {'$in': list(range(10))}}, 3)
+    with pytest.raises(AssertionError):
+        ChunkedCursor(None, filters, {'name': 1}, sort=[('rank', 1)])
+    with pytest.raises(AssertionError):
+        ChunkedCursor(None, filters, {'rank': 0}, sort=[('rank', 1)])
+    with pytest.raises(AssertionError):
+        ChunkedCursor(None, filters, sort=[('rank', 1)], collation={'locale': 'en'})
+    ChunkedCursor(None, filters, {'rank': 1}, sort=[('rank', 1), ('_id', 1)])
+    ChunkedCursor(None, filters, {'name': 0}, sort=[('rank.value', 1)])
+
+
+def test_gather_chunks():
+    async def double(chunk):
+        await asyncio.sleep(0.01 * (3 - chunk))
+        return chunk * 2
+
+    assert asyncio.run(gather_chunks([1, 2, 3], double, 2)) == [2, 4, 6]
+
+
+def test_gather_chunks_cancels_on_failure():
+    cancelled = []
+
+    async def count(chunk):
+        try:
+            await asyncio.sleep(0.01 * chunk)
+        except asyncio.CancelledError:
+            cancelled.append(chunk)
+            raise
+        if chunk == 3:
+            raise ValueError('chunk 3')
+        return chunk
+
+    with pytest.raises(ChunksFailed) as info:
+        asyncio.run(gather_chunks([1, 2, 3, 4, 5], count, 3, int))
+    assert info.value.results == {0: 1, 1: 2}
+    assert info.value.count == 3
+    assert isinstance(info.value.__cause__, ValueError)
+    assert cancelled == [4, 5]
@@ -0,0 +1,62 @@
+import pytest
+from bson import Binary, decode, encode
+
+from base.db.fields import CompressedJSONField, CompressedTextField
+from base.db.fields import compression
+from base.db.frames_motor import Frame
+
+TEXT = ' '.join(['The quick brown fox jumps over the lazy dog.'] * 50)
+PAYLOAD = {'name': 'report', 'rows': [{'id': i, 'value': i * 1.5, 'tags': ['a', 'b']} for i in range(100)]}
+
+
+class Article(Frame):
+    _collection = 'articles'
+    body = CompressedTextField(threshold=64)
+    meta = CompressedJSONField(threshold=64, algorithm='lzma', null=True)
+
+
+@pytest.mark.parametrize('algorithm', list(compression.ALGORITHMS))
+def test_compress_round_trip(algorithm):
+    data = TEXT.encode('utf-8')
+    compressed = compression.compress(data, algorithm)
+    assert compressed[:1] == compression.ALGORITHMS[algorithm][2]
+    assert len(compressed) < len(data)
+    assert compression.decompress(compressed) == data
+    assert compression.decompress(Binary(compressed, 0x81)) == data
+
+
+@pytest.mark.parametrize('value', [TEXT, 'é' * 500, ''])
+def test_text_field_round_trip(value):
+    field = Article.body
+    stored = field.get_prep_value(value)
+    if len(value.encode('utf-8')) < field.threshold:
+        assert stored == value
+    else:
+        assert field.is_db_value(stored)
+        assert field.from_db_value(stored) == value
+    assert field.to_python(decode(encode({'v': stored}))['v']) == value
+
+
+@pytest.mark.parametrize('value', [PAYLOAD, {'a': 1}, [1, 2, 3]])
+def test_json_field_round_trip(value):
+    field = Article.meta
+    stored = field.get_prep_value(value)
+    assert field.is_db_value(stored) == (value is PAYLOAD)
+    assert field.to_python(decode(encode({'v': stored}))['v']) == value
+
+    # JSON is accepted as the value
+    assert field.get_prep_value('{"a": 1}') == {'a': 1}
+
+
+def test_lazy_decompression():
+    article = Article._from_db({'body': Article.body.get_prep_value(TEXT), 'meta': None})
+    assert Article.body.is_db_value(article.__dict__['body'])
+    assert article.body == TEXT
+    assert article.__dict__['body'] == TEXT
+    assert article._get_document()['body'] == Article.body.get_prep_value(TEXT)
+
+
+def test_benchmark():
+    report = compression.benchmark({'text': TEXT, 'json': PAYLOAD}, number=1)
+    assert len(report) == 2 * len(compression.ALGORITHMS)
+    assert all(r['compressed_size'] < r['size'] for r in report)
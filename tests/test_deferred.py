@@ -0,0 +1,38 @@
+import pytest
+from bson import ObjectId
+
+from base.db.fields import CharField, TextField
+from base.db.frames_motor import Frame, QuerySet
+from base.db.frames_motor.queryset import DeferredFieldError
+
+
+class Author(Frame):
+    _collection = 'authors'
+    name = CharField(max_length=20)
+    bio = TextField(null=True)
+
+
+def test_deferred_fields():
+    query_set = QuerySet(Author).defer('bio')
+    partial_frames = []
+    first = query_set._to_frame({'_id': ObjectId(), 'name': 'Ann'}, partial_frames)
+    second = query_set._to_frame({'_id': ObjectId(), 'name': 'Bob'}, partial_frames)
+    assert first._deferred == second._deferred == {'bio'}
+    with pytest.raises(DeferredFieldError):
+        first.bio
+
+    # Setting a deferred field loads it on that frame only
+    first.bio = 'Writes'
+    assert first.bio == 'Writes'
+    assert first._deferred == set()
+    assert second._deferred == {'bio'}
+    with pytest.raises(DeferredFieldError):
+        second.bio
+    assert partial_frames == [first, second]
+
+
+def test_only():
+    query_set = QuerySet(Author).only('name')
+    frame = query_set._to_frame({'_id': ObjectId(), 'name': 'Ann'})
+    assert frame._deferred == {'bio'}
+    assert frame.name == 'Ann'
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from base.db.frames_motor import Frame
+from base.db.frames_motor.hedging import HedgeBudget, LatencyTracker, hedge_budget, hedged
+from base.db.frames_motor.scopes import SessionCollection
+
+
+class FakeCollection(object):
+    """A collection whose reads return after a delay, recording each read"""
+
+    def __init__(self, delays, read_preference=None, reads=None):
+        self.delays = delays
+        self.read_preference = read_preference or Primary()
+        self.reads = [] if reads is None else reads
+        self.cancelled = []
+
+    def with_options(self, read_preference=None, **options):
+        collection = FakeCollection(self.delays, read_preference, self.reads)
+        collection.cancelled = self.cancelled
+        return collection
+
+    async def find_one(self, filter=None, projection=None, **kwargs):
+        route = self.read_preference.mongos_mode
+        self.reads.append(route)
+        try:
+            delay = self.delays[route]
+            await asyncio.sleep(delay.pop(0) if isinstance(delay, list) else delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(route)
+            raise
+        return {'_id': route}
+
+
+class Dragon(Frame):
+    _collection = 'dragons'
+    _hedge = True
+
+
+class HedgedDragon(Frame):
+    _collection = 'dragons'
+    _hedge = True
+    _hedge_read_preference = 'secondary'
+
+
+@pytest.fixture(autouse=True)
+def latency():
+    """Give the frames a recent latency of 10ms and a full hedge budget"""
+    for frame_cls in (Dragon, HedgedDragon):
+        frame_cls._latency = LatencyTracker()
+        for _ in range(30):
+            frame_cls._latency.record(0.01)
+    hedge_budget.tokens = hedge_budget.burst
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_hedge_sent_at_percentile_and_loser_cancelled():
+    # The first (slow) attempt is cancelled once the hedge, sent with the
+    # read's own preference, returned
+    collection = FakeCollection({'secondaryPreferred': [0.5, 0]}, SecondaryPreferred())
+
+    async def read():
+        document = await Dragon._read_one({}, None, collection)
+        await asyncio.sleep(0)
+        return document
+
+    assert run(read()) == {'_id': 'secondaryPreferred'}
+    assert collection.reads == ['secondaryPreferred', 'secondaryPreferred']
+    assert collection.cancelled == ['secondaryPreferred']
+    assert hedge_budget.wins >= 1
+
+
+def test_hedge_not_sent_before_percentile():
+    collection = FakeCollection({'primary': 0.001, 'secondary': 0}, Primary())
+    assert run(HedgedDragon._read_one({}, None, collection)) == {'_id': 'primary'}
+    assert collection.reads == ['primary']
+
+
+def test_hedge_read_preference():
+    collection = FakeCollection({'primary': 0.5, 'secondary': 0}, Primary())
+
+    async def read():
+        document = await HedgedDragon._read_one({}, None, collection)
+        await asyncio.sleep(0)
+        return document
+
+    assert run(read()) == {'_id': 'secondary'}
+    assert collection.reads == ['primary', 'secondary']
+    assert collection.cancelled == ['primary']
+
+    # The first attempt's latency is recorded, up to when it was cancelled
+    assert max(HedgedDragon._latency.samples) >= 0.01
+
+
+def test_primary_reads_not_hedged_by_default():
+    collection = FakeCollection({'primary': 0.05}, Primary())
+    assert run(Dragon._read_one({}, None, collection)) == {'_id': 'primary'}
+    assert collection.reads == ['primary']
+
+
+def test_no_hedge_in_session():
+    collection = FakeCollection({'primary': 0.05, 'secondary': 0}, Primary())
+    session_collection = SessionCollection(collection, object())
+    assert run(HedgedDragon._read_one({}, None, session_collection)) == {'_id': 'primary'}
+    assert collection.reads == ['primary']
+
+
+def test_budget_denies_hedges():
+    hedge_budget.tokens = 0
+    collection = FakeCollection({'primary': 0.05, 'secondary': 0}, Primary())
+    assert run(HedgedDragon._read_one({}, None, collection)) == {'_id': 'primary'}
+    assert collection.reads == ['primary']
+
+
+def test_hedged_budget():
+    budget = HedgeBudget(ratio=0.5, burst=1)
+    calls = []
+
+    async def attempt(name, delay):
+        calls.append(name)
+        await asyncio.sleep(delay)
+        return name
+
+    async def read():
+        return await hedged(lambda: attempt('first', 0.05), lambda: attempt('second', 0), 0.01, budget)
+
+    assert run(read()) == 'second'
+    assert run(read()) == 'first'
+    assert run(read()) == 'second'
+    assert calls == ['first', 'second', 'first', 'first', 'second']
+    assert budget.report() == {'reads': 3, 'hedges': 2, 'denied': 1, 'wins': 2, 'tokens': 0.0}
+
+
+def test_hedged_error_falls_back():
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError('first')
+
+    async def fail_fast():
+        raise ValueError('second')
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return 'first'
+
+    assert run(hedged(slow, fail_fast, 0.01, HedgeBudget(burst=1))) == 'first'
+    with pytest.raises(ValueError, match='first'):
+        run(hedged(fail, fail_fast, 0.01, HedgeBudget(burst=1)))
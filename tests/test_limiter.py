@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from base.db.frames_motor.limiter import ConcurrencyLimiter, LimitedCursor
+
+
+class FakeCursor(object):
+    """A cursor over a list of documents counting the fetches"""
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+        self.fetches = []
+        self.size = None
+
+    @property
+    def alive(self):
+        return bool(self.documents)
+
+    def batch_size(self, batch_size):
+        self.size = batch_size
+        return self
+
+    async def to_list(self, length=None):
+        self.fetches.append(length)
+        length = len(self.documents) if length is None else length
+        documents, self.documents = self.documents[:length], self.documents[length:]
+        return documents
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_cancelled_operation_not_adapted():
+    limiter = ConcurrencyLimiter(initial=4, min_limit=2, max_limit=8)
+
+    async def operation():
+        await asyncio.sleep(1)
+
+    async def cancel():
+        task = asyncio.ensure_future(limiter.run('find_one', False, operation))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(cancel())
+    assert limiter.in_flight == 0
+    assert limiter._baselines == {}
+
+
+def test_operation_adapts_limit():
+    limiter = ConcurrencyLimiter(initial=2, min_limit=1, max_limit=8)
+
+    async def operation():
+        return 'done'
+
+    assert run(limiter.run('find_one', False, operation)) == 'done'
+    assert limiter.in_flight == 0
+    assert 'find_one' in limiter._baselines
+
+
+def test_cursor_fetches_batches():
+    cursor = FakeCursor(range(5))
+    limited = LimitedCursor(cursor, 'find', ConcurrencyLimiter()).batch_size(2)
+
+    async def read():
+        return [document async for document in limited]
+
+    assert run(read()) == [0, 1, 2, 3, 4]
+    assert cursor.size == 2
+    assert cursor.fetches == [2, 2, 2, 2]
+    assert not limited.alive
+
+
+def test_cursor_to_list_uses_fetched_documents():
+    cursor = FakeCursor(range(5))
+    limited = LimitedCursor(cursor, 'find', ConcurrencyLimiter()).batch_size(2)
+
+    async def read():
+        first = await limited.next()
+        return first, await limited.to_list(3), await limited.to_list()
+
+    assert run(read()) == (0, [1, 2, 3], [4])
+    assert cursor.fetches == [2, 2, None]
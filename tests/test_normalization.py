@@ -0,0 +1,87 @@
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from base.db.fields import ArrayField, CharField, DateTimeField, EmbeddedField, EncryptedField, IntegerField, \
+    ObjectIdField
+from base.db.frames_motor import Frame, SubFrame
+from base.db.frames_motor.normalization import normalize_filter
+
+
+class Item(SubFrame):
+    count = IntegerField()
+    owner = ObjectIdField()
+
+
+class Order(Frame):
+    _collection = 'orders'
+    total = IntegerField()
+    placed = DateTimeField()
+    customer = ObjectIdField()
+    items = ArrayField(EmbeddedField(Item))
+    codes = ArrayField(IntegerField())
+    note = CharField(max_length=20)
+    card = EncryptedField(key=os.urandom(32), null=True)
+
+
+fields = Order._fields
+ID = ObjectId()
+
+
+def test_casts_values():
+    casts = []
+    filter = normalize_filter({'total': '10', 'customer': str(ID), 'note': 10, 'other': '1'}, fields, casts)
+    assert filter == {'customer': ID, 'note': 10, 'other': '1', 'total': 10}
+    assert sorted(c[0] for c in casts) == ['customer', 'total']
+
+
+def test_casts_operators():
+    filter = normalize_filter({
+        'total': {'$gte': '1', '$in': ['2', 3], '$not': {'$lt': '0'}},
+        'codes': {'$all': ['1', '2']},
+        'items': {'$elemMatch': {'count': '2', 'owner': str(ID)}}
+    }, fields)
+    assert filter == {
+        'codes': {'$all': [1, 2]},
+        'items': {'$elemMatch': {'count': 2, 'owner': ID}},
+        'total': {'$gte': 1, '$in': [2, 3], '$not': {'$lt': 0}}
+    }
+    assert normalize_filter({'codes': '4', 'items.count': '5'}, fields) == {'codes': 4, 'items.count': 5}
+    assert normalize_filter({'codes': {'$elemMatch': {'$gt': '1'}}}, fields) == {'codes': {'$elemMatch': {'$gt': 1}}}
+
+
+def test_logical_operators_and_merge():
+    filter = normalize_filter({
+        '$and': [{'total': {'$gte': '1'}}, {'total': {'$lt': '5'}}, {'total': {'$lt': 9}}],
+        '$or': [{'customer': str(ID)}, {'note': 'x'}]
+    }, fields)
+    assert filter == {
+        '$and': [{'total': {'$lt': 9}}],
+        '$or': [{'customer': ID}, {'note': 'x'}],
+        'total': {'$gte': 1, '$lt': 5}
+    }
+
+
+def test_canonical_order():
+    filter = normalize_filter({'total': {'$lt': 2, '$gt': 1}, 'note': 'x', 'b': {'$lt': 2, '$gt': 1}}, fields)
+    assert list(filter) == ['b', 'note', 'total']
+    assert list(filter['total']) == ['$gt', '$lt']
+
+    # The conditions of unknown paths are kept as they are
+    assert list(filter['b']) == ['$lt', '$gt']
+
+
+def test_ids():
+    assert normalize_filter(None, fields) is None
+    assert normalize_filter(str(ID), fields) == {'_id': ID}
+
+
+def test_encrypted_fields():
+    with pytest.raises(ValueError):
+        normalize_filter({'card': '4111'}, fields)
+    with pytest.raises(ValueError):
+        normalize_filter({'card': {'$in': ['4111']}}, fields)
+    assert normalize_filter({'card': None}, fields) == {'card': None}
+    assert normalize_filter({'card': {'$exists': True}}, fields) == {'card': {'$exists': True}}
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+from base.db.fields import ArrayField, CharField, ForeignFrame, ForeignKey
+from base.db.frames_motor import Frame
+
+
+class Comment(Frame):
+    _collection = 'comments'
+    post = ForeignKey('Post', null=True, db_field='p')
+
+
+class Tag(Frame):
+    _collection = 'tags'
+    posts = ArrayField(ForeignKey('Post'))
+
+
+class Post(Frame):
+    _collection = 'posts'
+    title = CharField(max_length=20)
+    comments = ForeignFrame(frame=Comment, on_delete='_cascade')
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    async def raw_update_many(cls, filter, update, **kwargs):
+        calls.append(('update', cls, filter, update))
+        return 1
+
+    async def raw_delete_many(cls, filter, **kwargs):
+        calls.append(('delete', cls, filter))
+        return 1
+
+    async def count_by_filter(cls, filter=None, **kwargs):
+        calls.append(('count', cls, filter))
+        return 2
+
+    monkeypatch.setattr(Frame, 'raw_update_many', classmethod(raw_update_many))
+    monkeypatch.setattr(Frame, 'raw_delete_many', classmethod(raw_delete_many))
+    monkeypatch.setattr(Frame, 'count_by_filter', classmethod(count_by_filter))
+    return calls
+
+
+def make_post():
+    post = Post(title='a')
+    post.__dict__['_id'] = ObjectId()
+    return post
+
+
+def test_get_parent_key():
+    post = make_post()
+    assert asyncio.run(Comment()._get_parent_key(post)) == ('post', False, None)
+    assert asyncio.run(Tag()._get_parent_key(post))[:2] == ('posts', True)
+
+
+def test_cascade(calls):
+    post = make_post()
+    assert asyncio.run(post._cascade(ForeignFrame(frame=Comment)))
+    assert calls == [('delete', Comment, {'post': post._id})]
+
+
+def test_cascade_array(calls):
+    post = make_post()
+    assert asyncio.run(post._cascade(ForeignFrame(frame=Tag)))
+    assert calls == [('update', Tag, {'posts': post._id}, {'$pull': {'posts': post._id}})]
+
+
+def test_set_null_and_default(calls):
+    post = make_post()
+    assert asyncio.run(post._set_null(ForeignFrame(frame=Comment)))
+    assert asyncio.run(post._set_default(ForeignFrame(frame=Comment)))
+    assert calls == [
+        ('update', Comment, {'post': post._id}, {'$set': {'post': None}}),
+        ('update', Comment, {'post': post._id}, {'$set': {'post': None}})
+    ]
+
+
+def test_restrict(calls):
+    post = make_post()
+    assert not asyncio.run(post._restrict(ForeignFrame(frame=Comment)))
+    assert calls == [('count', Comment, {'post': post._id})]
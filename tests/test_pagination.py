@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from pymongo import DESCENDING
+
+from base.db.frames_motor.pagination import InvalidPage, Paginator
+
+
+class FakeFrame(object):
+    """A frame class over a list of numbers recording the arguments of `many`"""
+
+    items = list(range(45))
+    calls = []
+
+    @classmethod
+    async def count_by_filter(cls, filter):
+        return len(cls.items)
+
+    @classmethod
+    async def many(cls, filter, skip=0, limit=0, **kwargs):
+        cls.calls.append(kwargs)
+        return cls.items[skip:skip + limit]
+
+
+def test_pages():
+    async def paginate():
+        paginator = await Paginator(FakeFrame, per_page=20, orphans=5, by_creation=DESCENDING)
+        return paginator, await paginator[2], [len(p) async for p in paginator]
+
+    paginator, page, sizes = asyncio.run(paginate())
+    assert (paginator.item_count, paginator.page_count) == (45, 2)
+    assert (page.number, page.prev, page.next, len(page)) == (2, 1, None, 25)
+    assert page.offset(20) == 20
+    assert sizes == [20, 25]
+    assert FakeFrame.calls[0] == {'sort': [('_id', DESCENDING)]}
+
+
+def test_invalid_page():
+    async def paginate():
+        paginator = await Paginator(FakeFrame)
+        await paginator[4]
+
+    with pytest.raises(InvalidPage):
+        asyncio.run(paginate())
+
+
+def test_by_creation_with_sort():
+    with pytest.raises(AssertionError):
+        Paginator(FakeFrame, by_creation=DESCENDING, sort=[('name', 1)])
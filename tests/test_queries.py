@@ -0,0 +1,75 @@
+import pickle
+
+import pytest
+
+from base.db.frames_motor.queries import And, COMPILE_CACHE_MAX_VALUES, In, Or, Param, Q, compile_filter, to_filter
+
+
+def test_compile():
+    assert to_filter(Q.name == 'Burt') == {'name': 'Burt'}
+    assert to_filter(Q.level > 3) == {'level': {'$gt': 3}}
+    assert to_filter(And(Q.a == 1, Or(Q.b != 2, Q.c.d <= 3))) == {
+        '$and': [{'a': 1}, {'$or': [{'b': {'$ne': 2}}, {'c.d': {'$lte': 3}}]}]
+    }
+    assert to_filter({'raw': 1}) == {'raw': 1}
+
+
+def test_conditions_hash_by_structure():
+    assert (Q.a == 1) == (Q.a == 1)
+    assert hash(Q.a == [1, {'b': 2}]) == hash(Q.a == [1, {'b': 2}])
+    assert (Q.a == 1) != (Q.a == True)
+    assert (Q.a == 1) != (Q.a == 1.5)
+    assert And(Q.a == 1, Q.b == 2) == And(Q.a == 1, Q.b == 2)
+    assert And(Q.a == 1, Q.b == 2) != Or(Q.a == 1, Q.b == 2)
+    with pytest.raises(AttributeError):
+        (Q.a == 1).value = 2
+
+
+def test_compile_cache_identity():
+    first, _ = compile_filter(And(Q.a == 1, Q.b == [1, 2]))
+    second, _ = compile_filter(And(Q.a == 1, Q.b == [1, 2]))
+    assert first is second
+
+    # to_dict returns a copy safe to mutate
+    condition = Q.a == {'b': [1]}
+    copy = condition.to_dict()
+    copy['a']['b'].append(2)
+    assert condition.to_dict() == {'a': {'b': [1]}}
+
+    # Filters holding 1 and True don't share a cache entry
+    assert compile_filter(Q.a == True)[0] == {'a': True}
+    assert compile_filter(Q.a == 1)[0]['a'] is not True
+
+
+def test_large_nodes_not_cached():
+    values = list(range(COMPILE_CACHE_MAX_VALUES + 1))
+    first, _ = compile_filter(In(Q.a, values))
+    second, _ = compile_filter(In(Q.a, values))
+    assert first == second == {'a': {'$in': values}}
+    assert first is not second
+
+    small = values[:COMPILE_CACHE_MAX_VALUES]
+    assert compile_filter(In(Q.a, small))[0] is compile_filter(In(Q.a, small))[0]
+
+
+def test_unhashable_values():
+    class Value(object):
+        __hash__ = None
+
+    value = Value()
+    assert to_filter(Q.a == value) == {'a': value}
+
+
+def test_params():
+    template = And(Q.workspace == Param('ws'), Q.active == True)
+    filter, has_params = compile_filter(template)
+    assert has_params
+    assert template.bind(ws=3) == {'$and': [{'workspace': 3}, {'active': True}]}
+    assert to_filter(template, ws=4) == {'$and': [{'workspace': 4}, {'active': True}]}
+    with pytest.raises(KeyError):
+        template.bind()
+
+
+def test_pickle():
+    condition = And(Q.a == 1, Q.b == Param('b'))
+    assert pickle.loads(pickle.dumps(condition)) == condition
@@ -0,0 +1,26 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from base.rf.response import RawJSON, Response
+
+
+def test_response():
+    response = Response({'a': 1}, 'Saved', status_code=201)
+    assert response.status_code == 200
+    assert json.loads(response.content) == {
+        'result': True, 'status': 201, 'messages': {'general': 'Saved'}, 'data': {'a': 1}
+    }
+
+
+def test_raw_json_response():
+    response = Response(RawJSON(b'[1, 2]'), status_code=404)
+    assert response.status_code == 400
+    assert response['Content-Type'] == 'application/json'
+    assert json.loads(response.content) == {'result': False, 'status': 404, 'messages': {}, 'data': [1, 2]}
+
+
+def test_raw_json_response_arguments():
+    response = Response(RawJSON(b'{}'), {'general': 'é'}, 200, True, DjangoJSONEncoder, True, {'ensure_ascii': False})
+    assert '"general": "é"'.encode() in response.content
+    assert json.loads(response.content)['data'] == {}
@@ -0,0 +1,34 @@
+import pytest
+from pymongo.read_preferences import Primary, Secondary, SecondaryPreferred
+from pymongo.server_type import SERVER_TYPE
+
+from base.db.frames_motor.routing import _route_servers, get_read_preference
+
+
+def test_named_read_preference():
+    assert get_read_preference('primary') == Primary()
+    assert get_read_preference('secondary', 120) == Secondary(max_staleness=120)
+    assert get_read_preference('nearest', 90) is get_read_preference('nearest', 90)
+    with pytest.raises(AssertionError):
+        get_read_preference('primary', 90)
+    with pytest.raises(AssertionError):
+        get_read_preference('fastest')
+
+
+def test_read_preference_object():
+    read_preference = SecondaryPreferred(tag_sets=[{'dc': 'east'}])
+    assert get_read_preference(read_preference) is read_preference
+
+    stale = get_read_preference(read_preference, 120)
+    assert stale == SecondaryPreferred(tag_sets=[{'dc': 'east'}], max_staleness=120)
+    with pytest.raises(AssertionError):
+        get_read_preference(Primary(), 120)
+
+
+def test_route_servers():
+    types = {('a', 1): SERVER_TYPE.RSPrimary, ('b', 1): SERVER_TYPE.RSSecondary}
+    assert _route_servers('primary', types) == [('a', 1)]
+    assert _route_servers('secondaryPreferred', types) == [('b', 1)]
+    assert _route_servers('secondary', {('a', 1): SERVER_TYPE.RSPrimary}) == []
+    assert _route_servers('nearest', types) == [('a', 1), ('b', 1)]
+    assert _route_servers('secondary', {('m', 1): SERVER_TYPE.Mongos}) == [('m', 1)]
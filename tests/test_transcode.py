@@ -0,0 +1,91 @@
+import json
+import math
+from datetime import datetime
+
+from bson import Code, ObjectId, encode
+from bson.codec_options import CodecOptions
+
+from base.db.fields import ArrayField, CharField, CompressedJSONField, CompressedTextField, DateTimeField, \
+    EmbeddedField, IntegerField, PackedArrayField
+from base.db.frames_motor import Frame, SubFrame
+from base.db.frames_motor.transcode import _fallback, bson_to_json, bsons_to_json
+from base.rf.response import RawJSON
+
+
+class Part(SubFrame):
+    label = CharField(max_length=20, db_field='l')
+    vector = PackedArrayField(dtype='int32')
+
+
+class Report(Frame):
+    _collection = 'reports'
+    count = IntegerField(db_field='c')
+    text = CompressedTextField(threshold=0)
+    notes = ArrayField(CompressedTextField(threshold=8))
+    payload = CompressedJSONField(threshold=0, db_field='p')
+    part = EmbeddedField(Part)
+    parts = ArrayField(EmbeddedField(Part), db_field='ps')
+    created = DateTimeField()
+
+
+NAMES = Report._aliases.json_names()
+
+
+def stored(**values):
+    return encode(Report._aliases.to_db_document(values))
+
+
+def test_plain_values():
+    id = ObjectId()
+    data = encode({
+        '_id': id, 's': 'é"\n', 'i': 7, 'l': 2 ** 40, 'f': 1.5, 'nan': float('nan'), 'b': True, 'n': None,
+        'd': datetime(2021, 4, 20, 12, 30), 'doc': {'a': [1, {'b': 2}]}
+    })
+    result = bson_to_json(data)
+    assert isinstance(result, RawJSON)
+    document = json.loads(result)
+    assert math.isnan(document.pop('nan'))
+    assert document == {
+        '_id': str(id), 's': 'é"\n', 'i': 7, 'l': 2 ** 40, 'f': 1.5, 'b': True, 'n': None,
+        'd': '2021-04-20 12:30:00', 'doc': {'a': [1, {'b': 2}]}
+    }
+    assert result == _fallback(data, None, None)
+
+
+def test_aware_datetimes():
+    codec_options = CodecOptions(tz_aware=True)
+    data = encode({'d': datetime(2021, 4, 20, 12, 30)})
+    assert json.loads(bson_to_json(data, codec_options)) == {'d': '2021-04-20 12:30:00+00:00'}
+
+
+def test_names_and_binary_fields():
+    data = stored(
+        count=3,
+        text='hello ' * 10,
+        notes=['short', 'long enough to compress'],
+        payload={'a': [1, 2]},
+        part=Part(label='p', vector=[1, 2])._get_document(),
+        parts=[Part(label='q', vector=[3])._get_document()],
+        created=datetime(2021, 4, 20)
+    )
+    expected = {
+        'count': 3,
+        'text': 'hello ' * 10,
+        'notes': ['short', 'long enough to compress'],
+        'payload': {'a': [1, 2]},
+        'part': {'label': 'p', 'vector': [1, 2]},
+        'parts': [{'label': 'q', 'vector': [3]}],
+        'created': '2021-04-20 00:00:00'
+    }
+    assert json.loads(bson_to_json(data, None, NAMES)) == expected
+    assert json.loads(_fallback(data, None, NAMES)) == expected
+
+
+def test_unsupported_types_fall_back():
+    data = encode({'code': Code('return 1'), 'c': 1})
+    assert json.loads(bson_to_json(data, None, NAMES)) == {'code': 'return 1', 'count': 1}
+
+
+def test_many():
+    data = [encode({'a': 1}), encode({'a': 2})]
+    assert json.loads(bsons_to_json(data)) == [{'a': 1}, {'a': 2}]
@@ -0,0 +1,73 @@
+import pytest
+from django.core.validators import MaxValueValidator, MinValueValidator
+
+from base.db.fields import ArrayField, CharField, FloatField, IntegerField
+from base.db.frames_motor import Frame
+from base.db.frames_motor import validation
+from base.db.frames_motor.validation import compile_validator, validate_batch
+
+
+class Monster(Frame):
+    _collection = 'monsters'
+    name = CharField(max_length=10)
+    level = IntegerField(validators=[MinValueValidator(1), MaxValueValidator(100)], null=True)
+    speed = FloatField(null=True, db_field='s')
+    tags = ArrayField(IntegerField())
+
+
+def test_compile_validator():
+    validate = compile_validator(Monster._fields)
+    values = {'name': 'Burt', 'level': '7', 'speed': 'fast'}
+    errors = validate(values, {'name', 'level', 'speed'}, {})
+    assert values['level'] == 7
+    assert set(errors) == {'speed'}
+
+    # Only the named fields are cleaned
+    values = {'level': '7', 'speed': 'fast'}
+    assert validate(values, {'level'}, {}) == {}
+    assert values == {'level': 7, 'speed': 'fast'}
+
+
+def test_validate_batch():
+    tags = ['1', '2']
+    documents = [
+        {'name': 'Burt', 'level': 3, 'speed': 1.5, 'tags': tags},
+        {'name': 'Much too long a name', 'level': 0},
+        'not a document',
+        {'name': 'Ann', 'level': '4'}
+    ]
+    valid, errors = validate_batch(Monster, documents, offset=10)
+
+    assert valid == [
+        {'name': 'Burt', 'level': 3, 's': 1.5, 'tags': [1, 2]},
+        {'name': 'Ann', 'level': 4, 's': None, 'tags': []}
+    ]
+    assert [e['index'] for e in errors] == [11, 12]
+    assert set(errors[0]['errors']) == {'name', 'level'}
+
+    # The caller's lists aren't cleaned in place
+    assert tags == ['1', '2']
+    assert Monster.tags.default == []
+
+
+@pytest.mark.skipif(validation.numpy is None, reason='NumPy is not installed')
+def test_validate_batch_vectorized():
+    count = validation.VECTORIZE_MIN_ROWS
+    documents = [{'name': 'm', 'level': i % 100 + 1, 'speed': float(i)} for i in range(count)]
+    documents[5]['level'] = 0
+    documents[6]['level'] = '8'
+    documents[7]['level'] = True
+    documents[8]['level'] = 2 ** 70
+    documents[9]['speed'] = 'fast'
+
+    passed = validation._vectorized_check(Monster.level, [d['level'] for d in documents])
+    assert passed is None
+
+    documents[8]['level'] = 101
+    passed = validation._vectorized_check(Monster.level, [d['level'] for d in documents])
+    assert list(passed[4:10]) == [True, False, False, False, False, True]
+
+    valid, errors = validate_batch(Monster, documents)
+    assert [(e['index'], set(e['errors'])) for e in errors] == [(5, {'level'}), (8, {'level'}), (9, {'speed'})]
+    assert len(valid) == count - 3
+    assert valid[5]['level'] == 8
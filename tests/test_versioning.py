@@ -0,0 +1,42 @@
+from base.db.fields import CharField, IntegerField
+from base.db.frames_motor import Frame
+
+
+class Account(Frame):
+    _collection = 'accounts'
+    _versioned = True
+    name = CharField(max_length=20)
+
+
+class ShortAccount(Frame):
+    _collection = 'accounts'
+    _versioned = True
+    _version = IntegerField(null=True, db_field='_v')
+    name = CharField(max_length=20, db_field='n')
+
+
+def test_increment_version():
+    assert Account._increment_version({'$set': {'name': 'a'}}) == {'$set': {'name': 'a'}, '$inc': {'_version': 1}}
+    assert Account._increment_version([{'$set': {'name': 'a'}}]) == [
+        {'$set': {'name': 'a'}},
+        {'$set': {'_version': {'$add': [{'$ifNull': ['$_version', 0]}, 1]}}}
+    ]
+
+
+def test_increment_aliased_version():
+    update = ShortAccount._increment_version({'$set': {'n': 'a'}, '$inc': {'count': 1}})
+    assert update == {'$set': {'n': 'a'}, '$inc': {'count': 1, '_v': 1}}
+
+    # Translating the update again keeps the stored names
+    assert ShortAccount._aliases.update(update) == update
+    assert ShortAccount._increment_version([]) == [{'$set': {'_v': {'$add': [{'$ifNull': ['$_v', 0]}, 1]}}}]
+
+
+def test_instance_update():
+    account = ShortAccount(name='a')
+    account.__dict__['_id'] = 1
+    account.__dict__['_version'] = 3
+    assert account._instance_update({'$set': {'n': 'b'}}) == (
+        {'_id': 1, '_v': 3},
+        {'$set': {'n': 'b'}, '$inc': {'_v': 1}}
+    )